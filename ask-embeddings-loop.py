@@ -1,96 +1,65 @@
-import pinecone
+import argparse
+import asyncio
 import openai
 import os
-import pprint
+import sys
 
-pp = pprint.PrettyPrinter(indent=2)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from query_engine import QueryEngine
+from sessions import get_session_store
+from vectorstore import open_store
 
 openai.api_key = os.environ['OPENAI_API_KEY']
 embed_model = "text-embedding-ada-002"
 
-index_name = os.environ['PINECONE_INDEX']
-pinecone.init(
-    api_key=os.environ['PINECONE_API_KEY'],  # app.pinecone.io (console)
-    environment=os.environ['PINECONE_ENVIRONMENT']  # next to API key in console
-)
-index = pinecone.GRPCIndex(index_name)
 
-messagesList = []
-
-print("Enter your system prompt context below. As an example it should be something like: \n'you are an experienced frontend developer who cares about readability'")
-system_prompt = input("Leave blank for default: ")
-if system_prompt == "":
-    # system message to 'prime' the model
-    primer = f"""You are Q&A bot. A highly intelligent system that answers
-    user questions based on the information provided by the user above
-    each question. If the information can not be found in the information
-    provided by the user you truthfully say "I don't know".
-
-    your answers should be great examples of clean, easy to read code
-    """
-
-messagesList.append({"role": "system", "content": system_prompt})
-first_prompt = input("Enter your prompt: ")
-
-res = openai.Embedding.create(
-    input=[first_prompt],
-    engine=embed_model
-)
-
-# retrieve from Pinecone
-xq = res['data'][0]['embedding']
-
-# get relevant contexts (including the questions)
-res = index.query(xq, top_k=5, include_metadata=True)
-
-pp.pprint(res)
-
-contexts = [item['metadata']['text'] for item in res['matches']]
-
-augmented_query = "\n\n---\n\n".join(contexts)+"\n\n-----\n\n"+first_prompt
-messagesList.append({"role": "user", "content": augmented_query})
-
-response = openai.ChatCompletion.create(
-    model="gpt-4",
-    messages=messagesList
-)
-
-resContent = response["choices"][0]["message"]["content"]
-pp.pprint(resContent)
-messagesList.append({"role": "assistant", "content": resContent})
-
-while True:
-    next_prompt = input("Enter next prompt (q to quit): ")
-    if next_prompt == "q":
-        import csv
-        with open('chatlog.csv', 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, messagesList[0].keys())
-            writer.writeheader()
-            for message in messagesList:
-                writer.writerow(message)
-        print("Wrote log of chat to `chatlog.csv`")
-        exit()
-    
-    res = openai.Embedding.create(
-        input=[next_prompt],
-        engine=embed_model
-    )
-    # retrieve from Pinecone
-    xq = res['data'][0]['embedding']
-
-    # get relevant contexts (including the questions)
-    res = index.query(xq, top_k=5, include_metadata=True)
-    pp.pprint(res)
-    contexts = [item['metadata']['text'] for item in res['matches']]
-
-    augmented_query = "\n\n---\n\n".join(contexts)+"\n\n-----\n\n"+first_prompt
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messagesList
-    )
-
-    resContent = response["choices"][0]["message"]["content"]
-    pp.pprint(resContent)
-    messagesList.append({"role": "assistant", "content": resContent})
-     
-pp.pprint(res)
\ No newline at end of file
+def print_token(token):
+    # show the answer as it streams in
+    sys.stdout.write(token)
+    sys.stdout.flush()
+
+
+async def main(args):
+    # connect to the vector store picked by VECTOR_STORE, Pinecone by default
+    index = open_store()
+
+    sessions = get_session_store()
+    if args.resume is not None:
+        # a resumed session keeps its system prompt
+        session = sessions.resume(args.resume or None)
+        print(f"Resuming session {session.id}: {session.title}")
+    else:
+        print("Enter your system prompt context below. As an example it should be something like: \n'you are an experienced frontend developer who cares about readability'")
+        system_prompt = await asyncio.to_thread(input, "Leave blank for default: ")
+        if system_prompt == "":
+            # system message to 'prime' the model
+            system_prompt = f"""You are Q&A bot. A highly intelligent system that answers
+            user questions based on the information provided by the user above
+            each question. If the information can not be found in the information
+            provided by the user you truthfully say "I don't know".
+
+            your answers should be great examples of clean, easy to read code
+            """
+        session = sessions.start(system_prompt)
+
+    # retrieval for each prompt runs while the history is prepared, and the
+    # answer streams to the terminal as it is generated. Prompts keep to the
+    # CHAT_CONTEXT_TOKENS budget, see src/conversation.py. Every message is
+    # saved to the session as it happens, see src/sessions.py
+    engine = QueryEngine(session.system_prompt, store=index, embed_model=embed_model, session=session)
+    prompt = await asyncio.to_thread(input, "Enter your prompt: ")
+    while prompt != "q":
+        answer = await engine.ask(prompt, on_token=print_token)
+        timing = answer.timing
+        print(f"\n\n[first token {timing.first_token_secs:.2f}s, retrieval {timing.retrieval_secs:.2f}s, "
+              f"full answer {timing.total_secs:.2f}s, {timing.prompt_tokens} prompt tokens]")
+        # read in a thread, so old turns are summarized while the user types
+        prompt = await asyncio.to_thread(input, "Enter next prompt (q to quit): ")
+
+    print(f"Session {engine.session.id} saved, resume it with --resume {engine.session.id}")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", nargs="?", type=int, const=0, metavar="SESSION",
+                    help="continue a saved session, the last one used without SESSION")
+asyncio.run(main(parser.parse_args()))
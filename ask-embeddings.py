@@ -1,32 +1,42 @@
-import pinecone
-import openai
 import os
 import pprint
-from rich import print
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
 
 pp = pprint.PrettyPrinter(indent=2)
 
-openai.api_key = os.environ['OPENAI_API_KEY']
+api_key = os.environ['OPENAI_API_KEY']
 embed_model = "text-embedding-ada-002"
 
-index_name = os.environ['PINECONE_INDEX']
-pinecone.init(
-    api_key=os.environ['PINECONE_API_KEY'],  # app.pinecone.io (console)
-    environment=os.environ['PINECONE_ENVIRONMENT']  # next to API key in console
-)
-index = pinecone.GRPCIndex(index_name)
 
+def connect():
+    """Load OpenAI, the tokenizer and the retrieval modules, and open the vector store"""
+    import openai
+    from chunker import model_tokenizer
+    from vectorstore import open_store
+    import hybrid  # noqa: F401
+
+    openai.api_key = api_key
+    # the question and the prompt are counted in cl100k_base, for the rate limits
+    model_tokenizer(embed_model)
+    # the vector store picked by VECTOR_STORE, Pinecone by default
+    return open_store()
+
+
+# all of that happens while the question is typed
+connecting = ThreadPoolExecutor(max_workers=1).submit(connect)
 query = input("Enter your question to be augmented: ")
-res = openai.Embedding.create(
-    input=[query],
-    engine=embed_model
-)
+index = connecting.result()
 
-# retrieve from Pinecone
-xq = res['data'][0]['embedding']
+from rich import print  # noqa: E402
+from ratelimit import chat_completion  # noqa: E402
+from hybrid import search  # noqa: E402
 
-# get relevant contexts (including the questions)
-res = index.query(xq, top_k=5, include_metadata=True)
+# get relevant contexts (including the questions) from the vector store and
+# the keyword index, repeated questions skip OpenAI and the vector store
+res = search(query, index, top_k=5, engine=embed_model)
 
 pp.pprint(res)
 
@@ -41,7 +51,7 @@ each question. If the information can not be found in the information
 provided by the user you truthfully say "I don't know".
 """
 
-res = openai.ChatCompletion.create(
+res = chat_completion(
     model="gpt-4",
     messages=[
         {"role": "system", "content": primer},
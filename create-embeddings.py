@@ -1,119 +1,77 @@
-import datetime
-from langchain.document_loaders import ReadTheDocsLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import openai 
+"""Embed a local ReadTheDocs dump into the vector index.
+
+Parses and chunks the HTML files under the dump directory in a process pool
+and streams the chunks through the embed and upsert pipeline, see
+src/bulk_ingest.py. Each file is checkpointed once it is in the index, so
+running this again after a crash or ctrl+c carries on where it stopped.
+
+    $ wget -r -A.html -P rtdocs https://python.langchain.com/en/latest/
+    $ python3 create-embeddings.py rtdocs --workers 8
+"""
+import argparse
+import asyncio
 import os
-import pinecone
-import tiktoken
-from time import sleep
-
+import sys
 
 from tqdm.auto import tqdm
-from uuid import uuid4
-
-loader = ReadTheDocsLoader('rtdocs')
-docs = loader.load()
-print(f"loaded {len(docs)} documents")
-
-tokenizer = tiktoken.get_encoding('p50k_base')
-
-# create the length function
-def tiktoken_len(text):
-    tokens = tokenizer.encode(
-        text,
-        disallowed_special=()
-    )
-    return len(tokens)
-
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=400,
-    chunk_overlap=20,
-    length_function=tiktoken_len,
-    separators=["\n\n", "\n", " ", ""]
-)
-
-chunks = []
-
-for doc in docs:
-    doc.metadata['source'].replace('rtdocs/', 'https://')
-
-data = []
-
-for doc in docs:
-    data.append({"text": doc['page_content'], "url": doc.metadata['source']})
 
-for idx, record in enumerate(tqdm(data)):
-    texts = text_splitter.split_text(record['text'])
-    chunks.extend([{
-        'id': str(uuid4()),
-        'text': texts[i],
-        'chunk': i,
-        'url': record['url']
-    } for i in range(len(texts))])
+# share the chunker with the Temporal activities in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from bulk_ingest import INGEST_WORKERS, PARSE_AHEAD, count_source_files, get_checkpoint, ingest
+from dedup import get_dedup_index
+from embedding_cache import aembed_texts, get_cache
+from ratelimit import get_limiter
+from resources import open_resources
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", default="rtdocs", help="the dump, defaults to rtdocs")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="parse and chunk processes")
+    parser.add_argument("--parse-ahead", type=int, default=PARSE_AHEAD,
+                        help="files parsed ahead of the embeddings, per process")
+    parser.add_argument("--restart", action="store_true", help="forget the checkpoint and ingest every file")
+    args = parser.parse_args()
+
+    checkpoint = get_checkpoint()
+    if args.restart:
+        checkpoint.reset()
+
+    # the same OpenAI key and vector store as the workers: VECTOR_STORE picks
+    # the backend, PINECONE_INDEX the index, created with EMBEDDING_DIMENSION
+    # dimensions if it does not exist yet
+    res = open_resources()
+    index, embed_model = res.store, res.embed_model
+    # view index stats
+    print(f"here are the index stats: {index.describe()}")
+
+    async def embed(texts, token_counts):
+        # create embeddings, rate limiting and retries are handled by aembed_texts
+        return await aembed_texts(texts, engine=embed_model, token_counts=token_counts)
+
+    progress = tqdm(total=count_source_files(args.directory), unit="file")
+
+    def on_progress(stats):
+        progress.n = stats.files + stats.skipped + stats.failed
+        progress.set_postfix(chunks=stats.chunks, chunks_per_sec=f"{stats.chunks_per_sec:.1f}", refresh=False)
+        progress.refresh()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-embed_model = "text-embedding-ada-002"
-
-res = openai.Embedding.create(
-    input=[
-        "Sample document text goes here",
-        "there will be several phrases in each batch"
-    ], engine=embed_model
-)
-
-index_name = 'gpt-4-temporal-docs'
-
-# initialize connection to pinecone
-pinecone.init(
-    api_key=os.getenv("PINECONE_API_KEY"),  # app.pinecone.io (console)
-    environment=os.getenv("PINECONE_ENVIRONMENT")  # next to API key in console
-)
-
-# check if index already exists (it shouldn't if this is first time)
-if index_name not in pinecone.list_indexes():
-    # if does not exist, create index
-    pinecone.create_index(
-        index_name,
-        dimension=len(res['data'][0]['embedding']),
-        metric='dotproduct'
-    )
-# connect to index
-index = pinecone.GRPCIndex(index_name)
-# view index stats
-print(f"here are the pinecone index stats: {index.describe_index_stats()}")
-
-batch_size = 100  # how many embeddings we create and insert at once
-
-for i in tqdm(range(0, len(chunks), batch_size)):
-    # find end of batch
-    i_end = min(len(chunks), i+batch_size)
-    meta_batch = chunks[i:i_end]
-    # get ids
-    ids_batch = [x['id'] for x in meta_batch]
-    # get texts to encode
-    texts = [x['text'] for x in meta_batch]
-    # create embeddings (try-except added to avoid RateLimitError)
     try:
-        res = openai.Embedding.create(input=texts, engine=embed_model)
-    except:
-        done = False
-        while not done:
-            sleep(5)
-            try:
-                res = openai.Embedding.create(input=texts, engine=embed_model)
-                done = True
-            except:
-                pass
-    embeds = [record['embedding'] for record in res['data']]
-    # cleanup metadata
-    meta_batch = [{
-        'text': x['text'],
-        'chunk': x['chunk'],
-        'url': x['url']
-    } for x in meta_batch]
-    to_upsert = list(zip(ids_batch, embeds, meta_batch))
-    # upsert to Pinecone
-    index.upsert(vectors=to_upsert)
-
-print("completed insert of data")
\ No newline at end of file
+        stats = asyncio.run(ingest(args.directory, index, embed, checkpoint, workers=args.workers,
+                                   parse_ahead=args.parse_ahead, on_progress=on_progress))
+    finally:
+        progress.close()
+
+    print(f"ingested {stats.files} files in {stats.wall_secs:.1f}s, {stats.files_per_sec:.1f} files/s, "
+          f"{stats.chunks} new or changed chunks, {stats.chunks_per_sec:.1f} chunks/s")
+    print(f"skipped {stats.skipped} files already ingested, deleted {stats.deleted} stale chunks"
+          + (f", {stats.failed} files failed and will be retried on the next run" if stats.failed else ""))
+    print(f"embedded in {stats.pipeline.batches} batches, linked {stats.duplicates} near duplicate chunks "
+          f"to existing vectors instead, saving {stats.duplicate_tokens} tokens")
+    print(f"near duplicates: {get_dedup_index().stats()}")
+    print(f"embedding cache: {get_cache().stats()}")
+    print(f"rate limiting: {get_limiter('embeddings').metrics()}")
+
+
+if __name__ == "__main__":
+    main()
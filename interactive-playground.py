@@ -1,50 +1,117 @@
 import openai
 import os
+import sys
 
+from rich.text import Text
+from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Container
 from textual.widgets import Button, Header, Input, Footer, Static, RichLog
-from textual import events
-from textual.reactive import reactive
+from textual.worker import Worker, WorkerState
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from query_engine import QueryEngine
+from sessions import get_session_store
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+SYSTEM_PROMPT = "you are an experienced frontend developer who cares deeply about code readability"
+
+
 class GPTPrompt(Static):
     """A widget to prompt for ChatGPT"""
-            
+
     def compose(self) -> ComposeResult:
         yield Input(placeholder="Enter your prompt")
+        yield Button("Stop", id="stop", variant="error", disabled=True)
         yield Button("Enter", id="enter", variant="primary")
 
+
 class GPTResponse(Static):
     """A widget to hold ChatGPT responses"""
 
     def compose(self) -> ComposeResult:
         yield RichLog(highlight=True, markup=True, wrap=True)
+        # the answer being streamed, moved to the log once it is complete
+        yield Static(id="answer")
+        yield Static("Waiting for input to query ChatGPT", id="status")
 
-    def on_ready(self) -> None:
-        text_log = self.query_one(RichLog)
-        text_log.write("Waiting for input to query ChatGPT")
-        text_log.write("...")
-
-    def on_key(self, event: events.Key) -> None:
-        text_log = self.query_one(RichLog)
-        # text_log.write(event)
 
 class GPTApp(App):
-    """A Textual app to use GPT-4 from the command line"""
-    CSS_PATH="interactive.css"
-    BINDINGS = [("d", "toggle_dark", "Toggle dark mode")]
+    """A Textual app to use GPT-4 from the command line
+
+    Answers stream in from a worker, so the UI keeps handling input while
+    GPT-4 writes. The conversation keeps its history between prompts, see
+    query_engine.py, and is saved as it happens, see sessions.py. A new prompt
+    or escape cancels the answer in flight.
+    """
+    CSS_PATH = "interactive.css"
+    BINDINGS = [("d", "toggle_dark", "Toggle dark mode"), ("escape", "stop", "Stop answer")]
+
+    def __init__(self, system_prompt: str = SYSTEM_PROMPT, **kwargs):
+        super().__init__(**kwargs)
+        self.engine = QueryEngine(system_prompt, session=get_session_store().start(system_prompt))
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
-        button_id = event.button.Pressed
         if event.button.id == "enter":
-            inny = self.query_one(Input)
-            prompt = inny.value
-            response = openai.ChatCompletion.create(model="gpt-4", messages=[
-                {"role": "user", "content": prompt}])
-            outty = self.query_one(RichLog)
-            outty.write(response["choices"][0]["message"]["content"])
+            self.submit()
+        elif event.button.id == "stop":
+            self.action_stop()
+
+    def on_input_submitted(self, event: Input.Submitted) -> None:
+        self.submit()
+
+    def submit(self) -> None:
+        inny = self.query_one(Input)
+        prompt = inny.value.strip()
+        if not prompt:
+            return
+        inny.value = ""
+        self.query_one(RichLog).write(Text(f"> {prompt}", style="bold"))
+        self.ask(prompt)
+
+    @work(exclusive=True, group="answer", exit_on_error=False)
+    async def ask(self, prompt: str) -> None:
+        """Stream the answer to `prompt`, cancelling any answer still in flight"""
+        answer = self.query_one("#answer", Static)
+        status = self.query_one("#status", Static)
+        parts = []
+
+        def on_token(token: str) -> None:
+            if not parts:
+                status.update("Streaming answer...")
+            parts.append(token)
+            # plain text, markup in the answer is shown as is
+            answer.update(Text("".join(parts)))
+
+        answer.update("")
+        status.update("Waiting for GPT-4...")
+        self.query_one("#stop", Button).disabled = False
+        try:
+            result = await self.engine.ask(prompt, on_token=on_token)
+        finally:
+            # cancelled or not, what arrived so far goes to the log
+            if parts:
+                self.query_one(RichLog).write(Text("".join(parts)))
+            answer.update("")
+        status.update(f"first token {result.timing.first_token_secs:.2f}s, "
+                      f"full answer {result.timing.total_secs:.2f}s, {result.timing.tokens} tokens")
+
+    def on_worker_state_changed(self, event: Worker.StateChanged) -> None:
+        if event.worker.group != "answer" or event.state == WorkerState.RUNNING:
+            return
+        # a new prompt cancels the previous answer, that one reports nothing
+        if any(worker.group == "answer" and worker.is_running for worker in self.workers):
+            return
+        self.query_one("#stop", Button).disabled = True
+        if event.state == WorkerState.CANCELLED:
+            self.query_one("#status", Static).update("Stopped, the answer was not kept in the conversation")
+        elif event.state == WorkerState.ERROR:
+            self.query_one("#status", Static).update(f"Request failed: {event.worker.error}")
+
+    def action_stop(self) -> None:
+        """Cancel the answer in flight"""
+        self.workers.cancel_group(self, "answer")
 
     def compose(self) -> ComposeResult:
         """Create child widgets"""
@@ -55,7 +122,8 @@ class GPTApp(App):
     def action_toggle_dark(self) -> None:
         """An action to toggle dark mode."""
         self.dark = not self.dark
-    
+
+
 if __name__ == "__main__":
     app = GPTApp()
     app.run()
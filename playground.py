@@ -1,37 +1,51 @@
+import argparse
+import asyncio
 import os
+import sys
 import openai
 from rich import print
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from query_engine import QueryEngine
+from sessions import get_session_store
+
 # have this environment variable set
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-messagesList = []
-print("Enter your system prompt context below. As an example it should be something like: \n'you are an experienced frontend developer who cares about readability'")
-system_prompt = input("Leave blank for default: ")
-if system_prompt == "":
-    system_prompt = "you are an experienced frontend developer who cares deeply about code readability"
-messagesList.append({"role": "system", "content": system_prompt})
-first_prompt = input("Enter your prompt: ")
-messagesList.append({"role": "user", "content": first_prompt})
-
-response = openai.ChatCompletion.create(model="gpt-4", messages=messagesList)
-
-resContent = response["choices"][0]["message"]["content"]
-print(resContent)
-messagesList.append({"role": "assistant", "content": resContent})
-while True:
-    next_prompt = input("Enter next prompt (q to quit): ")
-    if next_prompt == "q":
-        import csv
-        with open('chatlog.csv', 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, messagesList[0].keys())
-            writer.writeheader()
-            for message in messagesList:
-                writer.writerow(message)
-        print("Wrote log of chat to `chatlog.csv`")
-        exit()
-    messagesList.append({"role": "user", "content": str(next_prompt)})
-    response = openai.ChatCompletion.create(model="gpt-4", messages=messagesList)
-    resContent = response["choices"][0]["message"]["content"]
-    print(resContent)
-    messagesList.append({"role": "assistant", "content": resContent})
\ No newline at end of file
+
+def print_token(token):
+    # show the answer as it streams in, outside rich so markup in it stays as is
+    sys.stdout.write(token)
+    sys.stdout.flush()
+
+
+async def main(args):
+    sessions = get_session_store()
+    if args.resume is not None:
+        # a resumed session keeps its system prompt
+        session = sessions.resume(args.resume or None)
+        print(f"Resuming session {session.id}: {session.title}")
+    else:
+        print("Enter your system prompt context below. As an example it should be something like: \n'you are an experienced frontend developer who cares about readability'")
+        system_prompt = await asyncio.to_thread(input, "Leave blank for default: ")
+        if system_prompt == "":
+            system_prompt = "you are an experienced frontend developer who cares deeply about code readability"
+        session = sessions.start(system_prompt)
+    # no vector store, the prompts go to GPT-4 as they are. Every message is
+    # saved to the session as it happens, see src/sessions.py
+    engine = QueryEngine(session.system_prompt, session=session)
+    prompt = await asyncio.to_thread(input, "Enter your prompt: ")
+    while prompt != "q":
+        answer = await engine.ask(prompt, on_token=print_token)
+        print(f"\n\n[dim]first token {answer.timing.first_token_secs:.2f}s, "
+              f"full answer {answer.timing.total_secs:.2f}s[/dim]")
+        # read in a thread, so old turns are summarized while the user types
+        prompt = await asyncio.to_thread(input, "Enter next prompt (q to quit): ")
+
+    print(f"Session {engine.session.id} saved, resume it with --resume {engine.session.id}")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", nargs="?", type=int, const=0, metavar="SESSION",
+                    help="continue a saved session, the last one used without SESSION")
+asyncio.run(main(parser.parse_args()))
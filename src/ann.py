@@ -0,0 +1,110 @@
+"""Inverted file (IVF) index for approximate dotproduct search.
+
+Vectors are clustered with k-means; each vector is filed under its nearest
+centroid. A query scores only the vectors filed under its `nprobe` best
+centroids, so latency grows with `nprobe / nlist` of the corpus instead of the
+whole of it. Raising `nprobe` trades latency for recall.
+
+The index itself only holds centroids and row assignments. `LocalStore` in
+vectorstore.py persists both and does the actual scoring.
+"""
+import os
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", "16"))
+# below this many vectors exact search is fast enough and k-means is noisy
+IVF_MIN_VECTORS = int(os.environ.get("IVF_MIN_VECTORS", "20000"))
+KMEANS_ITERATIONS = 10
+KMEANS_MAX_SAMPLE = 100000
+
+
+def default_nlist(count: int) -> int:
+    """Number of clusters for `count` vectors, about 4 * sqrt(n)"""
+    return max(1, int(4 * np.sqrt(count)))
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS,
+           seed: int = 667) -> np.ndarray:
+    """Spherical k-means centroids for dotproduct search
+
+    Trains on at most KMEANS_MAX_SAMPLE vectors. Empty clusters are reseeded
+    from the points furthest from their centroid.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > KMEANS_MAX_SAMPLE:
+        vectors = vectors[rng.choice(len(vectors), KMEANS_MAX_SAMPLE, replace=False)]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels, best = assign(vectors, centroids, return_scores=True)
+        # per cluster sums in one pass over the vectors sorted by label
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        filled = np.flatnonzero(counts)
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(vectors[order], np.cumsum(counts)[filled] - counts[filled])
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[np.argsort(best)[:len(empty)]]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, return_scores: bool = False,
+           block_rows: int = 8192):
+    """Index of the best scoring centroid for each vector"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[start:start + block_rows], dtype=np.float32) @ centroids.T
+        labels[start:start + len(block)] = block.argmax(axis=1)
+        scores[start:start + len(block)] = block.max(axis=1)
+    return (labels, scores) if return_scores else labels
+
+
+class IVFIndex:
+    """Centroids plus the rows filed under each of them"""
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self._sorted_rows = np.zeros(0, dtype=np.int64)
+        self._bounds = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def set_assignments(self, rows: Sequence[int], lists: Sequence[int]) -> None:
+        """Replace the inverted lists, `lists[i]` is the centroid of `rows[i]`"""
+        rows = np.asarray(rows, dtype=np.int64)
+        lists = np.asarray(lists, dtype=np.int64)
+        order = np.argsort(lists, kind="stable")
+        self._sorted_rows = rows[order]
+        self._bounds = np.searchsorted(lists[order], np.arange(self.nlist + 1))
+
+    def candidates(self, query: np.ndarray, nprobe: int = IVF_NPROBE) -> np.ndarray:
+        """Rows filed under the `nprobe` centroids closest to `query`"""
+        nprobe = min(nprobe, self.nlist)
+        scores = self.centroids @ np.asarray(query, dtype=np.float32)
+        probe = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([
+            self._sorted_rows[self._bounds[c]:self._bounds[c + 1]] for c in probe
+        ])
+
+    def save(self, path: Path) -> None:
+        tmp_path = Path(path).with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp_path, self.centroids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["IVFIndex"]:
+        try:
+            return cls(np.load(path))
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,76 @@
+"""Benchmark the IVF index of the local vector store against exact search.
+
+Builds one store, then reports query p50/p99 latency and recall@k against a
+full scan for a range of `nprobe` values. The vectors are drawn around a few
+hundred topic centres, since real chunk embeddings cluster far more than
+uniform noise does.
+
+    $ python3 -m benchmarks.bench_ann --vectors 200000 --nprobe 4 8 16 32
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_vectorstore import percentile_ms
+from vectorstore import LocalStore
+
+
+def clustered_vectors(count: int, dimension: int, topics: int, rng) -> np.ndarray:
+    centres = rng.normal(size=(topics, dimension))
+    vectors = centres[rng.integers(0, topics, count)] + rng.normal(scale=0.8, size=(count, dimension))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def run_queries(store: LocalStore, queries: np.ndarray, top_k: int):
+    latencies, results = [], []
+    for query in queries:
+        began = time.perf_counter()
+        res = store.query(query, top_k=top_k, include_metadata=False)
+        latencies.append(time.perf_counter() - began)
+        results.append({m['id'] for m in res['matches']})
+    return latencies, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(667)
+    vectors = clustered_vectors(args.vectors + args.queries, args.dimension, args.topics, rng)
+    vectors, queries = vectors[:args.vectors], vectors[args.vectors:]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = LocalStore(tmp, index="flat")
+        for start in range(0, args.vectors, 1000):
+            store.upsert([(str(i), vectors[i], {'chunk': i})
+                          for i in range(start, min(start + 1000, args.vectors))])
+        began = time.perf_counter()
+        store.build_index(args.nlist)
+        print(f"trained {store.describe()['nlist']} clusters in {time.perf_counter() - began:.1f}s")
+
+        latencies, exact = run_queries(store, queries, args.top_k)
+        print(f"{'nprobe':>8} {'p50 ms':>8} {'p99 ms':>8} {'recall@' + str(args.top_k):>10}")
+        print(f"{'exact':>8} {percentile_ms(latencies, 50):>8.2f} {percentile_ms(latencies, 99):>8.2f} {1:>10.3f}")
+
+        store.index = "ivf"
+        for nprobe in args.nprobe:
+            store.nprobe = nprobe
+            latencies, results = run_queries(store, queries, args.top_k)
+            recall = np.mean([len(r & ref) / args.top_k for r, ref in zip(results, exact)])
+            print(f"{nprobe:>8} {percentile_ms(latencies, 50):>8.2f} "
+                  f"{percentile_ms(latencies, 99):>8.2f} {recall:>10.3f}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Benchmark bulk ingest of a ReadTheDocs dump with create-embeddings.py.
+
+Writes a fake dump of docs pages, then ingests it into a store with upsert
+latency, through the fake embeddings API, two ways:
+
+- old: the previous create-embeddings.py, with its two bugs fixed so it
+  runs. Loads the whole dump with `ReadTheDocsLoader`, chunks every page on
+  one core into one list, then embeds and upserts the list.
+- bulk: `bulk_ingest.ingest`, a process pool parsing a few files ahead of
+  the bounded embed and upsert stage, with a checkpoint per file.
+
+Each run is a fresh process with its own state, and reports files/sec,
+chunks/sec and its peak RSS, for two dump sizes, so a memory use that grows
+with the dump shows. Then the bulk ingest is killed halfway through the
+larger dump and run again, to show the rerun skipping what was done.
+
+    $ python3 -m benchmarks.bench_bulk_ingest --files 200 800 --workers 4
+"""
+import argparse
+import html
+import json
+import os
+import resource
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.bench_chunker import make_document
+from benchmarks.scratch import scratch_env
+
+SRC = Path(__file__).resolve().parents[1]
+DIMENSION = 64
+UPSERT_LATENCY = 0.05
+
+
+def write_dump(root: Path, files: int, paragraphs: int) -> None:
+    """`files` pages laid out like a `wget -r` of a ReadTheDocs site"""
+    for i in range(files):
+        path = root / "docs.bench.local" / "en" / "latest" / f"section-{i // 100}" / f"page-{i}.html"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        body = "".join(f"<p>{html.escape(p)}</p>\n" for p in make_document(paragraphs, seed=i).split("\n\n"))
+        path.write_text(f"<html><head><title>page {i}</title></head><body><nav>menu</nav>"
+                        f"<main id=\"main-content\">{body}</main></body></html>")
+
+
+def run_old(root: str) -> dict:
+    """The old create-embeddings.py, with `page_content` and the URL fixed"""
+    import asyncio
+    from langchain.document_loaders import ReadTheDocsLoader
+    from chunker import iter_chunks
+    from embedding_cache import aembed_texts
+    from lexical import get_lexical_index
+    from manifest import chunk_id, plan_ingest, save_manifest
+    from pipeline import embed_and_upsert
+
+    started = time.perf_counter()
+    docs = ReadTheDocsLoader(root, features="html.parser").load()
+    pages = {}
+    for doc in docs:
+        url = doc.metadata['source'].replace(root.rstrip('/') + '/', 'https://')
+        pages.setdefault(url, []).extend([{
+            'id': chunk_id(url, i, text), 'text': text, 'chunk': i, 'url': url,
+        } for i, text in enumerate(iter_chunks(doc.page_content))])
+    chunks = []
+    for url, page_chunks in pages.items():
+        pending, _ = plan_ingest(url, page_chunks)
+        chunks.extend(pending)
+    store = make_store()
+
+    async def embed(texts, token_counts):
+        return await aembed_texts(texts, engine="text-embedding-ada-002", token_counts=token_counts)
+
+    async def upsert(vectors):
+        await asyncio.to_thread(store.upsert, vectors)
+
+    asyncio.run(embed_and_upsert(chunks, embed, upsert))
+    get_lexical_index().add(chunks)
+    for url, page_chunks in pages.items():
+        save_manifest(url, page_chunks)
+    return {'files': len(docs), 'chunks': len(chunks), 'secs': time.perf_counter() - started}
+
+
+def run_bulk(root: str, workers: int) -> dict:
+    import asyncio
+    from bulk_ingest import ingest
+    from embedding_cache import aembed_texts
+
+    async def embed(texts, token_counts):
+        return await aembed_texts(texts, engine="text-embedding-ada-002", token_counts=token_counts)
+
+    stats = asyncio.run(ingest(root, make_store(), embed, workers=workers))
+    return {'files': stats.files, 'skipped': stats.skipped, 'chunks': stats.chunks, 'secs': stats.wall_secs}
+
+
+def make_store():
+    from benchmarks.fakes import FakeStore
+
+    class DiscardingStore(FakeStore):
+        """Sleeps like a remote index, and keeps nothing so it does not add to the peak"""
+
+        def upsert(self, vectors) -> None:
+            time.sleep(self.latency)
+
+    return DiscardingStore(UPSERT_LATENCY)
+
+
+def child(args) -> None:
+    import openai
+    from benchmarks.fakes import openai_app, serve_in_thread
+
+    openai.api_base = f"{serve_in_thread(openai_app(0.05, DIMENSION))}/v1"
+    result = run_old(args.dump) if args.run == "old" else run_bulk(args.dump, args.workers)
+    # kilobytes on Linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def spawn(run: str, dump: Path, state: Path, workers: int) -> subprocess.Popen:
+    command = [sys.executable, "-m", "benchmarks.bench_bulk_ingest", "--run", run,
+               "--dump", str(dump), "--workers", str(workers)]
+    env = scratch_env(str(state), OPENAI_API_KEY="sk-bench", PYTHONPATH=str(SRC),
+                      OPENAI_EMBED_RPM="1000000", OPENAI_EMBED_TPM="1000000000")
+    # its own process group, so the parse pool can be killed with it
+    return subprocess.Popen(command, env=env, cwd=SRC, stdout=subprocess.PIPE, text=True,
+                            start_new_session=True)
+
+
+def result_of(process: subprocess.Popen) -> dict:
+    out, _ = process.communicate()
+    if process.returncode:
+        raise RuntimeError(f"benchmark run exited with code {process.returncode}")
+    return json.loads(out.splitlines()[-1])
+
+
+def checkpointed(state: Path) -> int:
+    try:
+        with sqlite3.connect(state / "checkpoint.sqlite3") as conn:
+            return conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[200, 800])
+    parser.add_argument("--paragraphs", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--run", choices=["old", "bulk"], help=argparse.SUPPRESS)
+    parser.add_argument("--dump", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return child(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'files':>6} {'run':>5} {'seconds':>8} {'files/s':>8} {'chunks/s':>9} {'peak RSS':>9}")
+        for files in args.files:
+            dump = Path(tmp) / f"rtdocs-{files}"
+            write_dump(dump, files, args.paragraphs)
+            for run in ["old", "bulk"]:
+                result = result_of(spawn(run, dump, Path(tempfile.mkdtemp(dir=tmp)), args.workers))
+                print(f"{files:>6} {run:>5} {result['secs']:>8.2f} {result['files'] / result['secs']:>8.1f} "
+                      f"{result['chunks'] / result['secs']:>9.0f} {result['peak_rss_mb']:>7.0f}MB")
+
+        files = max(args.files)
+        state = Path(tempfile.mkdtemp(dir=tmp))
+        process = spawn("bulk", Path(tmp) / f"rtdocs-{files}", state, args.workers)
+        while checkpointed(state) < files // 2 and process.poll() is None:
+            time.sleep(0.05)
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        killed_at = checkpointed(state)
+        result = result_of(spawn("bulk", Path(tmp) / f"rtdocs-{files}", state, args.workers))
+        print(f"\nkilled after {killed_at} of {files} files were checkpointed, the rerun skipped "
+              f"{result['skipped']} and ingested {result['files']} in {result['secs']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Compare the single-pass chunker against the old langchain splitter setup.
+
+Run from the `src` directory:
+
+    $ python3 -m benchmarks.bench_chunker
+"""
+import argparse
+import random
+import time
+
+import tiktoken
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from chunker import CHUNK_OVERLAP, CHUNK_SIZE, SEPARATORS, iter_chunks, tiktoken_len
+
+
+def legacy_tiktoken_len(text) -> int:
+    """The length function tasks.py used to hand to the splitter"""
+    tokenizer = tiktoken.get_encoding('p50k_base')
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def make_document(paragraphs: int, seed: int = 667) -> str:
+    """Build a docs-page sized blob of text
+
+    Mostly short lines and paragraphs, with the occasional run-on paragraph the
+    way BeautifulSoup flattens tables and code listings.
+    """
+    rng = random.Random(seed)
+    vocab = ["gitpod", "workspace", "temporal", "worker", "the", "a", "of", "to",
+             "configure", "task", "image", "port", "yml", "prebuild", "env",
+             "variable", "and", "with", "command", "init", "open", "preview"]
+    blocks = []
+    for _ in range(paragraphs):
+        longest = 900 if rng.random() < 0.1 else 30
+        lines = [" ".join(rng.choice(vocab) for _ in range(rng.randint(5, longest)))
+                 for _ in range(rng.randint(1, 6))]
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def time_it(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paragraphs", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=legacy_tiktoken_len,
+        separators=SEPARATORS,
+    )
+
+    print(f"{'paragraphs':>10} {'tokens':>8} {'splitter s':>11} {'chunker s':>10} {'speedup':>8} {'chunks old/new':>15}")
+    for paragraphs in args.paragraphs:
+        text = make_document(paragraphs)
+        old_chunks = splitter.split_text(text)
+        new_chunks = list(iter_chunks(text))
+        assert all(tiktoken_len(c) <= CHUNK_SIZE for c in new_chunks)
+
+        old = time_it(lambda: splitter.split_text(text), args.repeat)
+        new = time_it(lambda: list(iter_chunks(text)), args.repeat)
+        print(f"{paragraphs:>10} {tiktoken_len(text):>8} {old:>11.4f} {new:>10.4f} "
+              f"{old / new:>7.1f}x {len(old_chunks):>7}/{len(new_chunks):<7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Prompt tokens sent per turn over a long chat session.
+
+Replays a synthetic 50 turn session: a question per turn, five retrieved
+docs chunks of up to 400 tokens with the overlapping neighbours real
+retrieval returns, and an answer of a few hundred tokens. The old loop kept
+every augmented question and answer in `messagesList` and re-sent all of it
+each turn. `ConversationContext` sends fresh contexts for the current
+question only, drops duplicate chunks and packs history into the budget,
+summarizing what it evicts. No API calls are made.
+
+    $ python3 -m benchmarks.bench_conversation --turns 50 --budget 6000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.bench_chunker import make_document
+from chunker import iter_chunks, tiktoken_len
+from conversation import SUMMARY_TOKENS, ConversationContext, augment, message_tokens
+
+SYSTEM_PROMPT = """You are Q&A bot. A highly intelligent system that answers
+user questions based on the information provided by the user above
+each question. If the information can not be found in the information
+provided by the user you truthfully say "I don't know"."""
+
+GIT_WORDS = ["gitpod", "workspace", "prebuild", "port", "env", "image", "task", "yml", "init", "command"]
+
+
+def session(turns: int, seed: int = 667):
+    """(question, contexts, answer) for every turn"""
+    rng = random.Random(seed)
+    chunks = list(iter_chunks(make_document(2000, seed)))
+    for _ in range(turns):
+        question = "How do I " + " ".join(rng.choice(GIT_WORDS) for _ in range(rng.randint(8, 25))) + "?"
+        # neighbouring chunks share their overlap, and every so often the same chunk comes back twice
+        first = rng.randrange(len(chunks) - 5)
+        contexts = chunks[first:first + 4]
+        contexts.append(contexts[rng.randrange(4)] if rng.random() < 0.5 else chunks[rng.randrange(len(chunks))])
+        answer = " ".join(rng.choice(GIT_WORDS) for _ in range(rng.randint(150, 450)))
+        yield question, contexts, answer
+
+
+async def truncating_summary(summary, turns) -> str:
+    """Stands in for the summary model, a summary that stays at its token cap"""
+    text = summary + " " + " ".join(turn.question for turn in turns)
+    while tiktoken_len(text) > SUMMARY_TOKENS:
+        text = text[len(text) // 4:]
+    return text
+
+
+def old_loop_tokens(turns):
+    sent, history = [], message_tokens(SYSTEM_PROMPT)
+    for question, contexts, answer in turns:
+        prompt = message_tokens(augment(question, contexts))
+        sent.append(history + prompt)
+        history += prompt + message_tokens(answer)
+    return sent
+
+
+async def budgeted_tokens(turns, budget: int, summarize: bool):
+    context = ConversationContext(SYSTEM_PROMPT, budget, summarize=truncating_summary if summarize else None)
+    rows, build_secs = [], 0.0
+    for question, contexts, answer in turns:
+        started = time.perf_counter()
+        prompt = context.build(question, contexts)
+        build_secs += time.perf_counter() - started
+        rows.append(prompt)
+        context.add_turn(question, answer)
+        await context.compact()
+    return rows, build_secs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--budget", type=int, default=6000)
+    parser.add_argument("--no-summary", action="store_true", help="evict old turns without summarizing")
+    args = parser.parse_args()
+
+    turns = list(session(args.turns))
+    old = old_loop_tokens(turns)
+    prompts, build_secs = asyncio.run(budgeted_tokens(turns, args.budget, not args.no_summary))
+
+    print(f"{'turn':>5} {'old loop':>10} {'budgeted':>10} {'turns kept':>11} {'contexts':>9} {'dupes':>6}")
+    for turn in sorted({1, 2, 5, 10, 20, 30, 40, args.turns} & set(range(1, args.turns + 1))):
+        prompt = prompts[turn - 1]
+        print(f"{turn:>5} {old[turn - 1]:>10,} {prompt.tokens:>10,} {prompt.turns:>11} "
+              f"{prompt.contexts:>9} {prompt.duplicates:>6}")
+    over = next((turn for turn, tokens in enumerate(old, 1) if tokens > 8192), None)
+    print(f"\ntotal prompt tokens: old loop {sum(old):,}, budgeted {sum(p.tokens for p in prompts):,}")
+    print(f"old loop overflows gpt-4's 8k window at turn {over}" if over else "old loop stays inside 8k")
+    print(f"prompt packing: {build_secs / args.turns * 1000:.2f} ms per turn")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Benchmark near-duplicate elimination of chunks before embedding.
+
+Writes a docs site where every page has the navigation of its section, a
+sidebar and footer shared by the whole site with the page's own name and
+edit link in them, and a body of its own. The pages are parsed and chunked
+the way the `parse_and_chunk_file` activity does, and the new chunks of
+each page go through `DedupIndex.claim` and `commit` one page at a time,
+as `process_file_contents` runs them. Reports:
+
+- chunks and tokens sent to the embeddings API, and embedding requests,
+  with and without dedup
+- claim and commit time per chunk, MinHash signature included
+- every link checked against the exact Jaccard similarity of the two
+  chunks' shingles, and exact copies that were not linked
+- how many of the BM25 top 5 results, as the ask scripts retrieve them,
+  near duplicate a better ranked result, for questions about the
+  boilerplate and about the bodies
+
+    $ python3 -m benchmarks.bench_dedup --pages 200
+"""
+from benchmarks.scratch import use_scratch_env
+
+# the manifests are read from their directory when manifest.py is imported
+SCRATCH = use_scratch_env("bench_dedup-")
+
+import argparse  # noqa: E402
+import html  # noqa: E402
+import random  # noqa: E402
+import shutil  # noqa: E402
+import time  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+from benchmarks.bench_chunker import make_document  # noqa: E402
+from chunker import tiktoken_len  # noqa: E402
+from dedup import DEDUP_THRESHOLD, DedupIndex, minhash, shingle_hashes, similarity  # noqa: E402
+from lexical import LexicalIndex  # noqa: E402
+from pipeline import token_batches  # noqa: E402
+import tasks  # noqa: E402
+
+SECTIONS = ["getting-started", "configure", "references", "integrations", "workspaces", "prebuilds"]
+MENU = ["Introduction", "Quickstart", "Workspaces", "Tasks", "Ports", "Prebuilds", "Environment variables",
+        "Dotfiles", "Browser extension", "VS Code", "JetBrains", "SSH", "Gitpod CLI", "Self-hosted",
+        "Organizations", "Billing", "Integrations", "GitHub", "GitLab", "Bitbucket", "Troubleshooting"]
+
+
+def boilerplate(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(MENU).lower() for _ in range(words))
+
+
+def write_site(directory: Path, pages: int, paragraphs: int, boilerplate_words: int) -> list:
+    """(path, url) of every page"""
+    rng = random.Random(667)
+    navigation = {section: boilerplate(rng, boilerplate_words) for section in SECTIONS}
+    sidebar = boilerplate(rng, boilerplate_words)
+    footer = boilerplate(rng, boilerplate_words)
+    site = []
+    for i in range(pages):
+        section = SECTIONS[i % len(SECTIONS)]
+        url = f"https://docs.bench.local/docs/{section}/page-{i}"
+        body = "".join(f"<p>{html.escape(p)}</p>\n" for p in make_document(paragraphs, seed=i).split("\n\n"))
+        path = directory / f"page-{i}.html"
+        path.write_text(
+            f"<html><head><title>Page {i}</title></head><body>"
+            f"<nav><p>{navigation[section]}</p><p>You are reading page {i} of {section}</p></nav>"
+            f"<aside><p>{sidebar}</p></aside>"
+            f"<main>{body}</main>"
+            f"<footer><p>{footer}</p><p>Edit page {i} on GitHub: {url}</p></footer>"
+            "</body></html>"
+        )
+        site.append((str(path), url))
+    return site
+
+
+def jaccard(a: str, b: str) -> float:
+    a, b = set(shingle_hashes(a)), set(shingle_hashes(b))
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def requests(chunks: list) -> int:
+    return sum(1 for _ in token_batches(chunks))
+
+
+def redundant_in_top(index: LexicalIndex, queries: list, signatures: dict, threshold: float,
+                     top_k: int = 5) -> float:
+    """Mean number of results per query that near duplicate a better ranked one"""
+    redundant = 0
+    for query in queries:
+        seen = []
+        for match in index.search(query, top_k):
+            signature = signatures[match['id']]
+            if any(similarity(signature, other) >= threshold for other in seen):
+                redundant += 1
+            seen.append(signature)
+    return redundant / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--paragraphs", type=int, default=20)
+    parser.add_argument("--boilerplate-words", type=int, default=250,
+                        help="words in each of the navigation, sidebar and footer")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    try:
+        site = write_site(Path(SCRATCH), args.pages, args.paragraphs, args.boilerplate_words)
+        dedup_index = DedupIndex(Path(SCRATCH) / "dedup.sqlite3", threshold=DEDUP_THRESHOLD or 0.85)
+        chunks, unique, duplicates = [], [], []
+        claim_secs = 0.0
+        for path, url in site:
+            plan = tasks.chunk_file_contents(tasks.read_file(path, url))
+            pending = plan['pages'][url]
+            for chunk in pending:
+                chunk['tokens'] = tiktoken_len(chunk['text'])
+            started = time.perf_counter()
+            kept, linked = dedup_index.claim(pending)
+            # as if the embeddings were upserted
+            dedup_index.commit(kept)
+            claim_secs += time.perf_counter() - started
+            chunks += pending
+            unique += kept
+            duplicates += linked
+
+        tokens = sum(chunk['tokens'] for chunk in chunks)
+        unique_tokens = sum(chunk['tokens'] for chunk in unique)
+        print(f"{args.pages} pages, {len(chunks)} chunks, threshold {dedup_index.threshold}\n")
+        print(f"{'':>9} {'chunks':>7} {'tokens':>10} {'requests':>9}")
+        print(f"{'all':>9} {len(chunks):>7} {tokens:>10,} {requests(chunks):>9}")
+        print(f"{'dedup':>9} {len(unique):>7} {unique_tokens:>10,} {requests(unique):>9}")
+        print(f"\nlinked {len(duplicates)} chunks ({len(duplicates) / len(chunks):.0%}), "
+              f"saving {tokens - unique_tokens:,} tokens, claim {claim_secs / len(chunks) * 1e6:.0f}us per chunk")
+
+        by_id = {chunk['id']: chunk for chunk in chunks}
+        links = dict(dedup_index._conn.execute("SELECT chunk_id, vector_id FROM refs WHERE chunk_id != vector_id"))
+        scores = [jaccard(by_id[chunk_id]['text'], by_id[vector_id]['text']) for chunk_id, vector_id in links.items()]
+        texts = [" ".join(chunk['text'].split()) for chunk in unique]
+        print(f"exact Jaccard of linked pairs: min {min(scores, default=1):.2f}, p5 "
+              f"{np.percentile(scores, 5) if scores else 1:.2f}, {sum(s < 0.75 for s in scores)} below 0.75; "
+              f"{len(texts) - len(set(texts))} exact copies not linked")
+
+        rng = random.Random(42)
+        queries = [" ".join(rng.sample(MENU, 2)).lower() for _ in range(args.queries // 2)]
+        queries += [" ".join(rng.choice(chunk['text'].split()) for _ in range(3))
+                    for chunk in rng.sample(chunks, args.queries - len(queries))]
+        signatures = {chunk['id']: minhash(chunk['text']) for chunk in chunks}
+        print("\nnear duplicates of a better result in the BM25 top 5, per question:")
+        for name, indexed in [("all", chunks), ("dedup", unique)]:
+            index = LexicalIndex(Path(SCRATCH) / f"lexical-{name}.sqlite3")
+            index.add(indexed)
+            print(f"{name:>9} {redundant_in_top(index, queries, signatures, dedup_index.threshold):.2f}")
+            index.close()
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
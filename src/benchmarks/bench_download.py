@@ -0,0 +1,94 @@
+"""Benchmark the download stage against a local aiohttp server.
+
+Compares the old download loop (new session per call, 10 byte reads, blocking
+writes) with `downloader.download`, and times the conditional GET path for a
+page that has not changed.
+
+    $ python3 -m benchmarks.bench_download
+"""
+import argparse
+import asyncio
+import hashlib
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+import downloader
+
+
+def make_app(size: int) -> web.Application:
+    body = (b"<html><body>" + b"<p>gitpod workspace docs</p>\n" * (size // 29) + b"</body></html>")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    async def page(request: web.Request) -> web.Response:
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="text/html", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/page", page)
+    return app
+
+
+async def legacy_download(url: str, path: Path) -> None:
+    """The download loop tasks.py used before the downloader module"""
+    async with aiohttp.ClientSession() as sess:
+        async with sess.get(url) as resp:
+            with open(path, 'wb') as fd:
+                async for chunk in resp.content.iter_chunked(10):
+                    fd.write(chunk)
+
+
+async def time_downloads(fn, count: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            await fn(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return time.perf_counter() - started
+
+
+async def main(args):
+    runner = web.AppRunner(make_app(args.size_kb * 1024))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/page"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path = Path(tmp)
+        downloader.VALIDATORS_DIR = tmp_path / "validators"
+        total_mb = args.size_kb * args.count / 1024
+
+        legacy = await time_downloads(
+            lambda i: legacy_download(url, tmp_path / f"legacy-{i}"), args.count, args.concurrency)
+        print(f"legacy      {legacy:8.3f}s  {total_mb / legacy:8.1f} MB/s")
+
+        fresh = await time_downloads(
+            lambda i: downloader.download(url, tmp_path / f"new-{i}", conditional=False),
+            args.count, args.concurrency)
+        print(f"downloader  {fresh:8.3f}s  {total_mb / fresh:8.1f} MB/s  ({legacy / fresh:.1f}x)")
+
+        result = await downloader.download(url, tmp_path / "seed")
+        downloader.save_validators(url, result.etag, result.last_modified)
+        cached = await time_downloads(
+            lambda i: downloader.download(url, tmp_path / f"cond-{i}"), args.count, args.concurrency)
+        print(f"304 path    {cached:8.3f}s  {args.count / cached:8.1f} pages/s")
+
+    await downloader.close_session()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,204 @@
+"""End-to-end ingestion benchmark on a local Temporal server.
+
+Starts a Temporal dev server through `WorkflowEnvironment` (or connects to
+`--server`), runs the real workers from worker.py in this process, and crawls
+fixture pages from a local HTTP server with one CrawlWorkflow, the way
+starter.py does. Embeddings come from a fake OpenAI endpoint with configurable
+latency and rate limit, vectors go to an in-memory store with upsert latency.
+
+Reports URLs/sec, chunks/sec, p50/p95/p99 seconds per FileProcessing workflow,
+a per-activity breakdown taken from the workflow histories and the stage
+totals the crawl returns, and writes it all as JSON so runs can be compared across commits.
+
+`WorkflowEnvironment.start_local` downloads the dev server on first use, so
+offline it needs `--server`. This benchmark has not been run against a
+server yet, there are no recorded results.
+
+    $ python3 -m benchmarks.bench_e2e --urls 200 --embed-rpm 3000 --output e2e.json
+"""
+from benchmarks.scratch import use_scratch_env
+
+# before the pipeline modules read their paths
+SCRATCH = use_scratch_env("bench_e2e-")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import multiprocessing  # noqa: E402
+import os  # noqa: E402
+import shutil  # noqa: E402
+import subprocess  # noqa: E402
+import time  # noqa: E402
+from collections import defaultdict  # noqa: E402
+from dataclasses import asdict  # noqa: E402
+from concurrent.futures import ProcessPoolExecutor  # noqa: E402
+from multiprocessing.managers import SyncManager  # noqa: E402
+from typing import Dict, List  # noqa: E402
+from uuid import uuid4  # noqa: E402
+
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+from temporalio.client import Client  # noqa: E402
+from temporalio.testing import WorkflowEnvironment  # noqa: E402
+from temporalio.worker import SharedStateManager  # noqa: E402
+
+import codec  # noqa: E402
+import placement  # noqa: E402
+import resources  # noqa: E402
+import worker  # noqa: E402
+from benchmarks.fakes import FakeStore, docs_site_app, openai_app, serve  # noqa: E402
+from workflows import CrawlParams, CrawlWorkflow  # noqa: E402
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(samples))}
+
+
+def history_timings(history) -> Dict[str, float]:
+    """Seconds per activity type (schedule to completion) and for the whole workflow"""
+    timings: Dict[str, float] = defaultdict(float)
+    scheduled = {}
+    for event in history.events:
+        at = event.event_time.ToDatetime()
+        if event.HasField("activity_task_scheduled_event_attributes"):
+            name = event.activity_task_scheduled_event_attributes.activity_type.name
+            scheduled[event.event_id] = (name, at)
+        elif event.HasField("activity_task_started_event_attributes"):
+            _, scheduled_at = scheduled[event.activity_task_started_event_attributes.scheduled_event_id]
+            timings["schedule_to_start"] += (at - scheduled_at).total_seconds()
+        elif event.HasField("activity_task_completed_event_attributes"):
+            name, scheduled_at = scheduled[event.activity_task_completed_event_attributes.scheduled_event_id]
+            timings[name] += (at - scheduled_at).total_seconds()
+    events = history.events
+    timings["workflow"] = (events[-1].event_time.ToDatetime() - events[0].event_time.ToDatetime()).total_seconds()
+    return timings
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def crawl(env: WorkflowEnvironment, args, base_url: str):
+    """Run the workers and one CrawlWorkflow, returns its result, wall time and history timings"""
+    parse_pool = ProcessPoolExecutor(max_workers=args.parse_pool,
+                                     mp_context=multiprocessing.get_context("spawn"))
+    manager = SyncManager(ctx=multiprocessing.get_context("spawn"))
+    manager.start()
+    task_queues = worker.sticky_task_queues(args.queues)
+    workers = worker.create_workers(env.client, task_queues, parse_pool,
+                                    SharedStateManager.create_from_multiprocessing(manager))
+    board = placement.get_load_board()
+
+    async def heartbeat_load_board() -> None:
+        while True:
+            await asyncio.to_thread(board.heartbeat, task_queues)
+            await asyncio.sleep(placement.STALE_SECS / 3)
+
+    run_futures = [asyncio.create_task(w.run()) for w in workers]
+    heartbeat = asyncio.create_task(heartbeat_load_board())
+    try:
+        crawl_id = f"bench-e2e-{uuid4()}"
+        started = time.perf_counter()
+        result = await env.client.execute_workflow(
+            CrawlWorkflow.run,
+            CrawlParams(urls=[f"{base_url}/{i}" for i in range(args.urls)], concurrency=args.concurrency),
+            id=crawl_id,
+            task_queue=worker.DISTRIBUTION_QUEUE,
+        )
+        wall_secs = time.perf_counter() - started
+
+        stages: Dict[str, List[float]] = defaultdict(list)
+        for i in range(args.urls):
+            history = await env.client.get_workflow_handle(f"{crawl_id}-url-{i}").fetch_history()
+            for name, secs in history_timings(history).items():
+                stages[name].append(secs)
+        return result, wall_secs, stages
+    finally:
+        heartbeat.cancel()
+        await asyncio.gather(*[w.shutdown() for w in workers], return_exceptions=True)
+        await asyncio.gather(*run_futures, return_exceptions=True)
+        parse_pool.shutdown()
+        manager.shutdown()
+
+
+async def run(args) -> dict:
+    site_runner, site_url = await serve(docs_site_app(args.urls, args.paragraphs))
+    openai_fake = openai_app(args.embed_latency, args.dimension, args.embed_rpm)
+    openai_runner, openai_url = await serve(openai_fake)
+    openai.api_base = f"{openai_url}/v1"
+    store = FakeStore(args.upsert_latency)
+    resources.open_resources(store=store)
+    resources.use_pooled_openai_session()
+
+    try:
+        if args.server:
+            env = WorkflowEnvironment.from_client(
+                await Client.connect(args.server, data_converter=codec.data_converter))
+        else:
+            env = await WorkflowEnvironment.start_local(data_converter=codec.data_converter)
+        try:
+            result, wall_secs, stages = await crawl(env, args, f"{site_url}/docs")
+        finally:
+            await env.shutdown()
+    finally:
+        await resources.close_resources()
+        await site_runner.cleanup()
+        await openai_runner.cleanup()
+
+    embed = result.stages.get("embed")
+    chunks = embed.items if embed else 0
+    workflow_secs = stages.pop("workflow", [])
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "urls": args.urls,
+        "processed": result.processed,
+        "failed": result.failed,
+        "chunks": chunks,
+        "wall_secs": wall_secs,
+        "urls_per_sec": args.urls / wall_secs,
+        "chunks_per_sec": chunks / wall_secs,
+        "workflow_secs": percentiles(workflow_secs),
+        "stage_secs": {name: percentiles(samples) for name, samples in sorted(stages.items())},
+        "stage_totals": {name: asdict(timing) for name, timing in sorted(result.stages.items())},
+        "embedding_requests": openai_fake["requests"],
+        "embedding_rate_limited": openai_fake["rate_limited"],
+        "vector_upserts": store.upserts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--urls", type=int, default=100)
+    parser.add_argument("--paragraphs", type=int, default=100, help="paragraphs per fixture page")
+    parser.add_argument("--concurrency", type=int, default=10, help="crawl child workflows at once")
+    parser.add_argument("--queues", type=int, default=2, help="sticky task queues")
+    parser.add_argument("--parse-pool", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--embed-latency", type=float, default=0.2)
+    parser.add_argument("--embed-rpm", type=int, default=None, help="fake API requests per minute")
+    parser.add_argument("--upsert-latency", type=float, default=0.05)
+    parser.add_argument("--dimension", type=int, default=128)
+    parser.add_argument("--server", default=None, help="existing Temporal server, e.g. localhost:7233")
+    parser.add_argument("--output", default=None, help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
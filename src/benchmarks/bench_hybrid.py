@@ -0,0 +1,140 @@
+"""Benchmark hybrid retrieval against dense only retrieval.
+
+Builds a synthetic docs corpus: pages about a few dozen topics, each config
+key like `ports.onOpen` spelled out on a couple of pages of its topic, and
+some pages repeated as near duplicates the way overlapping chunks are.
+Embeddings place a page mostly by its topic and only a little by the key it
+defines, like real embeddings that know what a page is about but do not
+single out one field name. Questions ask about one key, some by its exact
+name and some in other words. Reports hit rate and recall@k of the pages
+defining the key, distinct pages in the top k, context tokens per relevant
+chunk, and query latency, for dense top-k, BM25 top-k, the RRF fusion of
+both, and RRF followed by MMR as in hybrid.py.
+
+    $ python3 -m benchmarks.bench_hybrid --topics 40 --pages 50
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.fakes import FakeStore
+from chunker import tiktoken_len
+from hybrid import CANDIDATES, mmr, reciprocal_rank_fusion, tfidf_similarity
+from lexical import LexicalIndex
+
+SECTIONS = ["tasks", "ports", "vscode", "github", "prebuilds", "image", "gitConfig", "workspaceLocation",
+            "jetbrains", "env", "coverage", "mainConfiguration"]
+FIELDS = ["init", "command", "before", "onOpen", "visibility", "extensions", "addCheck", "addBadge",
+          "pullRequests", "file", "context", "name", "port", "openMode", "branches", "plugins"]
+WORDS = ["gitpod", "workspace", "configure", "start", "open", "project", "repository", "the", "a",
+         "to", "and", "with", "when", "build", "run", "setup", "dev", "environment", "terminal"]
+
+
+def corpus(args, rng: np.random.Generator):
+    """(chunks, vectors, queries) where each query is (text, vector, relevant ids)"""
+    topic_vectors = rng.normal(size=(args.topics, args.dimension))
+    key_vectors = {}
+    topic_words = [[f"topic{t}word{i}" for i in range(6)] for t in range(args.topics)]
+    keys = [f"{s}.{f}" for s in SECTIONS for f in FIELDS]
+    rng.shuffle(keys)
+    chunks, vectors, defines = [], [], {}
+    for t in range(args.topics):
+        topic_keys = keys[t * args.keys_per_topic:(t + 1) * args.keys_per_topic]
+        for p in range(args.pages):
+            words = list(rng.choice(WORDS + topic_words[t], size=args.words))
+            key = topic_keys[p % len(topic_keys)] if p < 2 * len(topic_keys) else None
+            if key:
+                words[rng.integers(len(words)):0] = [f"`{key}`", "sets", "the", key.split(".")[1]]
+            text = " ".join(words)
+            copies = 2 if rng.random() < args.duplicates else 1
+            for copy in range(copies):
+                chunk_id = f"t{t}-p{p}-{copy}"
+                variant = text if copy == 0 else text + " " + " ".join(rng.choice(WORDS, size=5))
+                chunks.append({'id': chunk_id, 'text': variant, 'chunk': p, 'url': f"https://docs/{t}/{p}"})
+                vector = topic_vectors[t] + rng.normal(scale=args.noise, size=args.dimension)
+                if key:
+                    vector += args.key_signal * key_vectors.setdefault(key, rng.normal(size=args.dimension))
+                vectors.append(vector / np.linalg.norm(vector))
+                if key:
+                    defines.setdefault(key, set()).add(f"t{t}-p{p}")
+    queries = []
+    for key in rng.choice(sorted(defines), size=args.queries):
+        t = int(next(iter(defines[key])).split("-")[0][1:])
+        vector = topic_vectors[t] + args.key_signal * key_vectors[key]
+        vector += rng.normal(scale=args.noise, size=args.dimension)
+        if rng.random() < args.paraphrased:
+            text = f"Where do I change that setting for {' '.join(topic_words[t][:2])}?"
+        else:
+            text = f"How do I configure {key} in my .gitpod.yml for {' '.join(topic_words[t][:2])}?"
+        queries.append((text, vector / np.linalg.norm(vector), defines[key]))
+    return chunks, vectors, queries
+
+
+def page(match: dict) -> str:
+    return match['id'].rsplit("-", 1)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--topics", type=int, default=30)
+    parser.add_argument("--pages", type=int, default=40, help="pages per topic")
+    parser.add_argument("--keys-per-topic", type=int, default=6)
+    parser.add_argument("--words", type=int, default=120, help="words per page")
+    parser.add_argument("--duplicates", type=float, default=0.3, help="share of pages chunked twice")
+    parser.add_argument("--dimension", type=int, default=64)
+    parser.add_argument("--noise", type=float, default=0.4)
+    parser.add_argument("--key-signal", type=float, default=0.2, help="weight of the key in page embeddings")
+    parser.add_argument("--paraphrased", type=float, default=0.3, help="share of questions without the key name")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(667)
+    chunks, vectors, queries = corpus(args, rng)
+    store = FakeStore(0)
+    store.upsert([(c['id'], v.tolist(), {'text': c['text'], 'chunk': c['chunk'], 'url': c['url']})
+                  for c, v in zip(chunks, vectors)])
+    with tempfile.TemporaryDirectory() as tmp:
+        lexical = LexicalIndex(f"{tmp}/lexical.sqlite3")
+        started = time.perf_counter()
+        lexical.add(chunks)
+        print(f"{len(chunks)} chunks indexed in {time.perf_counter() - started:.2f}s, "
+              f"{len(queries)} questions\n")
+
+        def dense(text, vector):
+            return store.query(vector, top_k=CANDIDATES)['matches']
+
+        def keyword(text, vector):
+            return lexical.search(text, CANDIDATES)
+
+        def fused(text, vector):
+            return reciprocal_rank_fusion([dense(text, vector), keyword(text, vector)])[:CANDIDATES]
+
+        def fused_mmr(text, vector):
+            candidates = fused(text, vector)
+            similarity = tfidf_similarity([m['metadata']['text'] for m in candidates])
+            return [candidates[i] for i in mmr(np.array([m['score'] for m in candidates]), similarity, args.top_k)]
+
+        print(f"{'':>10} {'hit rate':>9} {'recall@' + str(args.top_k):>9} {'distinct':>9} "
+              f"{'tokens/hit':>11} {'ms':>7}")
+        for name, method in [("dense", dense), ("bm25", keyword), ("rrf", fused), ("rrf+mmr", fused_mmr)]:
+            hits, recalls, distinct, tokens, relevant_chunks, secs = [], [], [], 0, 0, 0.0
+            for text, vector, relevant in queries:
+                began = time.perf_counter()
+                matches = method(text, vector)[:args.top_k]
+                secs += time.perf_counter() - began
+                found = {page(m) for m in matches} & relevant
+                hits.append(bool(found))
+                recalls.append(len(found) / len(relevant))
+                distinct.append(len({page(m) for m in matches}))
+                tokens += sum(tiktoken_len(m['metadata']['text']) for m in matches)
+                relevant_chunks += sum(page(m) in relevant for m in matches)
+            print(f"{name:>10} {np.mean(hits):>9.3f} {np.mean(recalls):>9.3f} {np.mean(distinct):>9.2f} "
+                  f"{tokens / max(relevant_chunks, 1):>11.0f} {secs / len(queries) * 1000:>7.2f}")
+        lexical.close()
+
+
+if __name__ == "__main__":
+    main()
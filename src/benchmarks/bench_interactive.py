@@ -0,0 +1,137 @@
+"""Benchmark input to first paint of the interactive playground.
+
+Drives `interactive-playground.py` headless with a Textual pilot against the
+fake OpenAI endpoint: types a prompt, presses enter and waits for the first
+answer token to be on screen, then for the full answer. While the answer
+is on its way it presses a key and times how long the app takes to handle it.
+The same runs against the old handler, which called the blocking
+`chat_completion` inside the event handler with no history, so nothing
+painted and no key was handled until the whole answer was back.
+
+    $ python3 -m benchmarks.bench_interactive --turns 5 --first-token-latency 0.6
+"""
+from benchmarks.scratch import use_scratch_env
+
+# the rate limiter and the session store read their paths when imported
+SCRATCH = use_scratch_env("bench_interactive-")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import importlib.util  # noqa: E402
+import shutil  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+
+from benchmarks.fakes import openai_app, serve_in_thread  # noqa: E402
+from ratelimit import chat_completion  # noqa: E402
+
+KEY_DELAY = 0.05
+SCRIPT = Path(__file__).resolve().parents[2] / "interactive-playground.py"
+
+
+def load_playground():
+    spec = importlib.util.spec_from_file_location("interactive_playground", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Textual finds the CSS next to the module of the app class
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def blocking_app(playground):
+    class BlockingApp(playground.GPTApp):
+        """The old handler: one blocking completion per prompt, written when it is done"""
+        CSS_PATH = str(SCRIPT.parent / playground.GPTApp.CSS_PATH)
+
+        def submit(self) -> None:
+            prompt = self.query_one(playground.Input).value
+            response = chat_completion(model="gpt-4", messages=[{"role": "user", "content": prompt}])
+            self.query_one(playground.RichLog).write(response["choices"][0]["message"]["content"])
+            self.query_one("#status", playground.Static).update("done")
+
+    return BlockingApp()
+
+
+async def wait_for(condition, poll: float = 0.002) -> None:
+    while not condition():
+        await asyncio.sleep(poll)
+
+
+async def run_turns(app, turns: int) -> list:
+    """(first paint, full answer, key lag) in seconds for every turn"""
+    rows, paints = [], []
+    display = app._display
+
+    def record_paint(screen, renderable) -> None:
+        # headless apps still compose every screen update, they just do not write it out
+        display(screen, renderable)
+        paints.append(time.perf_counter())
+
+    app._display = record_paint
+    async with app.run_test() as pilot:
+        status, answer = app.query_one("#status"), app.query_one("#answer")
+
+        def answered() -> bool:
+            return str(status.renderable).startswith(("first token", "done"))
+
+        for turn in range(turns):
+            app.query_one("Input").value = f"How do I open port {3000 + turn} in my .gitpod.yml?"
+            await pilot.pause()
+            began = time.perf_counter()
+            enter = asyncio.create_task(pilot.press("enter"))
+            # a key pressed shortly after, while the answer is on its way
+            await asyncio.sleep(KEY_DELAY)
+            await pilot.press("d")
+            key_lag = time.perf_counter() - began - KEY_DELAY
+            # painted with the first screen update after the first token is in a widget
+            await wait_for(lambda: str(answer.renderable) or answered())
+            arrived = time.perf_counter()
+            await wait_for(lambda: paints[-1] >= arrived)
+            first_paint = paints[-1] - began
+            await wait_for(answered)
+            full = time.perf_counter() - began
+            await enter
+            rows.append((first_paint, full, key_lag))
+            status.update("")
+    return rows
+
+
+def ms(samples, pct: float) -> float:
+    return float(np.percentile(samples, pct)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--first-token-latency", type=float, default=0.6)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    try:
+        # the blocking handler stalls the app's loop, the fake API gets its own thread
+        fake = openai_app(0.01, 8, first_token_latency=args.first_token_latency,
+                          token_interval=args.token_interval, answer_tokens=args.answer_tokens)
+        openai.api_base = f"{serve_in_thread(fake)}/v1"
+        playground = load_playground()
+
+        print(f"{args.turns} turns, first token after {args.first_token_latency}s, "
+              f"{args.answer_tokens} tokens every {args.token_interval * 1000:.0f}ms\n")
+        print(f"{'':>10} {'paint p50':>10} {'paint p95':>10} {'answer p50':>11} {'key lag p50':>12} "
+              f"{'key lag max':>12}")
+        for name, make in [("blocking", lambda: blocking_app(playground)), ("worker", playground.GPTApp)]:
+            rows = asyncio.run(run_turns(make(), args.turns))
+            paint, full, lag = zip(*rows)
+            print(f"{name:>10} {ms(paint, 50):>8.0f}ms {ms(paint, 95):>8.0f}ms {ms(full, 50):>9.0f}ms "
+                  f"{ms(lag, 50):>10.0f}ms {max(lag) * 1000:>10.0f}ms")
+        print(f"\nchat requests served: {fake['chat_requests']}")
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Benchmark parse and chunk throughput against process pool size.
+
+Writes a set of docs-sized HTML pages to a temp directory and runs the same
+work as the `parse_and_chunk_file` activity through a `ProcessPoolExecutor` of
+each size, reporting activities per second.
+
+    $ python3 -m benchmarks.bench_parse_pool --pages 64 --pool-sizes 1 2 4 8
+"""
+import argparse
+import html
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from benchmarks.bench_chunker import make_document
+
+
+def write_pages(directory: Path, count: int, paragraphs: int) -> list:
+    paths = []
+    for i in range(count):
+        body = "".join(f"<p>{html.escape(p)}</p>\n" for p in make_document(paragraphs, seed=i).split("\n\n"))
+        path = directory / f"page-{i}.html"
+        path.write_text(f"<html><head><title>page {i}</title></head><body>{body}</body></html>")
+        paths.append(str(path))
+    return paths
+
+
+def run_one(path: str) -> int:
+    # imported here so the parent never loads langchain before spawning
+    import tasks
+    plan = tasks.chunk_file_contents(tasks.read_file(path, f"https://bench.local/{Path(path).name}"))
+    return len(plan['pending_ids'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=64)
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--pool-sizes", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["INGEST_MANIFEST_DIR"] = str(Path(tmp) / "manifests")
+        paths = write_pages(Path(tmp), args.pages, args.paragraphs)
+        print(f"{'pool size':>9} {'seconds':>8} {'activities/s':>13} {'speedup':>8}")
+        baseline = None
+        for size in args.pool_sizes:
+            with ProcessPoolExecutor(size, mp_context=multiprocessing.get_context("spawn")) as pool:
+                # warm every process up so import time is not measured
+                list(pool.map(run_one, paths[:size]))
+                started = time.perf_counter()
+                chunks = sum(pool.map(run_one, paths))
+                elapsed = time.perf_counter() - started
+            rate = args.pages / elapsed
+            baseline = baseline or rate
+            print(f"{size:>9} {elapsed:>8.2f} {rate:>13.1f} {rate / baseline:>7.1f}x  ({chunks} chunks)")
+
+
+if __name__ == "__main__":
+    main()
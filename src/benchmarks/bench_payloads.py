@@ -0,0 +1,118 @@
+"""Measure Temporal payload bytes per FileProcessing workflow.
+
+Encodes the arguments and results one FileProcessing run records in its
+history, with the default JSON converter and with the msgpack + lz4 converter
+in codec.py. The "reference" rows are what the activities exchange today, file
+paths on the sticky worker. The "inline" rows pass the chunk plan, and then
+the embeddings, through the workflow instead, which is what the reference
+passing convention avoids. Also reports a CrawlWorkflow continue-as-new input.
+
+    $ python3 -m benchmarks.bench_payloads --paragraphs 400
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from temporalio.converter import DataConverter
+
+from benchmarks.bench_chunker import make_document
+from chunker import iter_chunks
+from codec import CompactPayloadConverter, data_converter
+from manifest import chunk_id
+from workflows import ChunkedObj, CrawlParams, DownloadedObj, DownloadObj, FileResult, ProcessedObj, StageTiming
+
+URL = "https://www.gitpod.io/docs/introduction/getting-started"
+QUEUE = "activity_sticky_queue-host-5e4b6b0e-6d3c-4d3a-9e53-2d1f8c7f6a10"
+PATH = f"demo_fs/{QUEUE}/0b8f1f6e-1c1a-4c57-9a43-3f0b5e2d9c77"
+
+
+def history_values(chunks, embeds=None):
+    """Every payload a FileProcessing run writes to history, in order"""
+    summary = f"Processed {len(chunks)} documents to the vector store, deleted 0"
+    processed = ProcessedObj(summary=summary, chunks=len(chunks), stages={
+        "embed": StageTiming(secs=0.8, tokens=len(chunks) * 180, batches=1, items=len(chunks)),
+        "upsert": StageTiming(secs=0.05, batches=1, items=len(chunks)),
+    })
+    stages = {"download": StageTiming(secs=0.2, bytes=82294), **processed.stages}
+    downloaded = DownloadedObj(url=URL, path=PATH, etag='"5f3c-2a1b"',
+                               last_modified="Tue, 02 May 2023 10:00:00 GMT",
+                               stages={"download": stages["download"]})
+    values = [
+        URL, URL, QUEUE,
+        DownloadObj(url=URL, unique_worker_id=QUEUE, workflow_uuid=PATH.rsplit("/", 1)[1]),
+        downloaded, downloaded,
+    ]
+    if embeds is None:
+        chunked = ChunkedObj(url=URL, chunks_path=PATH + ".chunks.json", pending=len(chunks), stale=0,
+                             etag=downloaded.etag, last_modified=downloaded.last_modified)
+        values += [chunked, chunked]
+    else:
+        plan = {"pages": {URL: chunks}, "pending_ids": [c['id'] for c in chunks], "stale_ids": []}
+        values += [plan, plan]
+        if len(embeds):
+            values += [[(c['id'], e, {'text': c['text'], 'chunk': c['chunk'], 'url': c['url']})
+                        for c, e in zip(chunks, embeds)]]
+    result = FileResult(url=URL, summary=summary, chunks=len(chunks), stages=stages, wall_secs=1.2)
+    return values + [processed, PATH, None, result]
+
+
+async def encoded_bytes(converter: DataConverter, values) -> int:
+    payloads = converter.payload_converter.to_payloads(values)
+    if converter.payload_codec:
+        payloads = await converter.payload_codec.encode(payloads)
+    return sum(payload.ByteSize() for payload in payloads)
+
+
+async def run(args):
+    converters = {
+        "json": DataConverter.default,
+        "msgpack": DataConverter(payload_converter_class=CompactPayloadConverter),
+        "msgpack+lz4": data_converter,
+    }
+    text = make_document(args.paragraphs)
+    chunks = [{'id': chunk_id(URL, i, t), 'text': t, 'chunk': i, 'url': URL}
+              for i, t in enumerate(iter_chunks(text))]
+    embeds = np.random.default_rng(667).normal(size=(len(chunks), args.dimension)).astype(np.float32).tolist()
+    crawl = CrawlParams(urls=[f"{URL}/{i}" for i in range(args.crawl_urls)], offset=args.crawl_urls,
+                        processed=args.crawl_urls,
+                        stages={name: StageTiming(secs=12.5, items=6000) for name in ["download", "embed"]})
+    cases = {
+        "reference": history_values(chunks),
+        "inline chunks": history_values(chunks, []),
+        "inline vectors": history_values(chunks, embeds),
+        f"crawl input x{args.crawl_urls}": [crawl],
+    }
+
+    print(f"{len(text)} byte page, {len(chunks)} chunks\n")
+    print(f"{'bytes per workflow':>22}" + "".join(f"{name:>14}" for name in converters))
+    for case, values in cases.items():
+        sizes = [await encoded_bytes(converter, values) for converter in converters.values()]
+        print(f"{case:>22}" + "".join(f"{size:>14,}" for size in sizes))
+
+    print(f"\n{'encode+decode ms':>22}" + "".join(f"{name:>14}" for name in converters))
+    for case in ["reference", "inline chunks"]:
+        timings = []
+        for converter in converters.values():
+            began = time.perf_counter()
+            for _ in range(args.repeat):
+                payloads = converter.payload_converter.to_payloads(cases[case])
+                if converter.payload_codec:
+                    payloads = await converter.payload_codec.encode(payloads)
+                    payloads = await converter.payload_codec.decode(payloads)
+                converter.payload_converter.from_payloads(payloads)
+            timings.append((time.perf_counter() - began) / args.repeat * 1000)
+        print(f"{case:>22}" + "".join(f"{t:>14.3f}" for t in timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--crawl-urls", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
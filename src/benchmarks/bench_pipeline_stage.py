@@ -0,0 +1,88 @@
+"""Benchmark the embed -> upsert stage against local fake servers.
+
+Runs the old serial loop (batches of 100, embed then upsert) and the pipelined
+stage in `pipeline.py` over the same chunks and prints per-stage throughput.
+
+    $ python3 -m benchmarks.bench_pipeline_stage --chunks 2000
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import openai
+
+from benchmarks.fakes import openai_app, serve, vector_store_app
+from benchmarks.bench_chunker import make_document
+from chunker import iter_chunks
+from embedding_cache import EmbeddingCache, aembed_texts
+from pipeline import EMBED_BATCH_TOKENS, EMBED_MAX_IN_FLIGHT, embed_and_upsert, to_vectors
+
+
+def make_chunks(count: int) -> list:
+    chunks = []
+    paragraphs = 50
+    while len(chunks) < count:
+        text = make_document(paragraphs, seed=len(chunks))
+        chunks.extend({'id': f"{len(chunks)}-{i}", 'text': t, 'chunk': i, 'url': 'bench'}
+                      for i, t in enumerate(iter_chunks(text)))
+    return chunks[:count]
+
+
+async def main(args):
+    openai_runner, openai_url = await serve(openai_app(args.embed_latency, args.dimension))
+    store_runner, store_url = await serve(vector_store_app(args.upsert_latency))
+    openai.api_base = f"{openai_url}/v1"
+    openai.api_key = "sk-bench"
+    chunks = make_chunks(args.chunks)
+
+    async with aiohttp.ClientSession() as session:
+        async def upsert(vectors):
+            body = {"vectors": [{"id": i, "values": v, "metadata": m} for i, v, m in vectors]}
+            async with session.post(f"{store_url}/vectors/upsert", json=body) as resp:
+                resp.raise_for_status()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = EmbeddingCache(Path(tmp) / "serial.sqlite3")
+            started = time.perf_counter()
+            embed_secs = upsert_secs = 0.0
+            for i in range(0, len(chunks), 100):
+                batch = chunks[i:i + 100]
+                began = time.perf_counter()
+                embeds = await aembed_texts([x['text'] for x in batch], cache=cache)
+                embed_secs += time.perf_counter() - began
+                began = time.perf_counter()
+                await upsert(to_vectors(batch, embeds))
+                upsert_secs += time.perf_counter() - began
+            serial = time.perf_counter() - started
+            print(f"serial     {serial:7.2f}s  {len(chunks) / serial:8.1f} chunks/s  "
+                  f"embed {embed_secs:6.2f}s  upsert {upsert_secs:6.2f}s")
+
+            cache = EmbeddingCache(Path(tmp) / "pipelined.sqlite3")
+            stats = await embed_and_upsert(
+                chunks,
+                lambda texts, token_counts: aembed_texts(texts, cache=cache, token_counts=token_counts),
+                upsert,
+                max_tokens=args.batch_tokens,
+                max_in_flight=args.in_flight,
+            )
+            print(f"pipelined  {stats.wall_secs:7.2f}s  {stats.chunks_per_sec:8.1f} chunks/s  "
+                  f"embed {stats.embed_secs:6.2f}s  upsert {stats.upsert_secs:6.2f}s  "
+                  f"({stats.batches} batches, {serial / stats.wall_secs:.1f}x)")
+
+    await openai_runner.cleanup()
+    await store_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--embed-latency", type=float, default=0.3)
+    parser.add_argument("--upsert-latency", type=float, default=0.15)
+    parser.add_argument("--batch-tokens", type=int, default=EMBED_BATCH_TOKENS)
+    parser.add_argument("--in-flight", type=int, default=EMBED_MAX_IN_FLIGHT)
+    # the fakes share this process, so big vectors make the run JSON bound
+    parser.add_argument("--dimension", type=int, default=128)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,101 @@
+"""Benchmark perceived answer latency of the chat scripts.
+
+Runs a multi-turn conversation against the fake OpenAI endpoint, which
+answers after a first-token delay and then one token per interval, with
+retrieval from an in-memory store with remote-like latency. Compares the
+old loop, which retrieves, then waits for the whole completion before
+printing anything, with `QueryEngine`, which overlaps retrieval with history
+preparation and streams the answer. The user waits for the full answer in
+the first case and for the first token in the second.
+
+    $ python3 -m benchmarks.bench_query_engine --turns 10 --answer-tokens 300
+"""
+from benchmarks.scratch import use_scratch_env
+
+# the embedding and retrieval caches read their paths when imported
+SCRATCH = use_scratch_env("bench_query_engine-")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import shutil  # noqa: E402
+import time  # noqa: E402
+
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+
+from benchmarks.fakes import FakeStore, fake_embedding, openai_app, serve_in_thread  # noqa: E402
+from conversation import augment  # noqa: E402
+from query_engine import QueryEngine  # noqa: E402
+from ratelimit import chat_completion  # noqa: E402
+from retrieval_cache import retrieve  # noqa: E402
+
+SYSTEM_PROMPT = "You are Q&A bot. A highly intelligent system that answers user questions."
+
+
+def blocking_turns(questions, store) -> list:
+    """The old loop: retrieve, complete, then print the whole answer"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    waits = []
+    for question in questions:
+        began = time.perf_counter()
+        res = retrieve(question, store, top_k=5)
+        prompt = augment(question, [match['metadata']['text'] for match in res['matches']])
+        messages.append({"role": "user", "content": prompt})
+        response = chat_completion(model="gpt-4", messages=messages)
+        messages.append({"role": "assistant", "content": response["choices"][0]["message"]["content"]})
+        waits.append(time.perf_counter() - began)
+    return waits
+
+
+async def streaming_turns(questions, store) -> list:
+    engine = QueryEngine(SYSTEM_PROMPT, store=store)
+    return [(await engine.ask(question)).timing for question in questions]
+
+
+def ms(samples, pct: float) -> float:
+    return float(np.percentile(samples, pct)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.15)
+    parser.add_argument("--query-latency", type=float, default=0.08)
+    parser.add_argument("--first-token-latency", type=float, default=0.6)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    try:
+        # the old loop blocks, the fake API gets its own thread
+        fake = openai_app(args.embed_latency, args.dimension, first_token_latency=args.first_token_latency,
+                          token_interval=args.token_interval, answer_tokens=args.answer_tokens)
+        openai.api_base = f"{serve_in_thread(fake)}/v1"
+        store = FakeStore(0)
+        store.upsert([(f"chunk-{i}", fake_embedding(f"chunk {i}", args.dimension),
+                       {'text': f"paragraph {i} " * 40, 'chunk': i, 'url': f"https://example.com/{i // 10}"})
+                      for i in range(args.chunks)])
+        store.latency = args.query_latency
+
+        # distinct questions per run, so every turn retrieves
+        blocking = blocking_turns([f"blocking question {i}" for i in range(args.turns)], store)
+        timings = asyncio.run(streaming_turns([f"streaming question {i}" for i in range(args.turns)], store))
+
+        print(f"{args.turns} turns, {args.answer_tokens} token answers\n")
+        print(f"{'':>26} {'p50 ms':>9} {'p99 ms':>9}")
+        print(f"{'blocking, full answer':>26} {ms(blocking, 50):>9.0f} {ms(blocking, 99):>9.0f}")
+        for name, samples in [
+            ("streaming, first token", [t.first_token_secs for t in timings]),
+            ("streaming, full answer", [t.total_secs for t in timings]),
+            ("retrieval", [t.retrieval_secs for t in timings]),
+            ("history preparation", [t.history_secs for t in timings]),
+        ]:
+            print(f"{name:>26} {ms(samples, 50):>9.0f} {ms(samples, 99):>9.0f}")
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
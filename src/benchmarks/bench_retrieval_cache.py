@@ -0,0 +1,104 @@
+"""Benchmark the retrieval cache the ask scripts use.
+
+Asks a stream of support questions, where a few common ones come back again
+and again with different casing and spacing, against the fake OpenAI
+endpoint and an in-memory store with remote-like query latency. Compares the
+old path (cached embedding of the exact text, then a store query) with
+`retrieval_cache.retrieve`, and the first asks after an ingest invalidates
+the cache.
+
+    $ python3 -m benchmarks.bench_retrieval_cache --asks 500 --query-latency 0.08
+"""
+from benchmarks.scratch import use_scratch_env
+
+# the embedding cache reads its path when imported
+SCRATCH = use_scratch_env("bench_retrieval_cache-")
+
+import os  # noqa: E402
+import argparse  # noqa: E402
+import shutil  # noqa: E402
+import time  # noqa: E402
+
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+
+from benchmarks.fakes import FakeStore, fake_embedding, openai_app, serve_in_thread  # noqa: E402
+from embedding_cache import embed_texts  # noqa: E402
+from retrieval_cache import RetrievalCache, retrieve  # noqa: E402
+
+
+def variant(question: str, rng: np.random.Generator) -> str:
+    """The same question as somebody else would type it"""
+    words = question.split()
+    if rng.random() < 0.5:
+        words[0] = words[0].lower()
+    if rng.random() < 0.3:
+        words = [word.upper() if rng.random() < 0.2 else word for word in words]
+    return (" " if rng.random() < 0.7 else "  ").join(words) + ("" if rng.random() < 0.5 else " ")
+
+
+def summary(name: str, latencies, embeds: int, queries: int) -> str:
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return f"{name:>18} {p50:>9.2f} {p99:>9.2f} {embeds:>12} {queries:>13}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--asks", type=int, default=300)
+    parser.add_argument("--questions", type=int, default=200, help="distinct questions")
+    parser.add_argument("--common", type=int, default=20, help="questions that make up most asks")
+    parser.add_argument("--repeat-share", type=float, default=0.8, help="share of asks that are common ones")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.15)
+    parser.add_argument("--query-latency", type=float, default=0.08)
+    args = parser.parse_args()
+
+    try:
+        # the ask path is synchronous, the fake API gets its own thread
+        fake = openai_app(args.embed_latency, args.dimension)
+        openai.api_base = f"{serve_in_thread(fake)}/v1"
+        store = FakeStore(args.query_latency)
+        store.latency = 0
+        store.upsert([(f"chunk-{i}", fake_embedding(f"chunk {i}", args.dimension),
+                       {'text': f"paragraph {i} " * 40, 'chunk': i, 'url': f"https://example.com/{i // 10}"})
+                      for i in range(args.chunks)])
+        store.latency = args.query_latency
+
+        rng = np.random.default_rng(667)
+        questions = [f"How do I configure workspace feature number {i} in Gitpod?" for i in range(args.questions)]
+        picks = np.where(rng.random(args.asks) < args.repeat_share,
+                         rng.integers(0, args.common, args.asks),
+                         rng.integers(0, args.questions, args.asks))
+        asks = [variant(questions[i], rng) for i in picks]
+
+        print(f"{len(asks)} asks, {len(set(picks))} distinct questions\n")
+        print(f"{'':>18} {'p50 ms':>9} {'p99 ms':>9} {'embed calls':>12} {'store queries':>13}")
+
+        def run(name, ask):
+            requests, queries = fake["requests"], store.queries
+            latencies = []
+            for question in asks:
+                began = time.perf_counter()
+                ask(question)
+                latencies.append(time.perf_counter() - began)
+            print(summary(name, latencies, fake["requests"] - requests, store.queries - queries))
+            return latencies
+
+        run("uncached", lambda q: store.query(embed_texts([q])[0], top_k=5, include_metadata=True))
+
+        cache = RetrievalCache(os.path.join(SCRATCH, "retrieval.sqlite3"))
+        run("retrieval cache", lambda q: retrieve(q, store, top_k=5, cache=cache))
+        latencies = run("warm", lambda q: retrieve(q, store, top_k=5, cache=cache))
+        repeats = [latency for latency, i in zip(latencies, picks) if i < args.common]
+        print(f"\nwarm repeats of common questions: p50 {np.percentile(repeats, 50) * 1000:.2f} ms")
+
+        cache.invalidate()
+        run("after invalidate", lambda q: retrieve(q, store, top_k=5, cache=cache))
+        print(f"\ncache: {cache.stats()}")
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
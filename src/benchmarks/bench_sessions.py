@@ -0,0 +1,98 @@
+"""Benchmark per-message write cost of the chat session store.
+
+Appends a long synthetic session one message at a time and reports the
+write latency at several session lengths. The old scripts kept the
+conversation in memory and wrote all of chatlog.csv at the end. Saving after
+every message that way means rewriting the whole file each time, so its
+cost grows with the session. `SessionStore.append` inserts a row and its
+full-text entry, and should cost the same at message 10 and at message
+10,000. Also reports full-text search latency for a word and a topic over
+every message, and the time to resume the session from its newest turns.
+
+    $ python3 -m benchmarks.bench_sessions --messages 10000
+"""
+import argparse
+import csv
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.bench_conversation import GIT_WORDS
+from conversation import CONTEXT_TOKENS, message_tokens
+from sessions import SessionStore
+
+TOPICS = 1000
+
+
+def message(rng: random.Random, role: str) -> dict:
+    words = [rng.choice(GIT_WORDS) for _ in range(rng.randint(10, 30) if role == "user" else rng.randint(100, 300))]
+    # and what the turn is about, a few of 1000 topics
+    words += [f"topic{rng.randrange(TOPICS)}" for _ in range(3)]
+    rng.shuffle(words)
+    return {'role': role, 'content': " ".join(words)}
+
+
+def rewrite_csv(path: Path, messages) -> None:
+    """The old chatlog.csv dump, done after every message"""
+    with open(path, 'w') as csvfile:
+        writer = csv.DictWriter(csvfile, ["role", "content"])
+        writer.writeheader()
+        for row in messages:
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--csv-up-to", type=int, default=1000,
+                        help="stop the whole file rewrite after this many messages, it gets slow")
+    parser.add_argument("--searches", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(667)
+    checkpoints = sorted({n for n in (10, 100, 1000, 10000, 100000) if n <= args.messages} | {args.messages})
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SessionStore(Path(tmp) / "sessions.sqlite3")
+        session = store.start("You are Q&A bot.")
+        messages = [{'role': "system", 'content': session.system_prompt}]
+        store_secs, csv_secs = [], []
+        for n in range(1, args.messages + 1):
+            row = message(rng, "user" if n % 2 else "assistant")
+            messages.append(row)
+            started = time.perf_counter()
+            session.append(row['role'], row['content'])
+            store_secs.append(time.perf_counter() - started)
+            if n <= args.csv_up_to:
+                started = time.perf_counter()
+                rewrite_csv(Path(tmp) / "chatlog.csv", messages)
+                csv_secs.append(time.perf_counter() - started)
+
+        print(f"{'messages':>9} {'csv rewrite':>12} {'store p50':>10} {'store p99':>10}")
+        for n in checkpoints:
+            # the 10 writes leading up to the checkpoint
+            window = slice(max(n - 10, 0), n)
+            rewrite = f"{np.median(csv_secs[window]) * 1e6:>10.0f}us" if n <= len(csv_secs) else f"{'-':>12}"
+            print(f"{n:>9} {rewrite} {np.percentile(store_secs[window], 50) * 1e6:>8.0f}us "
+                  f"{np.percentile(store_secs[window], 99) * 1e6:>8.0f}us")
+
+        queries = [f"{rng.choice(GIT_WORDS)} topic{rng.randrange(TOPICS)}" for _ in range(args.searches)]
+        started = time.perf_counter()
+        for query in queries:
+            store.search(query)
+        search_ms = (time.perf_counter() - started) / len(queries) * 1000
+        message_tokens("")  # loads the tokenizer
+        started = time.perf_counter()
+        resumed = store.resume(session.id)
+        turns = resumed.recent_turns(CONTEXT_TOKENS)
+        resume_ms = (time.perf_counter() - started) * 1000
+        print(f"\nsearch over {args.messages:,} messages: {search_ms:.2f} ms per query")
+        print(f"resume: {len(turns)} newest turns in the {CONTEXT_TOKENS} token budget read in {resume_ms:.1f} ms")
+        print(f"database size: {sum(f.stat().st_size for f in Path(tmp).glob('sessions.sqlite3*')) / 1e6:.1f} MB")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
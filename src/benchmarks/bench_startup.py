@@ -0,0 +1,162 @@
+"""Benchmark cold start of the worker and the ask script.
+
+Reports, for fresh interpreters:
+
+- import time of each entry point module, with its heaviest direct imports,
+  from `python -X importtime`
+- time from starting `worker.py` to its first poll of the distribution
+  queue, seen through the server's DescribeTaskQueue, on a Temporal dev server
+  started through `WorkflowEnvironment` (or `--server`)
+- time from starting `ask-embeddings.py` to its question prompt
+
+The worker opens a local vector store and the ask script never gets an
+answer, so neither needs OpenAI or Pinecone.
+
+    $ python3 -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import asyncio
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from temporalio.api.enums.v1 import TaskQueueType
+from temporalio.api.taskqueue.v1 import TaskQueue
+from temporalio.api.workflowservice.v1 import DescribeTaskQueueRequest
+from temporalio.client import Client
+from temporalio.testing import WorkflowEnvironment
+
+from benchmarks.scratch import scratch_env
+
+SRC = Path(__file__).resolve().parents[1]
+ROOT = SRC.parent
+MODULES = ["workflows", "starter", "tasks", "worker", "hybrid", "query_engine"]
+# child processes import from src/ and keep their vectors on disk
+CHILD_ENV = {"VECTOR_STORE": "local", "PYTHONPATH": str(SRC)}
+
+
+def import_times(module: str, env: Dict[str, str]) -> Tuple[float, List[Tuple[str, float]]]:
+    """Seconds to import `module`, and its direct imports by cumulative seconds"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         env=env, cwd=SRC, capture_output=True, text=True, check=True).stderr
+    # a module's imports are listed before it, one level deeper
+    total, children, pending = 0.0, [], []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            pending.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == module:
+                total, children = int(cumulative) / 1e6, pending
+            pending = []
+    return total, sorted(children, key=lambda child: -child[1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def first_poll(client: Client, env: Dict[str, str], queue: str) -> float:
+    """Seconds from starting worker.py to its first poll of `queue`"""
+    request = DescribeTaskQueueRequest(
+        namespace=client.namespace, task_queue=TaskQueue(name=queue),
+        task_queue_type=TaskQueueType.TASK_QUEUE_TYPE_WORKFLOW,
+    )
+    started_at = datetime.now(timezone.utc)
+    began = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "worker.py"], env=env, cwd=SRC,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"worker.py exited with code {process.returncode}")
+            res = await client.workflow_service.describe_task_queue(request)
+            if any(poller.last_access_time.ToDatetime(timezone.utc) >= started_at for poller in res.pollers):
+                return time.perf_counter() - began
+            await asyncio.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def first_prompt(env: Dict[str, str]) -> float:
+    """Seconds from starting ask-embeddings.py to its question prompt"""
+    began = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "ask-embeddings.py"], env=env, cwd=ROOT,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        seen = b""
+        while b"Enter your question" not in seen:
+            byte = process.stdout.read(1)
+            if not byte:
+                raise RuntimeError("ask-embeddings.py exited before its prompt")
+            seen += byte
+        return time.perf_counter() - began
+    finally:
+        process.kill()
+        process.wait()
+
+
+async def worker_polls(args, tmp: str) -> List[float]:
+    if args.server:
+        env = WorkflowEnvironment.from_client(await Client.connect(args.server))
+    else:
+        env = await WorkflowEnvironment.start_local()
+    try:
+        address = env.client.service_client.config.target_host
+        samples = []
+        for _ in range(args.runs):
+            child_env = scratch_env(tmp, **CHILD_ENV, TEMPORAL_ADDRESS=address, WORKER_PROCESSES="1",
+                                    METRICS_PORT=str(free_port()))
+            samples.append(await first_poll(env.client, child_env, "activity_sticky_queue-distribution-queue"))
+        return samples
+    finally:
+        await env.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="heaviest imports shown per module")
+    parser.add_argument("--server", default=None, help="existing Temporal server, e.g. localhost:7233")
+    parser.add_argument("--skip-worker", action="store_true", help="no Temporal server, skip time to first poll")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = scratch_env(tmp, **CHILD_ENV)
+        print(f"{'module':>13} {'import p50':>11}   heaviest imports")
+        for module in MODULES:
+            runs = [import_times(module, env) for _ in range(args.runs)]
+            heaviest = defaultdict(list)
+            for _, children in runs:
+                for name, secs in children:
+                    heaviest[name].append(secs)
+            top = sorted(heaviest.items(), key=lambda item: -np.median(item[1]))[:args.top]
+            print(f"{module:>13} {np.median([total for total, _ in runs]) * 1000:>9.0f}ms   "
+                  + ", ".join(f"{name} {np.median(secs) * 1000:.0f}ms" for name, secs in top))
+
+        prompts = [first_prompt(env) for _ in range(args.runs)]
+        print(f"\nask-embeddings.py time to first prompt: p50 {np.median(prompts) * 1000:.0f}ms, "
+              f"max {max(prompts) * 1000:.0f}ms")
+        if not args.skip_worker:
+            polls = asyncio.run(worker_polls(args, tmp))
+            print(f"worker.py time to first poll: p50 {np.median(polls) * 1000:.0f}ms, "
+                  f"max {max(polls) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Benchmark the local vector store for each storage dtype.
+
+Reports upsert throughput, query p50/p99 latency and recall@k of the quantized
+stores against the float32 store.
+
+    $ python3 -m benchmarks.bench_vectorstore --vectors 100000
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from vectorstore import LocalStore
+
+
+def percentile_ms(samples, pct: float) -> float:
+    return float(np.percentile(samples, pct)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(667)
+    vectors = rng.normal(size=(args.vectors, args.dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # queries near existing vectors, like real questions near real chunks
+    picks = rng.integers(0, args.vectors, args.queries)
+    queries = vectors[picks] + rng.normal(scale=0.5 / np.sqrt(args.dimension), size=(args.queries, args.dimension))
+
+    reference = None
+    print(f"{'dtype':>8} {'upsert/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'recall@' + str(args.top_k):>10}")
+    for dtype in ["float32", "float16", "int8"]:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = LocalStore(tmp, dtype, index="flat")
+            started = time.perf_counter()
+            for start in range(0, args.vectors, 1000):
+                store.upsert([(str(i), vectors[i], {'chunk': i})
+                              for i in range(start, min(start + 1000, args.vectors))])
+            upsert_rate = args.vectors / (time.perf_counter() - started)
+
+            latencies, results = [], []
+            for query in queries:
+                began = time.perf_counter()
+                res = store.query(query, top_k=args.top_k, include_metadata=False)
+                latencies.append(time.perf_counter() - began)
+                results.append({m['id'] for m in res['matches']})
+            reference = reference or results
+            recall = np.mean([len(r & ref) / args.top_k for r, ref in zip(results, reference)])
+            print(f"{dtype:>8} {upsert_rate:>10.0f} {percentile_ms(latencies, 50):>8.2f} "
+                  f"{percentile_ms(latencies, 99):>8.2f} {recall:>10.3f}")
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
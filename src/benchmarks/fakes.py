@@ -0,0 +1,206 @@
+"""Local stand-ins for the OpenAI embeddings API and the vector index.
+
+The API and the remote index are small aiohttp apps with configurable latency,
+so the pipeline can be benchmarked offline. `FakeStore` is an in-process
+`VectorStore` with the same kind of latency, for benchmarks that go through
+resources.py.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from aiohttp import web
+
+from vectorstore import Vector, VectorStore
+
+
+def fake_embedding(text: str, dimension: int) -> list:
+    rng = random.Random(text)
+    return [rng.uniform(-1, 1) for _ in range(dimension)]
+
+
+def openai_app(latency: float = 0.2, dimension: int = 1536,
+               requests_per_minute: Optional[int] = None, first_token_latency: float = 0.5,
+               token_interval: float = 0.02, answer_tokens: int = 200) -> web.Application:
+    """Serves POST /v1/embeddings and /v1/chat/completions like the OpenAI API
+
+    With `requests_per_minute` set, embedding requests over the limit get a
+    429 with a Retry-After header, the way the real API throttles. Chat
+    answers are `answer_tokens` words, the first after `first_token_latency`
+    and the rest every `token_interval`, streamed as server-sent events when
+    the request asks for `stream`.
+    """
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["requests"] = 0
+    app["inputs"] = 0
+    app["rate_limited"] = 0
+    app["chat_requests"] = 0
+    # sliding one second window
+    window = []
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if requests_per_minute:
+            now = time.monotonic()
+            while window and window[0] <= now - 1:
+                window.pop(0)
+            if len(window) >= max(requests_per_minute / 60, 1):
+                app["rate_limited"] += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status=429, headers={"Retry-After": f"{window[0] + 1 - now:.3f}"},
+                )
+            window.append(now)
+        app["requests"] += 1
+        app["inputs"] += len(inputs)
+        await asyncio.sleep(latency)
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model") or body.get("engine"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimension)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        app["chat_requests"] += 1
+        words = [f"word{i} " for i in range(answer_tokens)]
+        await asyncio.sleep(first_token_latency)
+        if not body.get("stream"):
+            await asyncio.sleep(token_interval * (answer_tokens - 1))
+            return web.json_response({
+                "object": "chat.completion",
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": answer_tokens, "total_tokens": 0},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(token_interval)
+            chunk = {"object": "chat.completion.chunk", "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_post("/v1/engines/{engine}/embeddings", embeddings)
+    app.router.add_post("/v1/chat/completions", chat)
+    return app
+
+
+def vector_store_app(latency: float = 0.1) -> web.Application:
+    """Serves POST /vectors/upsert and /vectors/delete like a Pinecone index"""
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app["vectors"] = {}
+
+    async def upsert(request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        for vector in body["vectors"]:
+            app["vectors"][vector["id"]] = vector
+        return web.json_response({"upsertedCount": len(body["vectors"])})
+
+    async def delete(request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        for vector_id in body["ids"]:
+            app["vectors"].pop(vector_id, None)
+        return web.json_response({})
+
+    app.router.add_post("/vectors/upsert", upsert)
+    app.router.add_post("/vectors/delete", delete)
+    return app
+
+
+def docs_site_app(pages: int, paragraphs: int = 100) -> web.Application:
+    """Serves GET /docs/{n} as fixture HTML pages, each with different text"""
+    from benchmarks.bench_chunker import make_document
+
+    app = web.Application()
+    bodies = {}
+
+    async def page(request: web.Request) -> web.Response:
+        number = int(request.match_info["n"])
+        if not 0 <= number < pages:
+            raise web.HTTPNotFound()
+        if number not in bodies:
+            text = make_document(paragraphs, seed=number)
+            bodies[number] = "<html><body>" + "".join(
+                f"<p>{block}</p>\n" for block in text.split("\n\n")
+            ) + "</body></html>"
+        return web.Response(text=bodies[number], content_type="text/html")
+
+    app.router.add_get("/docs/{n}", page)
+    return app
+
+
+class FakeStore(VectorStore):
+    """In memory vector store that sleeps like a remote index would"""
+
+    def __init__(self, latency: float = 0.1):
+        self.latency = latency
+        self.vectors = {}
+        self.upserts = 0
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: Sequence[Vector]) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.upserts += 1
+            self.vectors.update((vector_id, (values, metadata)) for vector_id, values, metadata in vectors)
+
+    def query(self, vector: Sequence[float], top_k: int = 5, include_metadata: bool = True) -> dict:
+        time.sleep(self.latency)
+        with self._lock:
+            self.queries += 1
+            items = list(self.vectors.items())
+        if not items:
+            return {'matches': []}
+        matrix = np.array([values for _, (values, _) in items], dtype=np.float32)
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        return {'matches': [{
+            'id': items[i][0],
+            'score': float(scores[i]),
+            'metadata': dict(items[i][1][1]) if include_metadata else {},
+        } for i in np.argsort(-scores)[:top_k]]}
+
+    def delete(self, ids: Sequence[str]) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            for vector_id in ids:
+                self.vectors.pop(vector_id, None)
+
+    def describe(self) -> dict:
+        return {'total_vector_count': len(self.vectors)}
+
+
+def serve_in_thread(app: web.Application) -> str:
+    """Start `app` on its own event loop thread, for benchmarks of blocking code"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    _, url = asyncio.run_coroutine_threadsafe(serve(app), loop).result()
+    return url
+
+
+async def serve(app: web.Application) -> Tuple[web.AppRunner, str]:
+    """Start `app` on a free local port, returns the runner and base URL"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
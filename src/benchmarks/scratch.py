@@ -0,0 +1,41 @@
+"""Scratch directories for the host state of benchmark and test runs.
+
+Every piece of state the pipeline keeps on the host lives at a path that its
+module reads from the environment when it is imported, so a run points them
+all at a scratch directory before it imports any of those modules. This
+module only needs the standard library for that reason.
+"""
+import os
+import tempfile
+from typing import Dict
+
+# env var and file name of every piece of host state
+STATE_PATHS = {
+    "EMBEDDING_CACHE_PATH": "embeddings.sqlite3",
+    "INGEST_MANIFEST_DIR": "manifests",
+    "DOWNLOAD_VALIDATORS_DIR": "validators",
+    "RATE_LIMIT_PATH": "ratelimit.sqlite3",
+    "LOAD_BOARD_PATH": "load_board.sqlite3",
+    "RETRIEVAL_CACHE_PATH": "retrieval.sqlite3",
+    "LEXICAL_INDEX_PATH": "lexical.sqlite3",
+    "INGEST_CHECKPOINT_PATH": "checkpoint.sqlite3",
+    "DEDUP_INDEX_PATH": "dedup.sqlite3",
+    "SESSIONS_PATH": "sessions.sqlite3",
+    "LOCAL_STORE_PATH": "vectors",
+}
+
+
+def scratch_env(directory: str, **extra: str) -> Dict[str, str]:
+    """This process's environment with every state path in `directory`, for a child process"""
+    env = dict(os.environ, **{name: os.path.join(directory, path) for name, path in STATE_PATHS.items()})
+    # the fake OpenAI endpoint takes any key
+    env.setdefault("OPENAI_API_KEY", "sk-bench")
+    env.update(extra)
+    return env
+
+
+def use_scratch_env(prefix: str) -> str:
+    """Point this process's state at a new scratch directory, and return it for cleanup"""
+    directory = tempfile.mkdtemp(prefix=prefix)
+    os.environ.update(scratch_env(directory))
+    return directory
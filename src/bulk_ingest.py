@@ -0,0 +1,318 @@
+"""Bulk ingest of a local ReadTheDocs dump, see create-embeddings.py.
+
+Files are found by walking the dump as the ingest goes, and parsed and
+chunked in a process pool a few files ahead of the embeddings. Chunks go on
+to the bounded embed and upsert stage in pipeline.py as they are ready, so
+the pool waits for the embeddings when they fall behind. Memory holds the
+files in flight, however big the dump is.
+
+A file is done once every new chunk of it is upserted, its stale chunks are
+deleted and its manifest is saved, and only then is it checkpointed, by path,
+size and mtime, in a SQLite database at INGEST_CHECKPOINT_PATH. A rerun after
+a crash or ctrl+c skips the checkpointed files without reading them and picks
+up from the first file that was not done.
+
+Near duplicates of chunks already in the index, like the navigation every
+page repeats, are linked to the existing vectors instead of embedded, see
+dedup.py. Their MinHash signatures are worked out in the pool too.
+"""
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from chunker import tiktoken_len
+from dedup import DedupIndex, get_dedup_index, minhash
+from lexical import LexicalIndex, get_lexical_index
+from manifest import save_manifest
+from pipeline import EmbedFn, PipelineStats, embed_and_upsert
+import retrieval_cache
+import tasks
+from vectorstore import VectorStore
+
+CHECKPOINT_PATH = Path(
+    os.environ.get("INGEST_CHECKPOINT_PATH", Path(__file__).parent / "demo_fs" / "bulk_ingest.sqlite3")
+)
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 1))
+# files parsed ahead of the embeddings, per parse process
+PARSE_AHEAD = int(os.environ.get("INGEST_PARSE_AHEAD", "4"))
+HTML_SUFFIXES = (".html", ".htm")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    chunks INTEGER NOT NULL,
+    done REAL NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    path: str
+    url: str
+    size: int
+    mtime_ns: int
+
+
+class Checkpoint:
+    """Files of a bulk ingest that are fully in the index, in SQLite"""
+
+    def __init__(self, path: Path = CHECKPOINT_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def is_done(self, source: SourceFile) -> bool:
+        """Whether `source` was ingested as it is now, a file changed since is not done"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns FROM files WHERE path = ?", (source.path,)
+            ).fetchone()
+        return row == (source.size, source.mtime_ns)
+
+    def mark_done(self, source: SourceFile, chunks: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, url, chunks, done) VALUES (?, ?, ?, ?, ?, ?)",
+                (source.path, source.size, source.mtime_ns, source.url, chunks, time.time()),
+            )
+
+    def done_count(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()
+        return count
+
+    def reset(self) -> None:
+        """Forget every file, the next run ingests them all again"""
+        with self._lock:
+            self._conn.execute("DELETE FROM files")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_checkpoint() -> Checkpoint:
+    """The process wide checkpoint at CHECKPOINT_PATH"""
+    return Checkpoint()
+
+
+def iter_source_files(root: Path) -> Iterator[SourceFile]:
+    """HTML files under `root` in a stable order, read a directory at a time
+
+    A dump made with `wget -r` keeps the host as the first directory, so the
+    path under `root` is the page's URL without its scheme.
+    """
+    root = Path(root).resolve()
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(HTML_SUFFIXES):
+                continue
+            path = os.path.join(directory, filename)
+            stat = os.stat(path)
+            url = "https://" + Path(path).relative_to(root).as_posix()
+            yield SourceFile(path, url, stat.st_size, stat.st_mtime_ns)
+
+
+def count_source_files(root: Path) -> int:
+    """How many files `iter_source_files` finds, without keeping them"""
+    return sum(
+        filename.endswith(HTML_SUFFIXES) for _, _, filenames in os.walk(root) for filename in filenames
+    )
+
+
+def main_text(html: str) -> str:
+    """The text of a ReadTheDocs page's main content, like langchain's ReadTheDocsLoader"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    main = soup.find("main", {"id": "main-content"}) or soup.find("div", {"role": "main"})
+    if main is None:
+        return ""
+    return "\n".join(line for line in main.get_text().split("\n") if line)
+
+
+def parse_file(path: str, url: str) -> dict:
+    """Parse and chunk one file in a pool process, a plan like `tasks.chunk_file_contents`
+
+    Token counts and the signatures of new chunks are worked out here too, so
+    batching the chunks for the embeddings API and looking for near
+    duplicates do not go over the text again in the parent.
+    """
+    with open(path, encoding="utf-8", errors="replace") as handle:
+        text = main_text(handle.read())
+    plan = tasks.chunk_file_contents([{"text": text, "source": url}])
+    pending_ids = set(plan['pending_ids'])
+    for page_chunks in plan['pages'].values():
+        for chunk in page_chunks:
+            chunk['tokens'] = tiktoken_len(chunk['text'])
+            if chunk['id'] in pending_ids:
+                chunk['minhash'] = minhash(chunk['text'])
+    return plan
+
+
+@dataclass
+class IngestStats:
+    files: int = 0
+    skipped: int = 0
+    failed: int = 0
+    chunks: int = 0
+    deleted: int = 0
+    # new chunks linked to a near duplicate instead of embedded, and their tokens
+    duplicates: int = 0
+    duplicate_tokens: int = 0
+    wall_secs: float = 0.0
+    pipeline: PipelineStats = field(default_factory=PipelineStats)
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.files / self.wall_secs if self.wall_secs else 0.0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.chunks / self.wall_secs if self.wall_secs else 0.0
+
+
+@dataclass
+class _InFlight:
+    """A parsed file whose new chunks are not all upserted yet"""
+    source: SourceFile
+    pages: Dict[str, List[dict]]
+    # vectors to delete once the file is upserted, see `DedupIndex.release`
+    stale_ids: List[str]
+    # new chunks to embed, indexed for dedup once they are all upserted
+    chunks: List[dict]
+    remaining: int
+
+
+async def ingest(
+    root: Path,
+    store: VectorStore,
+    embed_fn: EmbedFn,
+    checkpoint: Optional[Checkpoint] = None,
+    lexical_index: Optional[LexicalIndex] = None,
+    dedup_index: Optional[DedupIndex] = None,
+    workers: int = INGEST_WORKERS,
+    parse_ahead: int = PARSE_AHEAD,
+    on_progress: Optional[Callable[[IngestStats], None]] = None,
+) -> IngestStats:
+    """Ingest every HTML file under `root` that is not checkpointed yet"""
+    checkpoint = checkpoint or get_checkpoint()
+    lexical_index = lexical_index or get_lexical_index()
+    dedup_index = dedup_index or get_dedup_index()
+    stats = IngestStats()
+    started = time.perf_counter()
+    in_flight: Dict[str, _InFlight] = {}
+
+    def progress() -> None:
+        if on_progress is not None:
+            stats.wall_secs = time.perf_counter() - started
+            on_progress(stats)
+
+    def finish_file(item: _InFlight) -> int:
+        dedup_index.commit(item.chunks)
+        stale_ids = item.stale_ids
+        if stale_ids:
+            store.delete(stale_ids)
+            lexical_index.delete(stale_ids)
+        for url, page_chunks in item.pages.items():
+            save_manifest(url, page_chunks)
+        checkpoint.mark_done(item.source, sum(len(page_chunks) for page_chunks in item.pages.values()))
+        return len(stale_ids)
+
+    async def finish(item: _InFlight) -> None:
+        stats.deleted += await asyncio.to_thread(finish_file, item)
+        del in_flight[item.source.url]
+        stats.files += 1
+        progress()
+
+    async def parsed_chunks(pool: ProcessPoolExecutor) -> AsyncIterator[dict]:
+        """New chunks of every file not done yet, parsed `workers * parse_ahead` files ahead"""
+        loop = asyncio.get_running_loop()
+        sources = iter_source_files(root)
+        parsing: Dict[asyncio.Future, SourceFile] = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(parsing) < workers * parse_ahead:
+                source = next(sources, None)
+                if source is None:
+                    exhausted = True
+                elif checkpoint.is_done(source):
+                    stats.skipped += 1
+                    progress()
+                else:
+                    parsing[loop.run_in_executor(pool, parse_file, source.path, source.url)] = source
+            if not parsing:
+                return
+            done, _ = await asyncio.wait(parsing, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                source = parsing.pop(future)
+                try:
+                    plan = future.result()
+                except Exception as exc:
+                    # not checkpointed, so the next run tries it again
+                    print(f"Skipping {source.path}: {exc!r}")
+                    stats.failed += 1
+                    progress()
+                    continue
+                pending_ids = set(plan['pending_ids'])
+                chunks = [chunk for page_chunks in plan['pages'].values()
+                          for chunk in page_chunks if chunk['id'] in pending_ids]
+                # released before the new chunks are claimed, so an edited chunk is
+                # not linked to the stale one it replaces, keeping vectors other
+                # pages link to
+                stale_ids = await asyncio.to_thread(dedup_index.release, plan['stale_ids'])
+                chunks, duplicates = await asyncio.to_thread(dedup_index.claim, chunks)
+                stats.duplicates += len(duplicates)
+                stats.duplicate_tokens += sum(chunk['tokens'] for chunk in duplicates)
+                item = in_flight[source.url] = _InFlight(source, plan['pages'], stale_ids, chunks, len(chunks))
+                if not chunks:
+                    await finish(item)
+                for chunk in chunks:
+                    yield chunk
+
+    async def upsert(vectors) -> None:
+        # the store clients block, so keep them off the event loop
+        await asyncio.to_thread(store.upsert, vectors)
+        # keep the keyword index in step with the vector store, see lexical.py
+        await asyncio.to_thread(lexical_index.add, [{'id': vector_id, **metadata}
+                                                    for vector_id, _, metadata in vectors])
+        stats.chunks += len(vectors)
+        for url, count in Counter(metadata['url'] for _, _, metadata in vectors).items():
+            item = in_flight[url]
+            item.remaining -= count
+            if item.remaining == 0:
+                await finish(item)
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=tasks.init_parse_process)
+    try:
+        stats.pipeline = await embed_and_upsert(parsed_chunks(pool), embed_fn, upsert)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if stats.chunks or stats.deleted:
+            # cached answers to questions may be out of date now
+            await asyncio.to_thread(retrieval_cache.invalidate)
+    stats.wall_secs = time.perf_counter() - started
+    return stats
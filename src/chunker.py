@@ -0,0 +1,129 @@
+"""Token-aware text chunking.
+
+Each document is encoded with tiktoken exactly once. Chunk windows are then cut
+straight from the token offsets, preferring to end on the same separators the
+old `RecursiveCharacterTextSplitter` setup used ("\\n\\n", then "\\n", then " ",
+then any token boundary).
+"""
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+from typing import Iterator, List, Sequence
+
+import tiktoken
+
+ENCODING_NAME = "p50k_base"
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 20
+SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(name: str = ENCODING_NAME) -> tiktoken.Encoding:
+    """Load a tiktoken encoding once per process"""
+    return tiktoken.get_encoding(name)
+
+
+def tiktoken_len(text: str) -> int:
+    """Number of tokens in `text`"""
+    return len(get_tokenizer().encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def model_tokenizer(model: str) -> tiktoken.Encoding:
+    """The encoding an OpenAI model counts its tokens in, cl100k_base for gpt-4 and ada-002"""
+    return tiktoken.encoding_for_model(model)
+
+
+def model_tokens(text: str, model: str) -> int:
+    """Number of tokens `model` counts in `text`, for budgets and rate limits"""
+    return len(model_tokenizer(model).encode(text, disallowed_special=()))
+
+
+def _last_boundary(data: bytes, offsets: List[int], separator: bytes, lo: int, hi: int) -> int:
+    """Last token index in (lo, hi] that starts right after or right on `separator`
+
+    Returns -1 when there is none.
+    """
+    start, stop = offsets[lo], offsets[hi]
+    # a match may begin just before `start`, or end just after `stop`
+    found = data.rfind(separator, start, stop + len(separator))
+    while found >= start:
+        for pos in (found + len(separator), found):
+            if start < pos <= stop:
+                idx = bisect_left(offsets, pos, lo, hi + 1)
+                if offsets[idx] == pos:
+                    return idx
+        found = data.rfind(separator, start, found + len(separator) - 1)
+    return -1
+
+
+def _first_boundary(data: bytes, offsets: List[int], separator: bytes, lo: int, hi: int) -> int:
+    """First token index in [lo, hi) that starts right after or right on `separator`
+
+    Returns -1 when there is none.
+    """
+    start, stop = offsets[lo], offsets[hi]
+    found = data.find(separator, max(start - len(separator), 0), stop)
+    while found != -1:
+        for pos in (found, found + len(separator)):
+            if start <= pos < stop:
+                idx = bisect_left(offsets, pos, lo, hi)
+                if offsets[idx] == pos:
+                    return idx
+        found = data.find(separator, found + 1, stop)
+    return -1
+
+
+def iter_chunks(
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    separators: Sequence[str] = SEPARATORS,
+) -> Iterator[str]:
+    """Yield chunks of at most `chunk_size` tokens from `text`
+
+    Consecutive chunks share up to `chunk_overlap` tokens, starting on a word
+    boundary where one is available.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap must be smaller than chunk_size")
+
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if not tokens:
+        return
+
+    data = text.encode("utf-8")
+    # offsets[i] is the byte position where token i starts, offsets[-1] == len(data)
+    offsets = [0] + list(accumulate(len(b) for b in tokenizer.decode_tokens_bytes(tokens)))
+    total = len(tokens)
+
+    levels = [sep.encode("utf-8") for sep in separators if sep]
+
+    start = end = 0
+    while start < total:
+        limit = min(start + chunk_size, total)
+        # each chunk has to reach past the end of the previous one
+        floor = max(start, end)
+        end = limit
+        if limit < total:
+            # Prefer the last boundary in the window on the highest priority separator
+            for separator in levels:
+                boundary = _last_boundary(data, offsets, separator, floor, limit)
+                if boundary != -1:
+                    end = boundary
+                    break
+
+        chunk = data[offsets[start]:offsets[end]].decode("utf-8", errors="ignore").strip()
+        if chunk:
+            yield chunk
+        if end >= total:
+            return
+
+        next_start = max(end - chunk_overlap, start + 1)
+        if levels:
+            boundary = _first_boundary(data, offsets, levels[-1], next_start, end)
+            if boundary != -1:
+                next_start = boundary
+        start = next_start
@@ -0,0 +1,115 @@
+"""Compact Temporal payloads.
+
+Workflow and activity arguments and results are serialized with msgpack
+instead of JSON, and any payload over `COMPRESS_MIN_BYTES` is lz4 compressed
+by the codec before it reaches the server. Payloads written with the default
+JSON converter still decode, so existing histories replay.
+
+The other half of keeping histories small is what goes into them. Activities
+exchange references to files on the sticky worker (see `DownloadedObj` and
+`ChunkedObj` in workflows.py), never page bodies, chunk text or embeddings,
+so a workflow's history stays the same size however big the page is.
+
+The client and every worker must use `data_converter`.
+"""
+import dataclasses
+from typing import Any, List, Optional, Sequence, Type
+
+import lz4.frame
+import msgpack
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import (
+    BinaryNullPayloadConverter,
+    BinaryPlainPayloadConverter,
+    BinaryProtoPayloadConverter,
+    CompositePayloadConverter,
+    DataConverter,
+    EncodingPayloadConverter,
+    JSONPlainPayloadConverter,
+    JSONProtoPayloadConverter,
+    PayloadCodec,
+    value_to_type,
+)
+
+# lz4 frames cost ~20 bytes of header, not worth it on tiny payloads
+COMPRESS_MIN_BYTES = 256
+
+
+def _default(value: Any) -> Any:
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+class MsgpackPayloadConverter(EncodingPayloadConverter):
+    """'binary/msgpack' payloads for dataclasses and anything msgpack takes"""
+
+    @property
+    def encoding(self) -> str:
+        return "binary/msgpack"
+
+    def to_payload(self, value: Any) -> Optional[Payload]:
+        try:
+            data = msgpack.packb(value, default=_default, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError):
+            # leave anything unusual to the JSON converter
+            return None
+        return Payload(metadata={"encoding": self.encoding.encode()}, data=data)
+
+    def from_payload(self, payload: Payload, type_hint: Optional[Type] = None) -> Any:
+        value = msgpack.unpackb(payload.data, raw=False, strict_map_key=False)
+        if type_hint:
+            value = value_to_type(type_hint, value)
+        return value
+
+
+class CompactPayloadConverter(CompositePayloadConverter):
+    """The default converters with msgpack tried before JSON"""
+
+    def __init__(self) -> None:
+        super().__init__(
+            BinaryNullPayloadConverter(),
+            BinaryPlainPayloadConverter(),
+            JSONProtoPayloadConverter(),
+            BinaryProtoPayloadConverter(),
+            MsgpackPayloadConverter(),
+            JSONPlainPayloadConverter(),
+        )
+
+
+class Lz4PayloadCodec(PayloadCodec):
+    """lz4 compresses payloads of at least `min_bytes` when that makes them smaller"""
+
+    def __init__(self, min_bytes: int = COMPRESS_MIN_BYTES):
+        self.min_bytes = min_bytes
+
+    async def encode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        return [self._encode(payload) for payload in payloads]
+
+    async def decode(self, payloads: Sequence[Payload]) -> List[Payload]:
+        return [self._decode(payload) for payload in payloads]
+
+    def _encode(self, payload: Payload) -> Payload:
+        raw = payload.SerializeToString()
+        if len(raw) < self.min_bytes:
+            return payload
+        compressed = lz4.frame.compress(raw)
+        if len(compressed) >= len(raw):
+            return payload
+        return Payload(metadata={"encoding": b"binary/lz4"}, data=compressed)
+
+    @staticmethod
+    def _decode(payload: Payload) -> Payload:
+        if payload.metadata.get("encoding") != b"binary/lz4":
+            return payload
+        decoded = Payload()
+        decoded.ParseFromString(lz4.frame.decompress(payload.data))
+        return decoded
+
+
+data_converter = DataConverter(
+    payload_converter_class=CompactPayloadConverter,
+    payload_codec=Lz4PayloadCodec(),
+)
@@ -0,0 +1,142 @@
+"""Token-budgeted prompts for multi-turn chat.
+
+Every turn sends the system prompt, a summary of turns that no longer fit,
+as many recent turns as the budget allows, the contexts retrieved for this
+turn's question and the question itself. Turns are kept as the plain
+question and answer, so contexts retrieved for earlier questions are never
+sent again. Contexts get at most `CHAT_RETRIEVAL_TOKENS` in rank order, near
+duplicates dropped, and history fills what is left of `CHAT_CONTEXT_TOKENS`.
+Turns that fell out of the prompt are evicted by `compact`, which folds them
+into the summary when given a summarizer.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Sequence, Set
+
+from chunker import model_tokens
+
+# gpt-4 has an 8k window, the rest is left for the answer
+CONTEXT_TOKENS = int(os.environ.get("CHAT_CONTEXT_TOKENS", "6000"))
+RETRIEVAL_TOKENS = int(os.environ.get("CHAT_RETRIEVAL_TOKENS", "2500"))
+SUMMARY_TOKENS = 400
+# the chat format adds a few tokens of framing to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# retrieved contexts sharing this much of their words are the same context
+DUPLICATE_SIMILARITY = 0.8
+
+Summarizer = Callable[[str, List["Turn"]], Awaitable[str]]
+
+_WORD = re.compile(r"\w+")
+
+
+def message_tokens(content: str, model: str = "gpt-4") -> int:
+    return model_tokens(content, model) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _shingles(text: str) -> Set[str]:
+    words = _WORD.findall(text.lower())
+    return {" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+
+
+def augment(question: str, contexts: Sequence[str]) -> str:
+    """The question with the retrieved contexts in front of it"""
+    if not contexts:
+        return question
+    return "\n\n---\n\n".join(contexts) + "\n\n-----\n\n" + question
+
+
+def dedupe_contexts(contexts: Sequence[str], similarity: float = DUPLICATE_SIMILARITY) -> List[str]:
+    """`contexts` in order, without the ones that mostly repeat an earlier one
+
+    Overlapping chunks of the same page and the same paragraph on several
+    pages come back together often, they cost tokens and add nothing.
+    """
+    kept, kept_shingles = [], []
+    for text in contexts:
+        shingles = _shingles(text)
+        if any(len(shingles & other) >= similarity * min(len(shingles), len(other))
+               for other in kept_shingles):
+            continue
+        kept.append(text)
+        kept_shingles.append(shingles)
+    return kept
+
+
+@dataclass
+class Turn:
+    question: str
+    answer: str
+    tokens: int = 0
+
+
+@dataclass
+class Prompt:
+    messages: List[dict]
+    tokens: int
+    contexts: int = 0
+    duplicates: int = 0
+    turns: int = 0
+
+
+@dataclass
+class ConversationContext:
+    system_prompt: str
+    budget: int = CONTEXT_TOKENS
+    retrieval_budget: int = RETRIEVAL_TOKENS
+    summarize: Optional[Summarizer] = None
+    summary: str = ""
+    turns: List[Turn] = field(default_factory=list)
+    # whose tokenizer the budget is counted in
+    model: str = "gpt-4"
+    # index of the oldest turn the last prompt had room for
+    _oldest_fitted: int = field(default=0, init=False, repr=False)
+
+    def add_turn(self, question: str, answer: str) -> None:
+        tokens = message_tokens(question, self.model) + message_tokens(answer, self.model)
+        self.turns.append(Turn(question, answer, tokens))
+
+    def build(self, question: str, contexts: Sequence[str] = ()) -> Prompt:
+        """The messages for `question`, packed into the token budget"""
+        system = self.system_prompt
+        if self.summary:
+            system += f"\n\nSummary of the conversation so far:\n{self.summary}"
+        used = message_tokens(system, self.model) + message_tokens(question, self.model)
+
+        unique = dedupe_contexts(contexts)
+        picked, retrieval_used = [], 0
+        for text in unique:
+            # each context costs its text plus the separator
+            cost = model_tokens(text, self.model) + 4
+            if retrieval_used + cost > min(self.retrieval_budget, self.budget - used):
+                continue
+            picked.append(text)
+            retrieval_used += cost
+        used += retrieval_used
+
+        history = []
+        for turn in reversed(self.turns):
+            if used + turn.tokens > self.budget:
+                break
+            history.append(turn)
+            used += turn.tokens
+        self._oldest_fitted = len(self.turns) - len(history)
+
+        messages = [{"role": "system", "content": system}]
+        for turn in reversed(history):
+            messages += [{"role": "user", "content": turn.question},
+                         {"role": "assistant", "content": turn.answer}]
+        messages.append({"role": "user", "content": augment(question, picked)})
+        return Prompt(messages, used, contexts=len(picked),
+                      duplicates=len(contexts) - len(unique), turns=len(history))
+
+    async def compact(self) -> List[Turn]:
+        """Evict the turns the last prompt had no room for, summarizing them if we can"""
+        evicted = self.turns[:self._oldest_fitted]
+        if not evicted:
+            return []
+        del self.turns[:len(evicted)]
+        self._oldest_fitted = 0
+        if self.summarize is not None:
+            self.summary = await self.summarize(self.summary, evicted)
+        return evicted
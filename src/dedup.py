@@ -0,0 +1,298 @@
+"""Near-duplicate chunks, found with MinHash and LSH before embedding.
+
+Pages of a docs site repeat the same navigation, sidebar and footer text,
+so the same chunk, give or take a word, comes out of every page. Each new
+chunk gets a MinHash signature of its word 3-shingles, and the signature's
+bands are looked up in an LSH index in a SQLite database in WAL mode shared
+by every worker and script on the host. A chunk whose estimated Jaccard
+similarity to an indexed one is at least `DEDUP_THRESHOLD` is linked to
+that chunk's vector instead of being embedded and upserted. Set
+`DEDUP_THRESHOLD` to an empty string to embed every chunk.
+
+Links are reference counted. When a chunk leaves its page, `release` drops
+its reference and only returns the vectors nothing links to any more, so a
+page losing its copy of the footer does not delete the footer for the
+pages that still have it. A released chunk's own vector leaves the LSH
+index at once though, so nothing new links to text that is no longer on
+the page it came from: when one page edits a shared footer, its new footer
+is embedded, and the other pages link to that one as they are edited too.
+A page's stale chunks are released before its new chunks are claimed,
+otherwise an edited chunk would be linked to the stale one it replaces.
+
+A chunk to embed is only looked up by other pages once its vector is in
+the store: `claim` records it, and `commit` adds it to the LSH index after
+the upsert. If the ingest of its page fails, no other page links to a
+vector that was never upserted, and the retry claims the same chunk id
+again and embeds it.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEDUP_INDEX_PATH = Path(
+    os.environ.get("DEDUP_INDEX_PATH", Path(__file__).parent / "demo_fs" / "dedup.sqlite3")
+)
+_threshold = os.environ.get("DEDUP_THRESHOLD", "0.85")
+DEDUP_THRESHOLD: Optional[float] = float(_threshold) if _threshold else None
+
+SHINGLE_WORDS = 3
+NUM_PERM = 128
+# 16 bands of 8 rows: a pair at 0.85 similarity shares a band 99% of the
+# time, a pair at 0.5 only 6% of the time
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+# random odd multipliers and offsets, one (a * x + b) mod 2**32 permutation of
+# the shingle hashes each, fixed so every process on the host hashes the same
+_rng = np.random.RandomState(0x5EED)
+_PERM_A = _rng.randint(0, 1 << 32, NUM_PERM, dtype=np.uint64).astype(np.uint32) | np.uint32(1)
+_PERM_B = _rng.randint(0, 1 << 32, NUM_PERM, dtype=np.uint64).astype(np.uint32)
+# mix the hashes of a shingle's words, so "a b c" and "c b a" differ
+_MIX = np.array([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D], dtype=np.uint32)[:SHINGLE_WORDS]
+_WORD = re.compile(r"\w+")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    vector_id TEXT PRIMARY KEY,
+    signature BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS buckets (
+    key INTEGER NOT NULL,
+    vector_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS buckets_key ON buckets (key);
+CREATE INDEX IF NOT EXISTS buckets_vector ON buckets (vector_id);
+CREATE TABLE IF NOT EXISTS refs (
+    chunk_id TEXT PRIMARY KEY,
+    vector_id TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refs_vector ON refs (vector_id);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('unique', 0), ('duplicates', 0);
+"""
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """Distinct hashes of every run of `SHINGLE_WORDS` lowercase words in `text`"""
+    words = _WORD.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint32)
+    hashes = np.fromiter(map(zlib.crc32, map(str.encode, words)), dtype=np.uint32, count=len(words))
+    # shorter texts are one shingle
+    runs = max(len(words) - SHINGLE_WORDS + 1, 1)
+    shingles = np.zeros(runs, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for offset, mix in enumerate(_MIX[:len(words)]):
+            shingles += hashes[offset:offset + runs] * mix
+    return np.unique(shingles)
+
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of `text`, None if it has no words"""
+    hashes = shingle_hashes(text)
+    if not hashes.size:
+        return None
+    with np.errstate(over="ignore"):
+        return (np.outer(_PERM_A, hashes) + _PERM_B[:, None]).min(axis=1)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Jaccard similarity estimated from two signatures"""
+    return float(np.count_nonzero(a == b)) / NUM_PERM
+
+
+def band_keys(signature: np.ndarray) -> List[int]:
+    """One LSH bucket per band, as signed 64-bit ints for SQLite"""
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([band]) + signature[band * ROWS:(band + 1) * ROWS].tobytes(),
+                                       digest_size=8).digest(), "big", signed=True)
+        for band in range(BANDS)
+    ]
+
+
+class DedupIndex:
+    """LSH index of the chunks behind each vector, and the chunks linked to them, in SQLite"""
+
+    def __init__(self, path: Path = DEDUP_INDEX_PATH, threshold: Optional[float] = DEDUP_THRESHOLD):
+        self.path = Path(path)
+        self.threshold = threshold
+        # this process's counts
+        self.unique = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def _nearest(self, signature: np.ndarray,
+                 batch: Sequence[Tuple[str, np.ndarray]] = ()) -> Tuple[Optional[str], float]:
+        keys = band_keys(signature)
+        rows = self._conn.execute(
+            "SELECT vector_id, signature FROM signatures WHERE vector_id IN "
+            f"(SELECT vector_id FROM buckets WHERE key IN ({','.join('?' * len(keys))}))",
+            keys,
+        ).fetchall()
+        candidates = [(vector_id, np.frombuffer(blob, dtype=np.uint32)) for vector_id, blob in rows]
+        best, best_score = None, 0.0
+        for vector_id, other in candidates + list(batch):
+            score = similarity(signature, other)
+            if score > best_score:
+                best, best_score = vector_id, score
+        return best, best_score
+
+    def claim(self, chunks: Sequence[dict]) -> Tuple[List[dict], List[dict]]:
+        """Split chunks into the ones to embed and the near duplicates of indexed ones
+
+        A later chunk in `chunks` can be linked to an earlier one to embed,
+        other pages only can once `commit` has indexed it. A chunk that
+        carries its signature under 'minhash' is not hashed again, the ones
+        to embed are given theirs for `commit`.
+        """
+        if self.threshold is None or not chunks:
+            return list(chunks), []
+        signatures = [chunk['minhash'] if 'minhash' in chunk else minhash(chunk['text']) for chunk in chunks]
+        unique, duplicates = [], []
+        # chunks of this call to embed, not in the LSH index until committed
+        batch = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk, signature in zip(chunks, signatures):
+                    row = self._conn.execute(
+                        "SELECT vector_id FROM refs WHERE chunk_id = ?", (chunk['id'],)
+                    ).fetchone()
+                    if row is not None:
+                        # claimed before, by a run that may not have finished
+                        if row[0] == chunk['id']:
+                            chunk['minhash'] = signature
+                            unique.append(chunk)
+                        else:
+                            duplicates.append(chunk)
+                        continue
+                    if signature is None:
+                        unique.append(chunk)
+                        continue
+                    nearest, score = self._nearest(signature, batch)
+                    if nearest is not None and score >= self.threshold:
+                        self._conn.execute("INSERT INTO refs (chunk_id, vector_id) VALUES (?, ?)",
+                                           (chunk['id'], nearest))
+                        duplicates.append(chunk)
+                        continue
+                    self._conn.execute("INSERT INTO refs (chunk_id, vector_id) VALUES (?, ?)",
+                                       (chunk['id'], chunk['id']))
+                    chunk['minhash'] = signature
+                    batch.append((chunk['id'], signature))
+                    unique.append(chunk)
+                self._conn.execute("UPDATE counters SET value = value + ? WHERE name = 'unique'", (len(unique),))
+                self._conn.execute("UPDATE counters SET value = value + ? WHERE name = 'duplicates'",
+                                   (len(duplicates),))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.unique += len(unique)
+            self.duplicates += len(duplicates)
+        return unique, duplicates
+
+    def commit(self, chunks: Iterable[dict]) -> None:
+        """Index claimed chunks whose vectors are now in the store, so other pages can link to them"""
+        if self.threshold is None:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk in chunks:
+                    signature = chunk.get('minhash')
+                    row = self._conn.execute(
+                        "SELECT vector_id FROM refs WHERE chunk_id = ?", (chunk['id'],)
+                    ).fetchone()
+                    # released since, or a chunk with no words
+                    if signature is None or row != (chunk['id'],):
+                        continue
+                    self._conn.execute("INSERT OR REPLACE INTO signatures (vector_id, signature) VALUES (?, ?)",
+                                       (chunk['id'], signature.tobytes()))
+                    self._conn.execute("DELETE FROM buckets WHERE vector_id = ?", (chunk['id'],))
+                    self._conn.executemany("INSERT INTO buckets (key, vector_id) VALUES (?, ?)",
+                                           [(key, chunk['id']) for key in band_keys(signature)])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, chunk_ids: Iterable[str]) -> List[str]:
+        """Drop chunks that are gone from their pages
+
+        Returns the vector ids to delete from the index: those nothing links
+        to any more, and chunks this index never saw. A released chunk's own
+        vector stops being a candidate for new links straight away, even
+        while other pages still link to it.
+        """
+        chunk_ids = list(chunk_ids)
+        if not chunk_ids:
+            return []
+        unused = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk_id in chunk_ids:
+                    row = self._conn.execute(
+                        "SELECT vector_id FROM refs WHERE chunk_id = ?", (chunk_id,)
+                    ).fetchone()
+                    if row is None:
+                        unused.append(chunk_id)
+                        continue
+                    (vector_id,) = row
+                    self._conn.execute("DELETE FROM refs WHERE chunk_id = ?", (chunk_id,))
+                    owner = vector_id == chunk_id
+                    linked = self._conn.execute(
+                        "SELECT 1 FROM refs WHERE vector_id = ? LIMIT 1", (vector_id,)
+                    ).fetchone()
+                    if owner or not linked:
+                        self._conn.execute("DELETE FROM signatures WHERE vector_id = ?", (vector_id,))
+                        self._conn.execute("DELETE FROM buckets WHERE vector_id = ?", (vector_id,))
+                    if not linked:
+                        unused.append(vector_id)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return unused
+
+    def stats(self) -> Dict[str, int]:
+        """Chunks embedded and linked, by this process and by the whole host"""
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM counters"))
+            (vectors,) = self._conn.execute("SELECT COUNT(*) FROM signatures").fetchone()
+        return {
+            "unique": self.unique,
+            "duplicates": self.duplicates,
+            "host_unique": totals["unique"],
+            "host_duplicates": totals["duplicates"],
+            "vectors": vectors,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_dedup_index() -> DedupIndex:
+    """The process wide index at DEDUP_INDEX_PATH"""
+    return DedupIndex()
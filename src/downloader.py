@@ -0,0 +1,142 @@
+"""Streaming page downloads for the worker activities.
+
+One `aiohttp.ClientSession` is shared for the lifetime of the worker process so
+connections to the docs site are reused. Responses are read in large chunks and
+written to disk from a thread so the event loop never blocks on file IO.
+ETag/Last-Modified validators from the last successful ingest of a URL are sent
+back as a conditional GET, so unchanged pages come back as a bodiless 304.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+import aiohttp
+
+READ_CHUNK_BYTES = 256 * 1024
+WRITE_BUFFER_BYTES = 1024 * 1024
+HEARTBEAT_INTERVAL_SECS = 1.0
+VALIDATORS_DIR = Path(
+    os.environ.get("DOWNLOAD_VALIDATORS_DIR", Path(__file__).parent / "demo_fs" / "validators")
+)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+@dataclass
+class DownloadResult:
+    status: int
+    bytes_written: int = 0
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+
+def get_session() -> aiohttp.ClientSession:
+    """The worker's pooled HTTP session, created on first use"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the pooled session, call once when the worker shuts down"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _validators_path(url: str, directory: Path = VALIDATORS_DIR) -> Path:
+    return directory / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+
+
+def load_validators(url: str, directory: Path = VALIDATORS_DIR) -> dict:
+    """ETag/Last-Modified recorded for the last successful ingest of `url`"""
+    try:
+        with open(_validators_path(url, directory)) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return {}
+
+
+def save_validators(url: str, etag: Optional[str], last_modified: Optional[str],
+                    directory: Path = VALIDATORS_DIR) -> None:
+    """Remember the validators of a page once it has been fully ingested"""
+    if not etag and not last_modified:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _validators_path(url, directory)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as handle:
+        json.dump({"etag": etag, "last_modified": last_modified}, handle)
+    os.replace(tmp_path, path)
+
+
+async def download(
+    url: str,
+    path: Path,
+    progress: Optional[Callable[[int], None]] = None,
+    conditional: bool = True,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> DownloadResult:
+    """Stream `url` into `path`
+
+    `progress` is called with the number of bytes written so far at most once
+    every HEARTBEAT_INTERVAL_SECS. Raises `aiohttp.ClientResponseError` on a
+    bad status; nothing is written for a 304.
+    """
+    headers = {}
+    if conditional:
+        validators = load_validators(url)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    loop = asyncio.get_running_loop()
+    session = session or get_session()
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            return DownloadResult(status=304)
+        resp.raise_for_status()
+
+        written = 0
+        last_report = time.monotonic()
+        buffer = bytearray()
+        handle = await loop.run_in_executor(None, open, path, "wb")
+        try:
+            async for chunk in resp.content.iter_chunked(READ_CHUNK_BYTES):
+                buffer += chunk
+                if len(buffer) >= WRITE_BUFFER_BYTES:
+                    await loop.run_in_executor(None, handle.write, bytes(buffer))
+                    written += len(buffer)
+                    buffer.clear()
+                if progress is not None and time.monotonic() - last_report >= HEARTBEAT_INTERVAL_SECS:
+                    progress(written + len(buffer))
+                    last_report = time.monotonic()
+            if buffer:
+                await loop.run_in_executor(None, handle.write, bytes(buffer))
+                written += len(buffer)
+        finally:
+            await loop.run_in_executor(None, handle.close)
+
+        if progress is not None:
+            progress(written)
+        return DownloadResult(
+            status=resp.status,
+            bytes_written=written,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+        )
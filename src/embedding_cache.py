@@ -0,0 +1,286 @@
+"""Persistent embedding cache shared by every worker on a host.
+
+Embeddings are keyed by (model, sha256(text)) and stored as float32 blobs in a
+SQLite database in WAL mode, so several worker processes can read and write it
+concurrently. The cache is bounded by size and evicts the least recently used
+entries first.
+
+Lookups only read, so they never wait on the database's write lock or make
+other processes wait on it. Each process keeps the hits, misses and
+`last_used` touches of its lookups in memory and writes them in batches,
+with the next `put_many` or once `FLUSH_EVERY` have built up, and only
+touches entries last used more than `TOUCH_INTERVAL_SECS` ago. Recency is
+coarse by that much, which is plenty to pick what to evict.
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import openai
+
+from chunker import model_tokens
+from ratelimit import acall_with_retry, call_with_retry, get_limiter
+
+EMBED_MODEL = "text-embedding-ada-002"
+CACHE_PATH = Path(
+    os.environ.get("EMBEDDING_CACHE_PATH", Path(__file__).parent / "demo_fs" / "embeddings.sqlite3")
+)
+CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "512")) * 1024 * 1024
+# entries used again within this long keep their last_used
+TOUCH_INTERVAL_SECS = 60.0
+# pending touches that make a lookup write them out
+FLUSH_EVERY = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, digest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('hits', 0), ('misses', 0), ('bytes', 0);
+"""
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def _pack(vector: Sequence[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _unpack(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """Size-bounded LRU cache of embeddings backed by SQLite"""
+
+    def __init__(self, path: Path = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        # counters for this process, the database keeps host-wide totals
+        self.hits = 0
+        self.misses = 0
+        # counts and touches not written to the database yet
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._touches: Dict[Tuple[str, bytes], float] = {}
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached embeddings for `texts`, None where there is no entry"""
+        digests = [_digest(text) for text in texts]
+        found: Dict[bytes, bytes] = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT digest, vector, last_used FROM embeddings WHERE model = ? "
+                    f"AND digest IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                )
+                for digest, vector, last_used in rows:
+                    found[digest] = vector
+                    if last_used < now - TOUCH_INTERVAL_SECS:
+                        self._touches[(model, digest)] = now
+            hits = sum(1 for digest in digests if digest in found)
+            self.hits += hits
+            self.misses += len(digests) - hits
+            self._pending_hits += hits
+            self._pending_misses += len(digests) - hits
+            if len(self._touches) >= FLUSH_EVERY:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._flush()
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return [_unpack(found[d]) if d in found else None for d in digests]
+
+    def _flush(self) -> None:
+        """Write the pending counts and touches, inside a write transaction"""
+        self._conn.executemany(
+            "UPDATE embeddings SET last_used = max(last_used, ?) WHERE model = ? AND digest = ?",
+            [(used, model, digest) for (model, digest), used in self._touches.items()],
+        )
+        self._conn.execute(
+            "UPDATE counters SET value = value + ? WHERE name = 'hits'", (self._pending_hits,)
+        )
+        self._conn.execute(
+            "UPDATE counters SET value = value + ? WHERE name = 'misses'", (self._pending_misses,)
+        )
+        self._touches.clear()
+        self._pending_hits = self._pending_misses = 0
+
+    def flush(self) -> None:
+        """Write this process's pending counts and touches now"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._flush()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Store embeddings, evicting the least recently used entries if over budget"""
+        now = time.time()
+        rows = [(model, _digest(text), _pack(vector), now) for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = 0
+                for row in rows:
+                    previous = self._conn.execute(
+                        "SELECT length(vector) FROM embeddings WHERE model = ? AND digest = ?",
+                        row[:2],
+                    ).fetchone()
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO embeddings (model, digest, vector, last_used) "
+                        "VALUES (?, ?, ?, ?)",
+                        row,
+                    )
+                    added += len(row[2]) - (previous[0] if previous else 0)
+                self._conn.execute(
+                    "UPDATE counters SET value = value + ? WHERE name = 'bytes'", (added,)
+                )
+                self._flush()
+                self._evict()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache is back under budget"""
+        (total,) = self._conn.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()
+        while total > self.max_bytes:
+            victims = self._conn.execute(
+                "SELECT model, digest, length(vector) FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not victims:
+                break
+            freed = 0
+            for model, digest, size in victims:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE model = ? AND digest = ?", (model, digest)
+                )
+                freed += size
+                if total - freed <= self.max_bytes:
+                    break
+            total -= freed
+            self._conn.execute(
+                "UPDATE counters SET value = value - ? WHERE name = 'bytes'", (freed,)
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters for this process and for the whole host"""
+        self.flush()
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM counters"))
+            (entries,) = self._conn.execute("SELECT count(*) FROM embeddings").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "host_hits": totals["hits"],
+            "host_misses": totals["misses"],
+            "entries": entries,
+            "bytes": totals["bytes"],
+        }
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_cache() -> EmbeddingCache:
+    """The process wide cache at CACHE_PATH"""
+    return EmbeddingCache()
+
+
+def _tokens(texts: Sequence[str], missing: Sequence[int], token_counts: Optional[Sequence[int]],
+            engine: str) -> int:
+    """Tokens of the texts to send, for the rate limiter
+
+    Chunk sizes counted by the chunker in p50k_base are close to, and on
+    prose and markup usually above, the cl100k_base count ada-002 bills.
+    """
+    return sum(token_counts[i] if token_counts else model_tokens(texts[i], engine) for i in missing)
+
+
+def _fill(embeds: List[Optional[List[float]]], missing: Sequence[int], res) -> List[List[float]]:
+    """Put the API's embeddings in place of the misses, and return them"""
+    fresh = [record['embedding'] for record in sorted(res['data'], key=lambda r: r['index'])]
+    for i, embed in zip(missing, fresh):
+        embeds[i] = embed
+    return fresh
+
+
+def embed_texts(texts: Sequence[str], engine: str = EMBED_MODEL,
+                cache: Optional[EmbeddingCache] = None,
+                token_counts: Optional[Sequence[int]] = None) -> List[List[float]]:
+    """Embed `texts`, only sending the ones missing from the cache to OpenAI"""
+    cache = cache or get_cache()
+    embeds = cache.get_many(engine, texts)
+    missing = [i for i, embed in enumerate(embeds) if embed is None]
+    if missing:
+        inputs = [texts[i] for i in missing]
+        res = call_with_retry(
+            lambda: openai.Embedding.create(input=inputs, engine=engine),
+            get_limiter("embeddings"),
+            tokens=_tokens(texts, missing, token_counts, engine),
+        )
+        cache.put_many(engine, inputs, _fill(embeds, missing, res))
+    return embeds
+
+
+async def aembed_texts(texts: Sequence[str], engine: str = EMBED_MODEL,
+                       cache: Optional[EmbeddingCache] = None,
+                       token_counts: Optional[Sequence[int]] = None) -> List[List[float]]:
+    """Async `embed_texts`, cache lookups run in a thread to keep the loop free
+
+    Pass the `token_counts` of `texts` if they are known, to save tokenizing
+    them again on the event loop for the rate limiter.
+    """
+    cache = cache or get_cache()
+    embeds = await asyncio.to_thread(cache.get_many, engine, texts)
+    missing = [i for i, embed in enumerate(embeds) if embed is None]
+    if missing:
+        inputs = [texts[i] for i in missing]
+        res = await acall_with_retry(
+            lambda: openai.Embedding.acreate(input=inputs, engine=engine),
+            get_limiter("embeddings"),
+            tokens=_tokens(texts, missing, token_counts, engine),
+        )
+        await asyncio.to_thread(cache.put_many, engine, inputs, _fill(embeds, missing, res))
+    return embeds
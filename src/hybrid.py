@@ -0,0 +1,100 @@
+"""Hybrid retrieval: dense and BM25 candidates, fused, then diversified.
+
+The vector store and the lexical index (lexical.py) each return
+`HYBRID_CANDIDATES` matches for a question. Reciprocal rank fusion merges the
+two rankings without having to compare their scores, and maximal marginal
+relevance picks the final `top_k` from the fused list, trading a little
+relevance for chunks that do not repeat each other (`MMR_LAMBDA`, 1 is pure
+relevance). Similarity between candidates is the cosine of their TF-IDF
+vectors, computed for the whole candidate set at once with NumPy, so no
+embeddings have to be fetched for them.
+
+The lexical index is kept on this host by the ingests that run here, so with
+`REMOTE_INGEST` set the default mode is "dense" and "hybrid" is refused.
+"""
+import os
+from collections import Counter
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from embedding_cache import EMBED_MODEL
+from lexical import LexicalIndex, get_lexical_index, tokenize
+from retrieval_cache import (REMOTE_INGEST, RetrievalCache, embed_query, ingested_here, query_store,
+                             retrieve)
+from vectorstore import VectorStore
+
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "dense" if REMOTE_INGEST else "hybrid")
+CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.7"))
+# the usual constant from the RRF paper, damps the head of each ranking
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[dict]], k: int = RRF_K) -> List[dict]:
+    """Matches from every ranking, scored by the sum of 1 / (k + rank)"""
+    scores: Counter = Counter()
+    matches = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking, 1):
+            scores[match['id']] += 1 / (k + rank)
+            matches.setdefault(match['id'], match)
+    return [dict(matches[match_id], score=score) for match_id, score in scores.most_common()]
+
+
+def tfidf_similarity(texts: Sequence[str]) -> np.ndarray:
+    """Cosine similarity of every pair of texts, over TF-IDF vectors"""
+    counts = [Counter(tokenize(text)) for text in texts]
+    vocabulary = {term: i for i, term in enumerate({term for count in counts for term in count})}
+    matrix = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+    for row, count in enumerate(counts):
+        for term, tf in count.items():
+            matrix[row, vocabulary[term]] = 1 + np.log(tf)
+    df = np.count_nonzero(matrix, axis=0)
+    matrix *= np.log((1 + len(texts)) / (1 + df)) + 1
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return matrix @ matrix.T
+
+
+def mmr(relevance: np.ndarray, similarity: np.ndarray, top_k: int,
+        weight: float = MMR_LAMBDA) -> List[int]:
+    """Indices picked by maximal marginal relevance, best first"""
+    relevance = relevance / (relevance.max() or 1)
+    closest = np.zeros(len(relevance))
+    available = np.ones(len(relevance), dtype=bool)
+    picked = []
+    for _ in range(min(top_k, len(relevance))):
+        gain = np.where(available, weight * relevance - (1 - weight) * closest, -np.inf)
+        best = int(np.argmax(gain))
+        picked.append(best)
+        available[best] = False
+        closest = np.maximum(closest, similarity[best])
+    return picked
+
+
+def hybrid_search(query: str, store: VectorStore, top_k: int = 5, engine: str = EMBED_MODEL,
+                  lexical: Optional[LexicalIndex] = None, cache: Optional[RetrievalCache] = None,
+                  candidates: int = CANDIDATES) -> dict:
+    """The `top_k` matches for a question from both indexes, shaped like `VectorStore.query`"""
+    dense = query_store(store, embed_query(query, engine, cache), candidates, cache=cache)['matches']
+    keyword = (lexical or get_lexical_index()).search(query, candidates)
+    fused = reciprocal_rank_fusion([dense, keyword])[:candidates]
+    if not fused:
+        return {'matches': []}
+    similarity = tfidf_similarity([match['metadata'].get('text', '') for match in fused])
+    picked = mmr(np.array([match['score'] for match in fused]), similarity, top_k)
+    return {'matches': [fused[i] for i in picked]}
+
+
+def search(query: str, store: VectorStore, top_k: int = 5, engine: str = EMBED_MODEL,
+           mode: str = RETRIEVAL_MODE) -> dict:
+    """Matches for a question by `RETRIEVAL_MODE`, "hybrid" or "dense" (vector store only)"""
+    if mode == "dense":
+        return retrieve(query, store, top_k, engine)
+    if mode == "hybrid":
+        if not ingested_here(store):
+            raise ValueError("Hybrid retrieval needs the lexical index ingested on this host, "
+                             "use RETRIEVAL_MODE=dense with REMOTE_INGEST")
+        return hybrid_search(query, store, top_k, engine)
+    raise ValueError(f"Unknown retrieval mode {mode!r}")
@@ -0,0 +1,228 @@
+"""BM25 keyword index of the ingested chunks.
+
+Dense retrieval is good at what a question is about and bad at exact names,
+so a question about `.gitpod.yml` fields or `--port` flags often misses the
+chunk that spells them out. This index scores chunks with BM25 over terms
+that keep such names whole, `.gitpod.yml` is indexed as `gitpod.yml`,
+`gitpod` and `yml`, and `onOpen` as `onopen`, `on` and `open`.
+
+The index is an inverted index in a SQLite database in WAL mode: terms are
+numbered once and postings are (term, chunk, term frequency) rows, so every
+worker on the host can add to it while the ask scripts search it. The
+ingest activity keeps it in step with the vector store, but only for ingests
+on this host, see `REMOTE_INGEST` in retrieval_cache.py.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+INDEX_PATH = Path(
+    os.environ.get("LEXICAL_INDEX_PATH", Path(__file__).parent / "demo_fs" / "lexical.sqlite3")
+)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# terms in more than this share of the chunks are treated as stop words, they
+# add little to a score and their postings are most of the work
+MAX_DF_RATIO = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    id INTEGER NOT NULL UNIQUE,
+    df INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS docs (
+    doc INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    length INTEGER NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term INTEGER NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('docs', 0), ('length', 0), ('terms', 0);
+"""
+
+# words, and names joined by dots, dashes, slashes or underscores
+_TOKEN = re.compile(r"[A-Za-z0-9_]+(?:[.\-/][A-Za-z0-9_]+)*")
+_PART = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms, compound names followed by their parts"""
+    terms = []
+    for match in _TOKEN.finditer(text):
+        word = match.group()
+        terms.append(word.lower())
+        parts = _PART.findall(word)
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return terms
+
+
+class LexicalIndex:
+    """BM25 over chunks, stored as an inverted index in SQLite"""
+
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def add(self, chunks: Iterable[dict]) -> None:
+        """Index chunks shaped like the pipeline's, {'id', 'text', 'chunk', 'url'}, replacing old versions"""
+        chunks = list(chunks)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete([chunk['id'] for chunk in chunks])
+                for chunk in chunks:
+                    counts = Counter(tokenize(chunk['text']))
+                    length = sum(counts.values())
+                    metadata = {'text': chunk['text'], 'chunk': chunk['chunk'], 'url': chunk['url']}
+                    doc = self._conn.execute(
+                        "INSERT INTO docs (id, length, metadata) VALUES (?, ?, ?)",
+                        (chunk['id'], length, json.dumps(metadata)),
+                    ).lastrowid
+                    term_ids = self._term_ids(list(counts))
+                    self._conn.executemany(
+                        "INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                        [(term_ids[term], doc, tf) for term, tf in counts.items()],
+                    )
+                    self._conn.executemany(
+                        "UPDATE terms SET df = df + 1 WHERE id = ?", [(term_ids[term],) for term in counts]
+                    )
+                    self._bump("docs", 1)
+                    self._bump("length", length)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _term_ids(self, terms: List[str]) -> Dict[str, int]:
+        ids = self._lookup(terms)
+        missing = [term for term in terms if term not in ids]
+        if missing:
+            (next_id,) = self._conn.execute("SELECT value FROM meta WHERE key = 'terms'").fetchone()
+            self._conn.executemany(
+                "INSERT INTO terms (term, id, df) VALUES (?, ?, 0)",
+                [(term, next_id + i) for i, term in enumerate(missing)],
+            )
+            self._bump("terms", len(missing))
+            ids.update((term, next_id + i) for i, term in enumerate(missing))
+        return ids
+
+    def _lookup(self, terms: Sequence[str]) -> Dict[str, int]:
+        ids = {}
+        for start in range(0, len(terms), 500):
+            batch = terms[start:start + 500]
+            ids.update(self._conn.execute(
+                f"SELECT term, id FROM terms WHERE term IN ({','.join('?' * len(batch))})", batch
+            ))
+        return ids
+
+    def _bump(self, key: str, value: int) -> None:
+        self._conn.execute("UPDATE meta SET value = value + ? WHERE key = ?", (value, key))
+
+    def delete(self, ids: Sequence[str]) -> None:
+        """Remove chunks by id, unknown ids are ignored"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete(ids)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _delete(self, ids: Sequence[str]) -> None:
+        for chunk_id in ids:
+            row = self._conn.execute("SELECT doc, length FROM docs WHERE id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                continue
+            doc, length = row
+            self._conn.execute(
+                "UPDATE terms SET df = df - 1 WHERE id IN (SELECT term FROM postings WHERE doc = ?)", (doc,)
+            )
+            self._conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+            self._conn.execute("DELETE FROM docs WHERE doc = ?", (doc,))
+            self._bump("docs", -1)
+            self._bump("length", -length)
+
+    def search(self, query: str, top_k: int = 5) -> List[dict]:
+        """Pinecone shaped matches, best BM25 score first"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+            found = {}
+            for start in range(0, len(terms), 500):
+                batch = terms[start:start + 500]
+                found.update((term_id, df) for term_id, df in self._conn.execute(
+                    f"SELECT id, df FROM terms WHERE term IN ({','.join('?' * len(batch))}) AND df > 0", batch
+                ))
+            if not found:
+                return []
+            # unless stop words are all the query has
+            found = {term: df for term, df in found.items() if df <= MAX_DF_RATIO * meta['docs']} or found
+            postings = self._conn.execute(
+                f"SELECT postings.term, postings.doc, postings.tf, docs.length FROM postings "
+                f"JOIN docs ON docs.doc = postings.doc WHERE postings.term IN ({','.join('?' * len(found))})",
+                list(found),
+            ).fetchall()
+
+        # score every posting at once, then sum per chunk
+        term, doc, tf, length = np.array(postings, dtype=np.float64).T
+        docs, average_length = meta['docs'], meta['length'] / meta['docs']
+        df = np.array([found[int(t)] for t in term])
+        idf = np.log(1 + (docs - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+        unique_docs, owner = np.unique(doc.astype(np.int64), return_inverse=True)
+        scores = np.bincount(owner, weights=idf * tf * (BM25_K1 + 1) / (tf + norm))
+        best = np.argsort(-scores)[:top_k]
+        top = [(int(unique_docs[i]), float(scores[i])) for i in best]
+
+        with self._lock:
+            rows = dict((doc, (chunk_id, metadata)) for doc, chunk_id, metadata in self._conn.execute(
+                f"SELECT doc, id, metadata FROM docs WHERE doc IN ({','.join('?' * len(top))})",
+                [doc for doc, _ in top],
+            ))
+        return [{'id': rows[doc][0], 'score': score, 'metadata': json.loads(rows[doc][1])}
+                for doc, score in top if doc in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, value FROM meta"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_lexical_index() -> LexicalIndex:
+    """The process wide index at INDEX_PATH"""
+    return LexicalIndex()
@@ -0,0 +1,68 @@
+"""Deterministic chunk ids and per-URL ingest manifests.
+
+A chunk id is derived from the page URL, the chunk's position and a hash of its
+text, so re-chunking an unchanged page produces the same ids. The manifest for
+a URL records the ids and hashes last written to the index, which lets a
+re-ingest upsert only new or changed chunks and delete the ones that are gone.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+MANIFEST_DIR = Path(
+    os.environ.get("INGEST_MANIFEST_DIR", Path(__file__).parent / "demo_fs" / "manifests")
+)
+
+
+def content_hash(text: str) -> str:
+    """sha256 of the chunk text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(url: str, index: int, text: str) -> str:
+    """Stable id for chunk `index` of `url` with contents `text`"""
+    key = f"{url}\0{index}\0{content_hash(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def _manifest_path(url: str, directory: Path = MANIFEST_DIR) -> Path:
+    return directory / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+
+
+def load_manifest(url: str, directory: Path = MANIFEST_DIR) -> Dict[str, str]:
+    """Chunk id -> content hash last ingested for `url`, empty if never ingested"""
+    try:
+        with open(_manifest_path(url, directory)) as handle:
+            return json.load(handle)["chunks"]
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(url: str, chunks: Iterable[dict], directory: Path = MANIFEST_DIR) -> None:
+    """Record `chunks` as the current contents of `url` in the index"""
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _manifest_path(url, directory)
+    body = {
+        "url": url,
+        "chunks": {chunk['id']: content_hash(chunk['text']) for chunk in chunks},
+    }
+    # write to a temp file and rename so a crash never leaves a torn manifest
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as handle:
+        json.dump(body, handle)
+    os.replace(tmp_path, path)
+
+
+def plan_ingest(url: str, chunks: List[dict], directory: Path = MANIFEST_DIR) -> Tuple[List[dict], List[str]]:
+    """Split `chunks` of `url` against its manifest
+
+    Returns the chunks that still need embedding and upserting, and the ids of
+    previously ingested chunks that should be deleted from the index.
+    """
+    previous = load_manifest(url, directory)
+    current = {chunk['id'] for chunk in chunks}
+    pending = [chunk for chunk in chunks if chunk['id'] not in previous]
+    stale = [old_id for old_id in previous if old_id not in current]
+    return pending, stale
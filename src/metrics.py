@@ -0,0 +1,155 @@
+"""Per-stage ingestion metrics.
+
+Activities time their own stages (download, parse, split, embed, upsert) and
+return the timings in their results as `StageTiming`s (workflows.py), which
+the workflow sums into its result. `MetricsInterceptor` records the same
+timings into this process's registry as they pass through the worker, and
+`serve_metrics` exposes the registry on `/metrics` in the Prometheus text
+format, together with the Temporal SDK's own worker metrics.
+
+The interceptor runs in the worker process even for sync activities in the
+process pool, which is why timings travel in results rather than being
+recorded where they are measured.
+"""
+import asyncio
+import socket
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from temporalio import activity
+from temporalio.runtime import PrometheusConfig, Runtime, TelemetryConfig
+from temporalio.worker import ActivityInboundInterceptor, ExecuteActivityInput, Interceptor
+
+from workflows import StageTiming
+
+# upper bounds of the stage duration histogram buckets, in seconds
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = defaultdict(dict)
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        with self._lock:
+            self._counters[name][tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # per bucket counts, then sum and count
+            series = self._histograms[name].setdefault(key, [0.0] * (len(SECONDS_BUCKETS) + 2))
+            for i, bound in enumerate(SECONDS_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += self._header(name)
+                lines += [f"{name}{_labels(key)} {value}" for key, value in series.items()]
+            for name, series in sorted(self._histograms.items()):
+                lines += self._header(name)
+                for key, values in series.items():
+                    for bound, count in zip(SECONDS_BUCKETS, values):
+                        lines.append(f"{name}_bucket{_labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {values[-1]}")
+                    lines.append(f"{name}_sum{_labels(key)} {values[-2]}")
+                    lines.append(f"{name}_count{_labels(key)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str) -> List[str]:
+        kind, text = self._help.get(name, ("untyped", ""))
+        return [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+
+
+def _labels(key: Labels) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+registry = Registry()
+registry.describe("ingest_stage_seconds", "histogram", "Time spent in each ingestion stage per page")
+registry.describe("ingest_stage_bytes_total", "counter", "Bytes handled by each ingestion stage")
+registry.describe("ingest_stage_tokens_total", "counter", "Tokens handled by each ingestion stage")
+registry.describe("ingest_stage_batches_total", "counter", "Requests made by each ingestion stage")
+registry.describe("ingest_stage_items_total", "counter", "Chunks or vectors handled by each ingestion stage")
+registry.describe("openai_retries_total", "counter", "Retried OpenAI requests")
+registry.describe("openai_throttled_seconds_total", "counter", "Time spent waiting on OpenAI rate limits")
+
+
+def record_stages(stages: Dict[str, StageTiming], task_queue: str = "") -> None:
+    """Add the timings of one activity to the registry"""
+    for stage, timing in stages.items():
+        labels = {"stage": stage, "task_queue": task_queue}
+        registry.observe("ingest_stage_seconds", timing.secs, **labels)
+        registry.inc("ingest_stage_bytes_total", timing.bytes, **labels)
+        registry.inc("ingest_stage_tokens_total", timing.tokens, **labels)
+        registry.inc("ingest_stage_batches_total", timing.batches, **labels)
+        registry.inc("ingest_stage_items_total", timing.items, **labels)
+        if timing.retries or timing.throttled_secs:
+            registry.inc("openai_retries_total", timing.retries, **labels)
+            registry.inc("openai_throttled_seconds_total", timing.throttled_secs, **labels)
+
+
+class MetricsInterceptor(Interceptor):
+    """Records the stage timings of every activity result that carries them"""
+
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return _MetricsInbound(next)
+
+
+class _MetricsInbound(ActivityInboundInterceptor):
+    async def execute_activity(self, input: ExecuteActivityInput) -> Any:
+        result = await super().execute_activity(input)
+        stages = getattr(result, "stages", None)
+        if stages:
+            record_stages(stages, activity.info().task_queue)
+        return result
+
+
+def temporal_runtime() -> Tuple[Runtime, str]:
+    """A Temporal runtime exporting SDK metrics on a free local port, and that address"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        address = f"127.0.0.1:{sock.getsockname()[1]}"
+    return Runtime(telemetry=TelemetryConfig(metrics=PrometheusConfig(bind_address=address))), address
+
+
+async def serve_metrics(port: int, temporal_address: Optional[str] = None) -> web.AppRunner:
+    """Serve `/metrics`: this registry plus the Temporal SDK metrics at `temporal_address`"""
+    async def metrics(request: web.Request) -> web.Response:
+        body = registry.render()
+        if temporal_address:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://{temporal_address}/metrics") as resp:
+                        body += await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    return runner
@@ -0,0 +1,166 @@
+"""Concurrent embed -> upsert stage.
+
+Chunks are grouped into batches by total token count. A bounded number of
+embedding requests run at once, and finished batches are handed to a bounded
+upsert queue drained by its own workers, so the wait for OpenAI overlaps with
+the wait for the vector index. Chunks can also come from an async iterable,
+which is read no faster than batches are embedded.
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import (AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Sequence,
+                    Tuple, Union)
+
+from chunker import tiktoken_len
+
+EMBED_BATCH_TOKENS = int(os.environ.get("EMBED_BATCH_TOKENS", "32000"))
+EMBED_BATCH_MAX_ITEMS = 2048
+EMBED_MAX_IN_FLIGHT = int(os.environ.get("EMBED_MAX_IN_FLIGHT", "4"))
+UPSERT_QUEUE_SIZE = int(os.environ.get("UPSERT_QUEUE_SIZE", "8"))
+UPSERT_WORKERS = int(os.environ.get("UPSERT_WORKERS", "2"))
+
+# called with the texts of a batch and their token counts
+EmbedFn = Callable[[List[str], List[int]], Awaitable[List[List[float]]]]
+UpsertFn = Callable[[List[Tuple[str, List[float], dict]]], Awaitable[None]]
+
+
+@dataclass
+class PipelineStats:
+    chunks: int = 0
+    tokens: int = 0
+    batches: int = 0
+    upserts: int = 0
+    # summed time spent waiting on each stage, can exceed wall time when overlapped
+    embed_secs: float = 0.0
+    upsert_secs: float = 0.0
+    wall_secs: float = 0.0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.chunks / self.wall_secs if self.wall_secs else 0.0
+
+
+def token_batches(chunks: Iterable[dict], max_tokens: int = EMBED_BATCH_TOKENS,
+                  max_items: int = EMBED_BATCH_MAX_ITEMS) -> Iterator[Tuple[List[dict], int]]:
+    """Group chunks into batches of at most `max_tokens` tokens
+
+    A single chunk larger than the budget still gets a batch of its own. Token
+    counts are kept on the chunks, so the embed step does not count them again.
+    """
+    batch: List[dict] = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = chunk['tokens'] = chunk.get('tokens') or tiktoken_len(chunk['text'])
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+            yield batch, batch_tokens
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch, batch_tokens
+
+
+async def atoken_batches(chunks: AsyncIterable[dict], max_tokens: int = EMBED_BATCH_TOKENS,
+                         max_items: int = EMBED_BATCH_MAX_ITEMS) -> AsyncIterator[Tuple[List[dict], int]]:
+    """`token_batches` of chunks that arrive asynchronously"""
+    batch: List[dict] = []
+    batch_tokens = 0
+    async for chunk in chunks:
+        tokens = chunk['tokens'] = chunk.get('tokens') or tiktoken_len(chunk['text'])
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+            yield batch, batch_tokens
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch, batch_tokens
+
+
+async def _aiter(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
+def to_vectors(batch: Sequence[dict], embeds: Sequence[List[float]]) -> List[Tuple[str, List[float], dict]]:
+    """(id, embedding, metadata) tuples ready to upsert"""
+    return [
+        (x['id'], embed, {'text': x['text'], 'chunk': x['chunk'], 'url': x['url']})
+        for x, embed in zip(batch, embeds)
+    ]
+
+
+async def embed_and_upsert(
+    chunks: Union[Iterable[dict], AsyncIterable[dict]],
+    embed_fn: EmbedFn,
+    upsert_fn: UpsertFn,
+    max_tokens: int = EMBED_BATCH_TOKENS,
+    max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+    upsert_queue_size: int = UPSERT_QUEUE_SIZE,
+    upsert_workers: int = UPSERT_WORKERS,
+) -> PipelineStats:
+    """Embed `chunks` and upsert them, overlapping the two stages"""
+    stats = PipelineStats()
+    started = time.perf_counter()
+    in_flight = asyncio.Semaphore(max_in_flight)
+    upserts: asyncio.Queue = asyncio.Queue(maxsize=upsert_queue_size)
+
+    async def embed(batch: List[dict], tokens: int) -> None:
+        try:
+            began = time.perf_counter()
+            embeds = await embed_fn([x['text'] for x in batch], [x['tokens'] for x in batch])
+            stats.embed_secs += time.perf_counter() - began
+            stats.chunks += len(batch)
+            stats.tokens += tokens
+            stats.batches += 1
+            # blocks while the upsert queue is full, which holds back new embeds
+            await upserts.put(to_vectors(batch, embeds))
+        finally:
+            in_flight.release()
+
+    async def upsert_worker() -> None:
+        while True:
+            vectors = await upserts.get()
+            try:
+                began = time.perf_counter()
+                await upsert_fn(vectors)
+                stats.upsert_secs += time.perf_counter() - began
+                stats.upserts += 1
+            finally:
+                upserts.task_done()
+
+    embeds: List[asyncio.Task] = []
+
+    async def produce() -> None:
+        if isinstance(chunks, AsyncIterable):
+            batches = atoken_batches(chunks, max_tokens)
+        else:
+            batches = _aiter(token_batches(chunks, max_tokens))
+        async for batch, tokens in batches:
+            await in_flight.acquire()
+            embeds.append(asyncio.create_task(embed(batch, tokens)))
+            # surface failures early instead of after every batch is sent, and
+            # let go of finished tasks so a long run does not pile them up
+            for task in [t for t in embeds if t.done()]:
+                task.result()
+                embeds.remove(task)
+        await asyncio.gather(*embeds)
+        await upserts.join()
+
+    workers = [asyncio.create_task(upsert_worker()) for _ in range(upsert_workers)]
+    producer = asyncio.create_task(produce())
+    try:
+        # upsert workers only ever finish by failing, so this returns either
+        # once everything is upserted or as soon as something breaks
+        await asyncio.wait([producer, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in [producer, *workers]:
+            if task.done():
+                task.result()
+    finally:
+        for task in [producer, *embeds, *workers]:
+            task.cancel()
+        await asyncio.gather(producer, *embeds, *workers, return_exceptions=True)
+
+    stats.wall_secs = time.perf_counter() - started
+    return stats
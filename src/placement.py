@@ -0,0 +1,178 @@
+"""Load-aware sticky task queue selection.
+
+Every per-host task queue has a row on a small SQLite load board shared by the
+workers on the host: its activity slots, the activities running on it right
+now and a decaying count of recent assignments (work that was handed to the
+queue but whose activities have not started yet). `LoadReportingInterceptor`
+keeps the running count current. It wraps sync activities too, since the
+interceptor chain runs in the worker process before handing off to the pool.
+
+`LoadBoard.choose` picks the least loaded queue and counts the assignment in
+the same transaction, so concurrent callers see each other's picks. The board
+is a local file, so it only knows the queues of the host whose distribution
+worker runs the activity, and which host that is is up to Temporal. There is
+no URL affinity: every cache a page leaves behind (validators, manifests,
+embeddings, dedup) is shared by all the queues on a host, so sending a page
+back to the same queue on a host gains nothing over any other queue there.
+"""
+import asyncio
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+from temporalio import activity
+from temporalio.worker import ActivityInboundInterceptor, ExecuteActivityInput, Interceptor
+
+LOAD_BOARD_PATH = Path(
+    os.environ.get("LOAD_BOARD_PATH", Path(__file__).parent / "demo_fs" / "load_board.sqlite3")
+)
+# queues that have not reported for this long are treated as gone
+STALE_SECS = 30.0
+# recent assignments count towards load for about this long
+ASSIGNMENT_DECAY_SECS = 15.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_loads (
+    queue TEXT PRIMARY KEY,
+    slots INTEGER NOT NULL,
+    in_flight INTEGER NOT NULL DEFAULT 0,
+    recent REAL NOT NULL DEFAULT 0,
+    recent_at REAL NOT NULL DEFAULT 0,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class QueueLoad:
+    slots: int
+    in_flight: int
+    recent: float
+
+    @property
+    def utilisation(self) -> float:
+        return (self.in_flight + self.recent) / max(self.slots, 1)
+
+
+def pick_queue(utilisation: Dict[str, float]) -> str:
+    """The least utilised queue"""
+    if not utilisation:
+        raise ValueError("No task queues available")
+    least = min(utilisation.values())
+    # random among ties, so simultaneous callers don't all pile onto one queue
+    return random.choice([q for q, load in utilisation.items() if load == least])
+
+
+class LoadBoard:
+    """Per queue load shared by every worker process on the host"""
+
+    def __init__(self, path: Path = LOAD_BOARD_PATH):
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def register(self, queue: str, slots: int) -> None:
+        """Add or reset a queue, called when its worker starts"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queue_loads (queue, slots, heartbeat) VALUES (?, ?, ?)",
+                (queue, slots, time.time()),
+            )
+
+    def unregister(self, queue: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM queue_loads WHERE queue = ?", (queue,))
+
+    def heartbeat(self, queues: Sequence[str]) -> None:
+        """Mark queues as alive, workers call this every few seconds"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE queue_loads SET heartbeat = ? WHERE queue = ?",
+                [(time.time(), queue) for queue in queues],
+            )
+
+    def adjust_in_flight(self, queue: str, delta: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE queue_loads SET in_flight = max(in_flight + ?, 0), heartbeat = ? WHERE queue = ?",
+                (delta, time.time(), queue),
+            )
+
+    def _loads(self, now: float) -> Dict[str, QueueLoad]:
+        rows = self._conn.execute(
+            "SELECT queue, slots, in_flight, recent, recent_at FROM queue_loads WHERE heartbeat > ?",
+            (now - STALE_SECS,),
+        ).fetchall()
+        return {
+            queue: QueueLoad(slots, in_flight, _decay(recent, now - recent_at))
+            for queue, slots, in_flight, recent, recent_at in rows
+        }
+
+    def loads(self) -> Dict[str, QueueLoad]:
+        """Load of every live queue"""
+        with self._lock:
+            return self._loads(time.time())
+
+    def choose(self) -> str:
+        """Pick a queue for new work and count the assignment against it"""
+        now = time.time()
+        with self._lock:
+            # one write transaction, so two callers can't both pick the
+            # queue that was least loaded before either counted against it
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                loads = self._loads(now)
+                queue = pick_queue({q: load.utilisation for q, load in loads.items()})
+                self._conn.execute(
+                    "UPDATE queue_loads SET recent = ?, recent_at = ? WHERE queue = ?",
+                    (loads[queue].recent + 1, now, queue),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return queue
+
+
+def _decay(recent: float, elapsed: float) -> float:
+    return recent * math.exp(-max(elapsed, 0.0) / ASSIGNMENT_DECAY_SECS)
+
+
+_board: Optional[LoadBoard] = None
+
+
+def get_load_board() -> LoadBoard:
+    """The process wide load board, opened on first use"""
+    global _board
+    if _board is None:
+        _board = LoadBoard()
+    return _board
+
+
+class LoadReportingInterceptor(Interceptor):
+    """Counts running activities per task queue on the load board"""
+
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return _LoadReportingInbound(next)
+
+
+class _LoadReportingInbound(ActivityInboundInterceptor):
+    async def execute_activity(self, input: ExecuteActivityInput) -> Any:
+        queue = activity.info().task_queue
+        board = get_load_board()
+        await asyncio.to_thread(board.adjust_in_flight, queue, 1)
+        try:
+            return await super().execute_activity(input)
+        finally:
+            await asyncio.to_thread(board.adjust_in_flight, queue, -1)
@@ -0,0 +1,144 @@
+"""Streaming question answering for the chat scripts.
+
+`QueryEngine.ask` starts the retrieval for a question (hybrid dense and
+keyword search, see hybrid.py) and prepares the conversation history
+at the same time, then streams the GPT-4 answer token by token to a
+callback. What the user waits for is the time to the first token, not the
+time to the whole answer, and every answer records both in `AnswerTiming`.
+
+Prompts are packed into a token budget by `ConversationContext`, see
+conversation.py. Old turns that no longer fit are summarized with
+`CHAT_SUMMARY_MODEL` in the background while the user types the next
+question, set it to an empty string to just drop them.
+
+With a `Session` (sessions.py) every question and answer is appended to the
+session store as it happens, and the summary is saved with it. A resumed
+session starts from its summary and the newest turns that fit the budget.
+"""
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import openai
+
+from conversation import CONTEXT_TOKENS, SUMMARY_TOKENS, ConversationContext, Turn
+from embedding_cache import EMBED_MODEL
+from hybrid import search
+from ratelimit import achat_completion
+from sessions import Session
+from vectorstore import VectorStore
+
+CHAT_MODEL = "gpt-4"
+SUMMARY_MODEL = os.environ.get("CHAT_SUMMARY_MODEL", "gpt-3.5-turbo")
+
+
+@dataclass
+class AnswerTiming:
+    retrieval_secs: float = 0.0
+    history_secs: float = 0.0
+    # from the question to the first streamed token, and to the last
+    first_token_secs: float = 0.0
+    total_secs: float = 0.0
+    tokens: int = 0
+    prompt_tokens: int = 0
+
+
+@dataclass
+class Answer:
+    content: str
+    matches: List[dict] = field(default_factory=list)
+    timing: AnswerTiming = field(default_factory=AnswerTiming)
+
+
+class QueryEngine:
+    """A chat with GPT-4, augmented with matches from `store` when there is one"""
+
+    def __init__(self, system_prompt: str, store: Optional[VectorStore] = None,
+                 model: str = CHAT_MODEL, top_k: int = 5, embed_model: str = EMBED_MODEL,
+                 budget: int = CONTEXT_TOKENS, summary_model: str = SUMMARY_MODEL,
+                 session: Optional[Session] = None):
+        self.store = store
+        self.model = model
+        self.top_k = top_k
+        self.embed_model = embed_model
+        self.summary_model = summary_model
+        self.context = ConversationContext(
+            system_prompt, budget, summarize=self._summarize if summary_model else None, model=model
+        )
+        self.session = session
+        if session is not None:
+            self.context.summary = session.summary
+            for question, answer in session.recent_turns(budget, model):
+                self.context.add_turn(question, answer)
+        self._compaction: Optional[asyncio.Task] = None
+
+    async def _retrieve(self, question: str, timing: AnswerTiming) -> List[dict]:
+        if self.store is None:
+            return []
+        started = time.perf_counter()
+        res = await asyncio.to_thread(search, question, self.store, self.top_k, self.embed_model)
+        timing.retrieval_secs = time.perf_counter() - started
+        return res['matches']
+
+    async def _prepare_history(self, timing: AnswerTiming) -> None:
+        """Wait for the previous turn's compaction, usually long done"""
+        started = time.perf_counter()
+        if self._compaction is not None:
+            await self._compaction
+            self._compaction = None
+        timing.history_secs = time.perf_counter() - started
+
+    async def _record(self, role: str, content: str) -> None:
+        if self.session is not None:
+            await asyncio.to_thread(self.session.append, role, content)
+
+    async def _compact(self) -> None:
+        evicted = await self.context.compact()
+        if evicted and self.session is not None and self.context.summary != self.session.summary:
+            await asyncio.to_thread(self.session.set_summary, self.context.summary)
+
+    async def _summarize(self, summary: str, turns: List[Turn]) -> str:
+        transcript = "\n\n".join(f"User: {turn.question}\nAssistant: {turn.answer}" for turn in turns)
+        messages = [
+            {"role": "system", "content": f"Summarize this conversation in under {SUMMARY_TOKENS} tokens. "
+                                          "Keep the facts, names, settings and code the user may refer back to."},
+            {"role": "user", "content": f"Summary so far:\n{summary}\n\nNew turns:\n{transcript}"},
+        ]
+        try:
+            res = await achat_completion(messages, model=self.summary_model, max_tokens=SUMMARY_TOKENS)
+        except openai.error.OpenAIError:
+            # the turns are gone either way, the chat goes on without them
+            return summary
+        return res["choices"][0]["message"]["content"]
+
+    async def ask(self, question: str, on_token: Callable[[str], None] = lambda token: None) -> Answer:
+        """Answer `question`, calling `on_token` with each piece of the answer as it arrives"""
+        started = time.perf_counter()
+        timing = AnswerTiming()
+        matches, _, _ = await asyncio.gather(
+            self._retrieve(question, timing), self._prepare_history(timing), self._record("user", question)
+        )
+        prompt = self.context.build(question, [match['metadata']['text'] for match in matches])
+        timing.prompt_tokens = prompt.tokens
+
+        stream = await achat_completion(prompt.messages, model=self.model, stream=True,
+                                        tokens=prompt.tokens)
+        parts = []
+        async for chunk in stream:
+            token = chunk["choices"][0]["delta"].get("content")
+            if not token:
+                continue
+            if not parts:
+                timing.first_token_secs = time.perf_counter() - started
+            parts.append(token)
+            on_token(token)
+        timing.total_secs = time.perf_counter() - started
+        timing.tokens = len(parts)
+
+        content = "".join(parts)
+        self.context.add_turn(question, content)
+        await self._record("assistant", content)
+        self._compaction = asyncio.create_task(self._compact())
+        return Answer(content=content, matches=matches, timing=timing)
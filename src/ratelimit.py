@@ -0,0 +1,296 @@
+"""Host-wide rate limiting for OpenAI calls.
+
+Each kind of call ("embeddings", "chat") gets a pair of token buckets, one for
+requests per minute and one for tokens per minute. Bucket state lives in a
+small SQLite database, so every worker and every process on the host draws
+from the same budget. A 429 from the API pauses the whole host until its
+Retry-After has passed, and retries back off exponentially with full jitter.
+Chat calls take their prompt and the completion they may write from the token
+bucket, as OpenAI counts both against the limit.
+"""
+import asyncio
+import contextlib
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, TypeVar
+
+import openai
+
+from chunker import model_tokens
+
+T = TypeVar("T")
+
+LIMITS_PATH = Path(
+    os.environ.get("RATE_LIMIT_PATH", Path(__file__).parent / "demo_fs" / "ratelimit.sqlite3")
+)
+MAX_ATTEMPTS = int(os.environ.get("OPENAI_MAX_ATTEMPTS", "8"))
+BACKOFF_BASE_SECS = 1.0
+BACKOFF_MAX_SECS = 60.0
+# completion tokens a chat call is charged when it sets no max_tokens
+COMPLETION_TOKENS = int(os.environ.get("OPENAI_CHAT_COMPLETION_TOKENS", "1000"))
+
+
+@dataclass
+class Limits:
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
+# Defaults match the standard OpenAI account limits, override per host with env vars
+DEFAULT_LIMITS = {
+    "embeddings": Limits(
+        requests_per_minute=int(os.environ.get("OPENAI_EMBED_RPM", "3000")),
+        tokens_per_minute=int(os.environ.get("OPENAI_EMBED_TPM", "1000000")),
+    ),
+    "chat": Limits(
+        requests_per_minute=int(os.environ.get("OPENAI_CHAT_RPM", "200")),
+        tokens_per_minute=int(os.environ.get("OPENAI_CHAT_TPM", "40000")),
+    ),
+}
+
+@dataclass
+class CallStats:
+    """Retries and rate limit waits of the calls made inside `track_calls`"""
+    retries: int = 0
+    rate_limit_errors: int = 0
+    throttled_secs: float = 0.0
+
+
+_call_stats: ContextVar[Optional[CallStats]] = ContextVar("openai_call_stats", default=None)
+
+
+@contextlib.contextmanager
+def track_calls() -> Iterator[CallStats]:
+    """Collect the retries and throttling of the calls made in this context
+
+    Tasks and threads started inside inherit the context, so concurrent
+    batches of one activity add up while other activities stay separate.
+    """
+    stats = CallStats()
+    token = _call_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _call_stats.reset(token)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    requests REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared through SQLite"""
+
+    def __init__(self, name: str, limits: Limits, path: Path = LIMITS_PATH):
+        self.name = name
+        self.limits = limits
+        # metrics for this process
+        self.throttled_secs = 0.0
+        self.throttle_events = 0
+        self.rate_limit_errors = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute(
+                "INSERT OR IGNORE INTO buckets (name, requests, tokens, updated) VALUES (?, ?, ?, ?)",
+                (name, limits.requests_per_minute, limits.tokens_per_minute, time.time()),
+            )
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """Take one request and `tokens` tokens if available
+
+        Returns 0 on success, otherwise the seconds to wait before trying again.
+        """
+        rpm, tpm = self.limits.requests_per_minute, self.limits.tokens_per_minute
+        # a request bigger than a whole minute of budget would never fit
+        tokens = min(tokens, tpm)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                requests, available, updated, blocked_until = self._conn.execute(
+                    "SELECT requests, tokens, updated, blocked_until FROM buckets WHERE name = ?",
+                    (self.name,),
+                ).fetchone()
+                now = time.time()
+                elapsed = max(now - updated, 0.0)
+                requests = min(rpm, requests + elapsed * rpm / 60)
+                available = min(tpm, available + elapsed * tpm / 60)
+                wait = max(
+                    blocked_until - now,
+                    (1 - requests) * 60 / rpm,
+                    (tokens - available) * 60 / tpm,
+                    0.0,
+                )
+                if wait == 0:
+                    requests -= 1
+                    available -= tokens
+                self._conn.execute(
+                    "UPDATE buckets SET requests = ?, tokens = ?, updated = ? WHERE name = ?",
+                    (requests, available, now, self.name),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def block_for(self, secs: float) -> None:
+        """Pause every caller on the host, used when the API says 429"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE buckets SET blocked_until = max(blocked_until, ?) WHERE name = ?",
+                (time.time() + secs, self.name),
+            )
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until the request fits in the budget"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return
+            self._throttled(wait)
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """Wait without blocking the event loop until the request fits in the budget"""
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if wait == 0:
+                return
+            self._throttled(wait)
+            await asyncio.sleep(wait)
+
+    def _throttled(self, wait: float) -> None:
+        self.throttle_events += 1
+        self.throttled_secs += wait
+        stats = _call_stats.get()
+        if stats is not None:
+            stats.throttled_secs += wait
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "throttled_secs": self.throttled_secs,
+            "throttle_events": self.throttle_events,
+            "rate_limit_errors": self.rate_limit_errors,
+            "retries": self.retries,
+        }
+
+    def _backoff(self, err: Exception, attempt: int) -> float:
+        """Seconds to wait after `err` on retry number `attempt`
+
+        A 429 blocks the whole host instead, the next `acquire` waits the
+        block out and counts it as throttled time, so it returns 0.
+        """
+        delay = random.uniform(0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** attempt))
+        stats = _call_stats.get()
+        self.retries += 1
+        if stats is not None:
+            stats.retries += 1
+        if isinstance(err, openai.error.RateLimitError):
+            self.rate_limit_errors += 1
+            if stats is not None:
+                stats.rate_limit_errors += 1
+            self.block_for(max(delay, _retry_after(err) or 0.0))
+            return 0.0
+        self._throttled(delay)
+        return delay
+
+
+def _retry_after(err: Exception) -> Optional[float]:
+    headers = getattr(err, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def call_with_retry(fn: Callable[[], T], limiter: RateLimiter, tokens: int = 0,
+                    max_attempts: int = MAX_ATTEMPTS) -> T:
+    """Call `fn` inside the rate limit, retrying throttled or transient failures"""
+    for attempt in range(max_attempts):
+        limiter.acquire(tokens)
+        try:
+            return fn()
+        except RETRYABLE_ERRORS as err:
+            if attempt == max_attempts - 1:
+                raise
+            time.sleep(limiter._backoff(err, attempt))
+    raise AssertionError("unreachable")
+
+
+async def acall_with_retry(fn: Callable[[], Awaitable[T]], limiter: RateLimiter, tokens: int = 0,
+                           max_attempts: int = MAX_ATTEMPTS) -> T:
+    """Async `call_with_retry`"""
+    for attempt in range(max_attempts):
+        await limiter.aacquire(tokens)
+        try:
+            return await fn()
+        except RETRYABLE_ERRORS as err:
+            if attempt == max_attempts - 1:
+                raise
+            await asyncio.sleep(limiter._backoff(err, attempt))
+    raise AssertionError("unreachable")
+
+
+@lru_cache(maxsize=None)
+def get_limiter(kind: str) -> RateLimiter:
+    """The process wide limiter for "embeddings" or "chat" calls"""
+    return RateLimiter(kind, DEFAULT_LIMITS[kind])
+
+
+def _chat_tokens(messages: List[dict], model: str, prompt_tokens: Optional[int], kwargs: dict) -> int:
+    """Prompt plus completion tokens of a chat call, what its rate limit is charged"""
+    if prompt_tokens is None:
+        prompt_tokens = sum(model_tokens(message["content"], model) for message in messages)
+    return prompt_tokens + (kwargs.get("max_tokens") or COMPLETION_TOKENS) * kwargs.get("n", 1)
+
+
+def chat_completion(messages: List[dict], model: str = "gpt-4", **kwargs):
+    """`openai.ChatCompletion.create` inside the host wide chat rate limit"""
+    return call_with_retry(
+        lambda: openai.ChatCompletion.create(model=model, messages=messages, **kwargs),
+        get_limiter("chat"),
+        tokens=_chat_tokens(messages, model, None, kwargs),
+    )
+
+
+async def achat_completion(messages: List[dict], model: str = "gpt-4", tokens: Optional[int] = None,
+                           **kwargs):
+    """Async `chat_completion`, with `stream=True` it returns an async iterator of chunks
+
+    Pass `tokens` when the prompt has already been counted.
+    """
+    return await acall_with_retry(
+        lambda: openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs),
+        get_limiter("chat"),
+        tokens=_chat_tokens(messages, model, tokens, kwargs),
+    )
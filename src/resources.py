@@ -0,0 +1,64 @@
+"""Clients owned by the worker for its whole lifetime.
+
+`worker.py` opens these once at startup and closes them on shutdown, so the
+activities never pay for `pinecone.init`, `list_indexes`, a probe embedding or
+a fresh gRPC channel. The vector store backend is picked by `VECTOR_STORE`,
+see vectorstore.py. Anything running outside the worker (sync activities in
+a process pool, the CLI scripts) gets the same clients lazily on first use.
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import openai
+
+import downloader
+from embedding_cache import EMBED_MODEL
+from vectorstore import VectorStore, open_store
+
+# text-embedding-ada-002 vectors have 1536 dimensions
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "1536"))
+
+
+@dataclass
+class Resources:
+    store: VectorStore
+    embed_model: str = EMBED_MODEL
+    dimension: int = EMBEDDING_DIMENSION
+
+
+_resources: Optional[Resources] = None
+
+
+def open_resources(store: Optional[VectorStore] = None) -> Resources:
+    """Configure OpenAI and connect to the vector store, or use `store` if given"""
+    global _resources
+    if _resources is not None:
+        return _resources
+
+    openai.api_key = os.environ['OPENAI_API_KEY']
+    _resources = Resources(store=store or open_store(dimension=EMBEDDING_DIMENSION))
+    return _resources
+
+
+def get_resources() -> Resources:
+    """The open resources, opening them on first use outside the worker"""
+    return _resources or open_resources()
+
+
+def use_pooled_openai_session() -> None:
+    """Route async OpenAI calls through the worker's pooled HTTP session
+
+    Must be called from the worker's event loop before the workers start, the
+    session is picked up through a context variable that tasks inherit.
+    """
+    openai.aiosession.set(downloader.get_session())
+
+
+async def close_resources() -> None:
+    """Close the vector store and the pooled HTTP session"""
+    global _resources
+    if _resources is not None:
+        _resources.store.close()
+        _resources = None
+    await downloader.close_session()
@@ -0,0 +1,239 @@
+"""Cache of question embeddings and retrieval results for the ask scripts.
+
+A repeated question costs an embedding request and a vector store query, the
+two slow steps before the chat completion. Both are cached in a SQLite
+database in WAL mode, shared by every process on the host:
+
+- the normalized question text maps to the embedding of the question as
+  it was first asked
+- the embedding, `top_k` and the index version map to the store's matches
+
+Entries expire after `RETRIEVAL_CACHE_TTL_SECS`. The index version is a
+generation counter that the ingestion pipeline bumps with `invalidate()`
+after every write to the vector store, plus the local store's own write
+version, so matches cached before an ingest are never served after it.
+
+The cache and its generation live on this host's disk, so they only hear of
+ingests that run on the same host. When the workers writing to a shared
+Pinecone index run elsewhere, set `REMOTE_INGEST=1` on the ask hosts: their
+matches are then always queried, only question embeddings are cached.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from embedding_cache import EMBED_MODEL, embed_texts
+from vectorstore import PineconeStore, VectorStore
+
+CACHE_PATH = Path(
+    os.environ.get("RETRIEVAL_CACHE_PATH", Path(__file__).parent / "demo_fs" / "retrieval.sqlite3")
+)
+CACHE_TTL_SECS = float(os.environ.get("RETRIEVAL_CACHE_TTL_SECS", "3600"))
+# the workers ingesting into Pinecone run on other hosts than this one
+REMOTE_INGEST = os.environ.get("REMOTE_INGEST", "") not in ("", "0")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    model TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (model, digest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS queries_created ON queries (created);
+CREATE TABLE IF NOT EXISTS results (
+    digest BLOB PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    created REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_created ON results (created);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Fold case, unicode forms and whitespace so trivial variants share an entry"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text).casefold()).strip()
+
+
+def _digest(*parts: bytes) -> bytes:
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(len(part).to_bytes(4, "little"))
+        hasher.update(part)
+    return hasher.digest()
+
+
+class RetrievalCache:
+    """TTL cache of query embeddings and store matches backed by SQLite"""
+
+    def __init__(self, path: Path = CACHE_PATH, ttl: float = CACHE_TTL_SECS):
+        self.path = Path(path)
+        self.ttl = ttl
+        # counters for this process
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    @property
+    def generation(self) -> int:
+        """Bumped by `invalidate`, part of every result key"""
+        with self._lock:
+            (value,) = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'generation'"
+            ).fetchone()
+        return value
+
+    def invalidate(self) -> None:
+        """Retire every cached result, the index behind them has changed"""
+        with self._lock:
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def get_embedding(self, model: str, query: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM queries WHERE model = ? AND digest = ? AND created >= ?",
+                (model, _digest(query.encode()), time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def put_embedding(self, model: str, query: str, vector: Sequence[float]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queries (model, digest, vector, created) VALUES (?, ?, ?, ?)",
+                (model, _digest(query.encode()), array("f", vector).tobytes(), time.time()),
+            )
+
+    def result_key(self, vector: Sequence[float], top_k: int, include_metadata: bool,
+                   index_version: str) -> bytes:
+        return _digest(array("f", vector).tobytes(), f"{top_k}:{include_metadata}".encode(),
+                       index_version.encode())
+
+    def get_result(self, key: bytes) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM results WHERE digest = ? AND created >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put_result(self, key: bytes, generation: int, result: dict) -> None:
+        """Store matches, dropping expired entries and results of older generations"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (digest, generation, result, created) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, generation, json.dumps(result), now),
+                )
+                self._conn.execute(
+                    "DELETE FROM results WHERE created < ? OR generation < ?",
+                    (now - self.ttl, generation),
+                )
+                self._conn.execute("DELETE FROM queries WHERE created < ?", (now - self.ttl,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (queries,) = self._conn.execute("SELECT count(*) FROM queries").fetchone()
+            (results,) = self._conn.execute("SELECT count(*) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "queries": queries, "results": results}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_retrieval_cache() -> RetrievalCache:
+    """The process wide cache at CACHE_PATH"""
+    return RetrievalCache()
+
+
+def invalidate() -> None:
+    """Called by the ingestion pipeline after it writes to the vector store"""
+    get_retrieval_cache().invalidate()
+
+
+def ingested_here(store: VectorStore) -> bool:
+    """Whether every write to `store` reaches this host's caches and lexical index"""
+    return not (REMOTE_INGEST and isinstance(store, PineconeStore))
+
+
+def embed_query(query: str, engine: str = EMBED_MODEL,
+                cache: Optional[RetrievalCache] = None) -> List[float]:
+    """Embedding of the question as asked, from the cache when it has one
+
+    The normalized question is only the cache key, the text that is embedded
+    is the user's own, so retrieval matches what it was without the cache.
+    """
+    cache = cache or get_retrieval_cache()
+    key = normalize_query(query)
+    vector = cache.get_embedding(engine, key)
+    if vector is None:
+        vector = embed_texts([query], engine=engine)[0]
+        cache.put_embedding(engine, key, vector)
+    return vector
+
+
+def query_store(store: VectorStore, vector: Sequence[float], top_k: int = 5,
+                include_metadata: bool = True, cache: Optional[RetrievalCache] = None) -> dict:
+    """`store.query`, served from the cache while the index is unchanged"""
+    if not ingested_here(store):
+        # no invalidation would reach the cache
+        return store.query(vector, top_k=top_k, include_metadata=include_metadata)
+    cache = cache or get_retrieval_cache()
+    generation = cache.generation
+    # the local store counts its own writes, so writers outside the pipeline
+    # invalidate too, Pinecone relies on the generation alone
+    index_version = f"{type(store).__name__}:{getattr(store, 'version', 0)}:{generation}"
+    key = cache.result_key(vector, top_k, include_metadata, index_version)
+    result = cache.get_result(key)
+    if result is None:
+        result = store.query(vector, top_k=top_k, include_metadata=include_metadata)
+        cache.put_result(key, generation, result)
+    return result
+
+
+def retrieve(query: str, store: VectorStore, top_k: int = 5, engine: str = EMBED_MODEL,
+             cache: Optional[RetrievalCache] = None) -> dict:
+    """The `top_k` matches for a question, embedding and querying only on a cache miss"""
+    cache = cache or get_retrieval_cache()
+    return query_store(store, embed_query(query, engine, cache), top_k, cache=cache)
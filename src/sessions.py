@@ -0,0 +1,272 @@
+"""Chat sessions of the playground and ask scripts, appended as they happen.
+
+Every message is a row in a SQLite database in WAL mode, written when it is
+asked or answered, so a crash loses at most the answer being streamed and
+sessions never overwrite each other. A message costs one insert into the
+messages table and one into its FTS5 index, however long the session is.
+The summary of the turns that no longer fit the prompt is kept with the
+session, and `Session.recent_turns` reads back only the newest turns that
+fit the budget, so resuming a long session does not load all of it.
+
+    $ python3 src/sessions.py list
+    $ python3 src/sessions.py search "prebuild env"
+    $ python3 src/sessions.py export 3 --output chatlog.csv
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from conversation import message_tokens
+
+SESSIONS_PATH = Path(
+    os.environ.get("SESSIONS_PATH", Path(__file__).parent / "demo_fs" / "sessions.sqlite3")
+)
+# characters of a session's first question kept as its title
+TITLE_CHARS = 80
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    system_prompt TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    summary TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions (id),
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id'
+);
+"""
+
+
+def _match_expression(query: str) -> str:
+    """Every word of `query` as a quoted FTS5 term, so punctuation is never syntax"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class SessionStore:
+    """Sessions and their messages, with a full-text index, in SQLite"""
+
+    def __init__(self, path: Path = SESSIONS_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def start(self, system_prompt: str) -> "Session":
+        """A new session, its system prompt is its first message"""
+        now = time.time()
+        with self._lock:
+            session_id = self._conn.execute(
+                "INSERT INTO sessions (system_prompt, created, updated) VALUES (?, ?, ?)",
+                (system_prompt, now, now),
+            ).lastrowid
+        session = Session(self, session_id, system_prompt)
+        session.append("system", system_prompt)
+        return session
+
+    def resume(self, session_id: Optional[int] = None) -> "Session":
+        """Session `session_id`, or the last one used"""
+        with self._lock:
+            if session_id is None:
+                row = self._conn.execute(
+                    "SELECT id, system_prompt, title, summary FROM sessions ORDER BY updated DESC LIMIT 1"
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT id, system_prompt, title, summary FROM sessions WHERE id = ?", (session_id,)
+                ).fetchone()
+        if row is None:
+            raise KeyError(f"No session {session_id}" if session_id is not None else "No sessions yet")
+        return Session(self, *row)
+
+    def append(self, session_id: int, role: str, content: str, title: Optional[str] = None) -> int:
+        """Add a message to a session, returns its id"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                message_id = self._conn.execute(
+                    "INSERT INTO messages (session, role, content, created) VALUES (?, ?, ?, ?)",
+                    (session_id, role, content, now),
+                ).lastrowid
+                self._conn.execute(
+                    "INSERT INTO messages_fts (rowid, content) VALUES (?, ?)", (message_id, content)
+                )
+                if title is None:
+                    self._conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (now, session_id))
+                else:
+                    self._conn.execute(
+                        "UPDATE sessions SET updated = ?, title = ? WHERE id = ?", (now, title, session_id)
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return message_id
+
+    def set_summary(self, session_id: int, summary: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET summary = ? WHERE id = ?", (summary, session_id))
+
+    def messages(self, session_id: int, batch: int = 500) -> Iterator[dict]:
+        """Every message of a session, oldest first, read `batch` rows at a time"""
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, role, content, created FROM messages WHERE session = ? AND id > ? "
+                    "ORDER BY id LIMIT ?", (session_id, last, batch),
+                ).fetchall()
+            for message_id, role, content, created in rows:
+                yield {'id': message_id, 'role': role, 'content': content, 'created': created}
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def newest(self, session_id: int, before: Optional[int] = None, batch: int = 50) -> List[Tuple[int, str, str]]:
+        """Up to `batch` (id, role, content) of a session, newest first, older than message `before`"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, role, content FROM messages WHERE session = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?",
+                (session_id, before if before is not None else sys.maxsize, batch),
+            ).fetchall()
+
+    def sessions(self, limit: int = 20) -> List[dict]:
+        """The last `limit` sessions used, most recent first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sessions.id, title, created, updated, "
+                "(SELECT COUNT(*) FROM messages WHERE session = sessions.id) "
+                "FROM sessions ORDER BY updated DESC LIMIT ?", (limit,),
+            ).fetchall()
+        return [{'id': session_id, 'title': title, 'created': created, 'updated': updated, 'messages': count}
+                for session_id, title, created, updated, count in rows]
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        """Messages of any session matching every word of `query`, best match first"""
+        expression = _match_expression(query)
+        if not expression:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT messages.session, messages.id, messages.role, messages.created, "
+                "snippet(messages_fts, 0, '[', ']', '...', 16) "
+                "FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?",
+                (expression, limit),
+            ).fetchall()
+        return [{'session': session, 'id': message_id, 'role': role, 'created': created, 'snippet': snippet}
+                for session, message_id, role, created, snippet in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class Session:
+    store: SessionStore
+    id: int
+    system_prompt: str
+    title: str = ""
+    summary: str = ""
+    _titled: bool = field(default=False, init=False, repr=False)
+
+    def __post_init__(self):
+        self._titled = bool(self.title)
+
+    def append(self, role: str, content: str) -> int:
+        title = None
+        if role == "user" and not self._titled:
+            # the first question names the session
+            title = " ".join(content.split())[:TITLE_CHARS]
+            self.title, self._titled = title, True
+        return self.store.append(self.id, role, content, title)
+
+    def set_summary(self, summary: str) -> None:
+        self.summary = summary
+        self.store.set_summary(self.id, summary)
+
+    def recent_turns(self, budget: int, model: str = "gpt-4") -> List[Tuple[str, str]]:
+        """The newest (question, answer) turns that fit in `budget` tokens of `model`, oldest first
+
+        Reads the session backwards a batch at a time and stops at the budget.
+        """
+        turns, used, answer, before = [], 0, None, None
+        while True:
+            rows = self.store.newest(self.id, before)
+            for message_id, role, content in rows:
+                if role == "assistant":
+                    answer = content
+                elif role == "user" and answer is not None:
+                    used += message_tokens(content, model) + message_tokens(answer, model)
+                    if used > budget:
+                        return turns[::-1]
+                    turns.append((content, answer))
+                    answer = None
+            if not rows:
+                return turns[::-1]
+            before = rows[-1][0]
+
+
+@lru_cache(maxsize=None)
+def get_session_store() -> SessionStore:
+    """The process wide store at SESSIONS_PATH"""
+    return SessionStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="recent sessions").add_argument("--limit", type=int, default=20)
+    search = commands.add_parser("search", help="full-text search of every session")
+    search.add_argument("query")
+    search.add_argument("--limit", type=int, default=10)
+    export = commands.add_parser("export", help="write a session as CSV, like the old chatlog.csv")
+    export.add_argument("session", type=int)
+    export.add_argument("--output", default="chatlog.csv")
+    args = parser.parse_args()
+
+    store = get_session_store()
+    if args.command == "list":
+        for session in store.sessions(args.limit):
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(session['updated']))
+            print(f"{session['id']:>5}  {updated}  {session['messages']:>5} messages  {session['title']}")
+    elif args.command == "search":
+        for match in store.search(args.query, args.limit):
+            print(f"session {match['session']:>5} {match['role']:>9}: {match['snippet']}")
+    elif args.command == "export":
+        with open(args.output, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, ["role", "content"])
+            writer.writeheader()
+            for message in store.messages(args.session):
+                writer.writerow({'role': message['role'], 'content': message['content']})
+        print(f"Wrote session {args.session} to `{args.output}`")
+
+
+if __name__ == "__main__":
+    main()
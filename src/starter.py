@@ -1,9 +1,15 @@
 import asyncio
+import os
+import sys
 from uuid import uuid4
 
 from temporalio.client import Client
 
-from tasks import FileProcessing
+import codec
+from workflows import CrawlParams, CrawlWorkflow
+
+TEMPORAL_ADDRESS = os.environ.get("TEMPORAL_ADDRESS", "localhost:7233")
+CRAWL_CONCURRENCY = int(os.environ.get("CRAWL_CONCURRENCY", "10"))
 
 # URLs to populate pinecone with docs
 urls = [
@@ -28,23 +34,34 @@ urls = [
 
 async def main():
     # Connect client
-    client = await Client.connect("localhost:7233")
+    client = await Client.connect(TEMPORAL_ADDRESS, data_converter=codec.data_converter)
 
-    # Start 10 concurrent workflows
-    futures = []
-    for idx in range(len(urls)):
-        result = client.execute_workflow(
-            FileProcessing.run,
-            urls[idx],
-            id=f"activity_sticky_queue-workflow-id-{idx}",
-            task_queue="activity_sticky_queue-distribution-queue",
-        )
-        await asyncio.sleep(0.1)
-        futures.append(result)
+    # One crawl workflow runs the pages as child workflows, a few at a time.
+    # Pass a sitemap URL to ingest every page it lists instead of the list above.
+    sitemap_url = sys.argv[1] if len(sys.argv) > 1 else None
+    result = await client.execute_workflow(
+        CrawlWorkflow.run,
+        CrawlParams(
+            urls=[] if sitemap_url else urls,
+            sitemap_url=sitemap_url,
+            concurrency=CRAWL_CONCURRENCY,
+        ),
+        id=f"activity_sticky_queue-crawl-{uuid4()}",
+        task_queue="activity_sticky_queue-distribution-queue",
+    )
 
-    checksums = await asyncio.gather(*futures)
-    print("\n".join([f"Output checksums:"] + checksums))
+    print(f"{result.processed} processed, {result.skipped} skipped, {result.failed} failed")
+    for url, error in result.failures.items():
+        print(f"  {url}: {error}")
+    print("Time per stage, summed over pages:")
+    for stage, timing in result.stages.items():
+        print(f"  {stage:<10} {timing.secs:8.2f}s  {timing.bytes:>12,} bytes  {timing.tokens:>10,} tokens  "
+              f"{timing.batches:>6} batches  {timing.throttled_secs:6.2f}s throttled")
+    dedup = result.stages.get("dedup")
+    if dedup and dedup.items:
+        print(f"Linked {dedup.items} near duplicate chunks to existing vectors instead of embedding them, "
+              f"saving {dedup.tokens:,} tokens")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,46 +1,44 @@
+"""Activity implementations of the ingestion pipeline.
+
+The workflows that run them, and the types they take and return, are in
+workflows.py. Only the worker imports this module. BS4 and langchain are
+only needed to parse pages, which happens in the worker's parse pool, so
+they are imported on first use there rather than by every worker process.
+"""
 import asyncio
-from dataclasses import dataclass
-from datetime import timedelta
+import json
+import os
+import signal
+import time
+import xml.etree.ElementTree as ElementTree
 from pathlib import Path
+from typing import List
 
-from temporalio import activity, workflow
-from temporalio.common import RetryPolicy
+import aiohttp
+from temporalio import activity
 from temporalio.exceptions import ApplicationError
 
-with workflow.unsafe.imports_passed_through():
-    import aiohttp
-    import pinecone
-    import tiktoken
-    from langchain.document_loaders import BSHTMLLoader
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-    from uuid import uuid4
-    from tqdm.auto import tqdm
-    import openai
-    import os
-
-def _get_delay_secs() -> float:
-    return 3 
-
-def tiktoken_len(text) -> int:
-    tokenizer = tiktoken.get_encoding('p50k_base')
-    tokens = tokenizer.encode(
-        text,
-        disallowed_special=()
-    )
-    return len(tokens)
+import downloader
+from chunker import get_tokenizer, iter_chunks, tiktoken_len
+from dedup import get_dedup_index
+from embedding_cache import aembed_texts
+from lexical import get_lexical_index
+from manifest import chunk_id, plan_ingest, save_manifest
+from pipeline import embed_and_upsert
+from ratelimit import track_calls
+from resources import get_resources
+import retrieval_cache
+from workflows import ChunkedObj, DownloadedObj, DownloadObj, ProcessedObj, StageTiming
+
 
 def _get_local_path() -> Path:
     return Path(__file__).parent / "demo_fs"
 
 
-def write_file(path: Path, body: str) -> None:
-    """Write to the filesystem"""
-    with open(path, "w") as handle:
-        handle.write(body)
-
-
 def read_file(path, url) -> list:
     """Read file and load with BS4"""
+    from langchain.document_loaders import BSHTMLLoader
+
     loader = BSHTMLLoader(path)
     data = loader.load()
     plain_text = []
@@ -51,6 +49,31 @@ def read_file(path, url) -> list:
     return plain_text
 
 
+def init_parse_process() -> None:
+    """Start a process of the worker's parse pool
+
+    Ignores ctrl+c so running parses can finish while the worker drains, and
+    loads the tokenizer and the HTML loader before the first page needs them.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_tokenizer()
+    from langchain.document_loaders import BSHTMLLoader  # noqa: F401
+
+
+def _load_json(path: str):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def parse_sitemap(body: bytes) -> dict:
+    """Page and nested sitemap URLs listed in a sitemap or sitemap index"""
+    root = ElementTree.fromstring(body)
+    locs = [el.text.strip() for el in root.iter() if el.tag.endswith("loc") and el.text]
+    if root.tag.endswith("sitemapindex"):
+        return {"pages": [], "sitemaps": locs}
+    return {"pages": locs, "sitemaps": []}
+
+
 def delete_file(path) -> None:
     """Convenience delete wrapper"""
     Path(path).unlink()
@@ -64,184 +87,225 @@ def create_filepath(unique_worker_id: str, workflow_uuid: str) -> Path:
     return filepath
 
 
-def process_file_contents(file_content: list) -> str:
-    """split, create embeddings, and post to pinecone"""
-    text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=400,
-    chunk_overlap=20,
-    length_function=tiktoken_len,
-    separators=["\n\n", "\n", " ", ""]
-    )
-    chunks = []
-    
-    for idx, record in enumerate(tqdm(file_content)):
-        texts = text_splitter.split_text(record['text'])
-        chunks.extend([{
-          'id': str(uuid4()),
-         'text': texts[i],
-         'chunk': i,
-          'url': record['source']
-       } for i in range(len(texts))])
-    
-    openai.api_key = os.environ['OPENAI_API_KEY']
-    embed_model = "text-embedding-ada-002"
-    index_name = os.environ['PINECONE_INDEX']
-    pinecone.init(
-    api_key=os.environ['PINECONE_API_KEY'],  # app.pinecone.io (console)
-    environment=os.environ['PINECONE_ENVIRONMENT']  # next to API key in console
-    )
-    
-    res = openai.Embedding.create(
-        input=[
-            "Sample document text goes here",
-            "there will be several phrases in each batch"
-        ], engine=embed_model
+def chunk_file_contents(file_content: list) -> dict:
+    """split into chunks and work out what changed since the last ingest
+
+    Only chunks that changed since the last ingest of a URL need embedding, and
+    chunks that disappeared from the page need deleting from the index.
+    """
+    pages = {}
+
+    for idx, record in enumerate(file_content):
+        pages.setdefault(record['source'], []).extend([{
+            'id': chunk_id(record['source'], i, text),
+            'text': text,
+            'chunk': i,
+            'url': record['source']
+        } for i, text in enumerate(iter_chunks(record['text']))])
+
+    pending_ids = []
+    stale_ids = []
+    for url, page_chunks in pages.items():
+        pending, stale = plan_ingest(url, page_chunks)
+        pending_ids.extend(chunk['id'] for chunk in pending)
+        stale_ids.extend(stale)
+
+    return {"pages": pages, "pending_ids": pending_ids, "stale_ids": stale_ids}
+
+
+def chunks_path_for(path: str) -> str:
+    """Where the chunks of a downloaded page are kept between activities"""
+    return f"{path}.chunks.json"
+
+
+def dedup_chunks(chunks: List[dict]) -> tuple:
+    """Chunks to embed, their near duplicates and the tokens those would have cost"""
+    chunks, duplicates = get_dedup_index().claim(chunks)
+    return chunks, duplicates, sum(tiktoken_len(chunk['text']) for chunk in duplicates)
+
+
+async def process_file_contents(plan: dict) -> ProcessedObj:
+    """create embeddings for new chunks, post to the vector store and drop stale chunks"""
+    pending_ids = set(plan['pending_ids'])
+    chunks = [
+        chunk for page_chunks in plan['pages'].values()
+        for chunk in page_chunks if chunk['id'] in pending_ids
+    ]
+    stale_ids = plan['stale_ids']
+
+    if not chunks and not stale_ids:
+        return ProcessedObj(summary="Processed 0 documents to the vector store, page unchanged")
+
+    # clients are opened once by the worker, see resources.py
+    res = get_resources()
+    store = res.store
+    embed_model = res.embed_model
+
+    # release the chunks that are no longer on the page first, so an edited
+    # chunk is not linked to the stale one it replaces, and keep the vectors
+    # other pages link to
+    started = time.perf_counter()
+    stale_ids = await asyncio.to_thread(get_dedup_index().release, stale_ids)
+    release_secs = time.perf_counter() - started
+
+    # chunks that nearly match ones already in the index link to their
+    # vectors instead of being embedded, see dedup.py
+    started = time.perf_counter()
+    chunks, duplicates, saved_tokens = await asyncio.to_thread(dedup_chunks, chunks)
+    dedup = StageTiming(secs=time.perf_counter() - started, tokens=saved_tokens, items=len(duplicates))
+
+    async def embed(texts, token_counts):
+        # create embeddings, reusing any the cache already has
+        return await aembed_texts(texts, engine=embed_model, token_counts=token_counts)
+
+    async def upsert(vectors):
+        # the store clients block, so keep them off the event loop
+        await asyncio.to_thread(store.upsert, vectors)
+
+    with track_calls() as calls:
+        stats = await embed_and_upsert(chunks, embed, upsert)
+    # only now can other pages link to the new vectors
+    await asyncio.to_thread(get_dedup_index().commit, chunks)
+    activity.logger.info(f"Embedded {stats.chunks} chunks in {stats.batches} batches, "
+                         f"{stats.chunks_per_sec:.1f} chunks/s, skipped {len(duplicates)} near duplicates")
+    # embed and upsert time is summed over concurrent batches
+    stages = {
+        "embed": StageTiming(secs=stats.embed_secs, tokens=stats.tokens, batches=stats.batches,
+                             items=stats.chunks, retries=calls.retries,
+                             throttled_secs=calls.throttled_secs),
+        "upsert": StageTiming(secs=stats.upsert_secs, batches=stats.upserts, items=stats.chunks),
+        # items and tokens that were not sent to the embeddings API
+        "dedup": dedup,
+    }
+
+    # drop chunks that are no longer on the page
+    if stale_ids:
+        started = time.perf_counter()
+        await asyncio.to_thread(store.delete, stale_ids)
+        stages["delete"] = StageTiming(secs=release_secs + time.perf_counter() - started, batches=1,
+                                       items=len(stale_ids))
+
+    # keep the keyword index in step with the vector store, see lexical.py
+    started = time.perf_counter()
+    lexical_index = get_lexical_index()
+    await asyncio.to_thread(lexical_index.add, chunks)
+    await asyncio.to_thread(lexical_index.delete, stale_ids)
+    stages["lexical"] = StageTiming(secs=time.perf_counter() - started, items=len(chunks) + len(stale_ids))
+    # cached answers to questions may be out of date now
+    await asyncio.to_thread(retrieval_cache.invalidate)
+    for url, page_chunks in plan['pages'].items():
+        save_manifest(url, page_chunks)
+
+    return ProcessedObj(
+        summary=f"Processed {len(chunks)} documents to the vector store, deleted {len(stale_ids)}, "
+                f"linked {len(duplicates)} near duplicates",
+        chunks=len(chunks),
+        deleted=len(stale_ids),
+        stages=stages,
     )
-    # check if index already exists (it shouldn't if this is first time)
-    if index_name not in pinecone.list_indexes():
-        # if does not exist, create index
-        pinecone.create_index(
-            index_name,
-            dimension=len(res['data'][0]['embedding']),
-            metric='dotproduct'
-        )
-    # connect to index
-    index = pinecone.GRPCIndex(index_name)
-
-    batch_size = 100  # how many embeddings we create and insert at once
-
-    for i in tqdm(range(0, len(chunks), batch_size)):
-        # find end of batch
-        i_end = min(len(chunks), i+batch_size)
-        meta_batch = chunks[i:i_end]
-        # get ids
-        ids_batch = [x['id'] for x in meta_batch]
-        # get texts to encode
-        texts = [x['text'] for x in meta_batch]
-        # create embeddings (try-except added to avoid RateLimitError)
-        
-        res = openai.Embedding.create(input=texts, engine=embed_model)
-        embeds = [record['embedding'] for record in res['data']]
-        # cleanup metadata
-        meta_batch = [{
-            'text': x['text'],
-            'chunk': x['chunk'],
-            'url': x['url']
-        } for x in meta_batch]
-        to_upsert = list(zip(ids_batch, embeds, meta_batch))
-        # upsert to Pinecone
-        index.upsert(vectors=to_upsert)
-
-    return f"Processed {len(chunks)} documents to pinecone"
-
-
-@dataclass
-class DownloadObj:
-    url: str
-    unique_worker_id: str
-    workflow_uuid: str
-
-@dataclass
-class DownloadedObj:
-    url: str
-    path: str
+
 
 @activity.defn
-async def get_available_task_queue() -> str:
-    """Just a stub for typedworkflow invocation."""
-    raise NotImplementedError
+async def expand_sitemap(sitemap_url: str) -> List[str]:
+    """Page URLs of a sitemap, following nested sitemap indexes"""
+    session = downloader.get_session()
+    pending, seen, pages = [sitemap_url], set(), []
+    while pending:
+        url = pending.pop()
+        if url in seen:
+            continue
+        seen.add(url)
+        async with session.get(url, raise_for_status=True) as resp:
+            found = parse_sitemap(await resp.read())
+        activity.heartbeat(url)
+        pages.extend(found["pages"])
+        pending.extend(reversed(found["sitemaps"]))
+    return pages
 
 
 @activity.defn
-async def download_file_to_worker_filesystem(details: DownloadObj) -> str:
-    """Download a URL to local filesystem"""
+async def download_file_to_worker_filesystem(details: DownloadObj) -> DownloadedObj:
+    """Download a URL to local filesystem
+
+    Sends the validators from the last ingest of the URL, so an unchanged page
+    comes back as not modified and nothing is written.
+    """
     # FS ops
     path = create_filepath(details.unique_worker_id, details.workflow_uuid)
-    activity.logger.info(f"Downloading ${details.url} and saving to ${path}")
-
-    # Here is where the real download code goes. Developers should be careful
-    # not to block an async activity. If there are concerns about blocking download
-    # or disk IO, developers should use loop.run_in_executor or change this activity
-    # to be synchronous. Also like for all non-immediate activities, be sure to
-    # heartbeat during download.
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(details.url) as resp:
-            # We don't want to retry client failure
-            if resp.status >= 400 and resp.status < 500:
-                raise ApplicationError(f"Status: {resp.status}", resp.json(), non_retryable=True)
-            # Otherwise, fail on bad status which will be inherently retried
-            with open(path, 'wb') as fd:
-                async for chunk in resp.content.iter_chunked(10):
-                    fd.write(chunk)
-    return str(path)
+    activity.logger.info(f"Downloading {details.url} and saving to {path}")
+
+    started = time.perf_counter()
+    try:
+        result = await downloader.download(details.url, path, progress=activity.heartbeat)
+    except aiohttp.ClientResponseError as err:
+        # We don't want to retry client failure
+        if 400 <= err.status < 500:
+            raise ApplicationError(f"Status: {err.status}", err.message, non_retryable=True)
+        # Otherwise, fail on bad status which will be inherently retried
+        raise
+
+    stages = {"download": StageTiming(secs=time.perf_counter() - started, bytes=result.bytes_written)}
+
+    if result.not_modified:
+        activity.logger.info(f"{details.url} not modified since last ingest")
+        return DownloadedObj(url=details.url, path="", not_modified=True, stages=stages)
+    return DownloadedObj(
+        url=details.url,
+        path=str(path),
+        etag=result.etag,
+        last_modified=result.last_modified,
+        stages=stages,
+    )
 
 
 @activity.defn
-async def work_on_file_in_worker_filesystem(dl_file: DownloadedObj) -> str:
-    """Processing the file, in this case identical MD5 hashes"""
-    content = read_file(dl_file.path, dl_file.url)
-    checksum = process_file_contents(content)
-    activity.logger.info(f"Did some work on {dl_file.path} with the URL {dl_file.url}, checksum {checksum}")
-    return checksum
+def parse_and_chunk_file(dl_file: DownloadedObj) -> ChunkedObj:
+    """Parse and chunk the downloaded page
+
+    This is a synchronous activity so the worker can run it in its process
+    pool, keeping BS4 and tokenization off the event loop.
+    """
+    started = time.perf_counter()
+    records = read_file(dl_file.path, dl_file.url)
+    parsed = time.perf_counter()
+    plan = chunk_file_contents(records)
+    stages = {
+        "parse": StageTiming(secs=parsed - started, bytes=os.path.getsize(dl_file.path)),
+        "split": StageTiming(
+            secs=time.perf_counter() - parsed,
+            bytes=sum(len(record['text'].encode()) for record in records),
+            items=sum(len(page_chunks) for page_chunks in plan['pages'].values()),
+        ),
+    }
+    chunks_path = chunks_path_for(dl_file.path)
+    with open(chunks_path, "w") as handle:
+        json.dump(plan, handle)
+    return ChunkedObj(
+        url=dl_file.url,
+        chunks_path=chunks_path,
+        pending=len(plan['pending_ids']),
+        stale=len(plan['stale_ids']),
+        etag=dl_file.etag,
+        last_modified=dl_file.last_modified,
+        stages=stages,
+    )
+
+
+@activity.defn
+async def work_on_file_in_worker_filesystem(chunked: ChunkedObj) -> ProcessedObj:
+    """Embed and upsert the chunks of a page, then remember it as ingested"""
+    plan = await asyncio.to_thread(_load_json, chunked.chunks_path)
+    processed = await process_file_contents(plan)
+    # only now is the page safe to skip on the next conditional download
+    downloader.save_validators(chunked.url, chunked.etag, chunked.last_modified)
+    activity.logger.info(f"Did some work on {chunked.chunks_path} with the URL {chunked.url}, "
+                         f"checksum {processed.summary}")
+    return processed
 
 
 @activity.defn
 async def clean_up_file_from_worker_filesystem(path: str) -> None:
-    """Deletes the file created in the first activity, but leaves the folder"""
+    """Deletes the files created by the earlier activities, but leaves the folder"""
     activity.logger.info(f"Removing {path}")
     delete_file(path)
-
-
-@workflow.defn
-class FileProcessing:
-    @workflow.run
-    async def run(self, url: str) -> str:
-        """Workflow implementing the basic file processing example.
-
-        First, a worker is selected randomly. This is the "sticky worker" on which
-        the workflow runs. This consists of a file download and the Pinecone pipeline,
-        with a file cleanup if an error occurs.
-        """
-        workflow.logger.info("Searching for available worker")
-        workflow.logger.info(f"url: {url}")
-        unique_worker_task_queue = await workflow.execute_activity(
-            activity=get_available_task_queue,
-            start_to_close_timeout=timedelta(seconds=120),
-        )
-        workflow.logger.info(f"Matching workflow to worker {unique_worker_task_queue}")
-
-        download_params = DownloadObj(
-            url=url,
-            unique_worker_id=unique_worker_task_queue,
-            workflow_uuid=str(workflow.uuid4()),
-        )
-
-        download_path = await workflow.execute_activity(
-            download_file_to_worker_filesystem,
-            download_params,
-            start_to_close_timeout=timedelta(seconds=120),
-            task_queue=unique_worker_task_queue,
-        )
-
-        downloaded_file = DownloadedObj(url=url, path=download_path)
-
-        checksum = "failed execution"  # Sentinel value
-        try:
-            checksum = await workflow.execute_activity(
-                work_on_file_in_worker_filesystem,
-                downloaded_file,
-                start_to_close_timeout=timedelta(seconds=120),
-                retry_policy=RetryPolicy(
-                    maximum_attempts=2,
-                    # maximum_interval=timedelta(milliseconds=500),
-                ),
-                task_queue=unique_worker_task_queue,
-            )
-        finally:
-            await workflow.execute_activity(
-                clean_up_file_from_worker_filesystem,
-                download_path,
-                start_to_close_timeout=timedelta(seconds=120),
-                task_queue=unique_worker_task_queue,
-            )
-        return checksum
\ No newline at end of file
+    Path(chunks_path_for(path)).unlink(missing_ok=True)
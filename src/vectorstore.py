@@ -0,0 +1,446 @@
+"""Vector index backends.
+
+`VectorStore` is the small interface the ingestion activities and the ask
+scripts need: upsert, query and delete. `PineconeStore` wraps a Pinecone gRPC
+index. `LocalStore` keeps vectors in a memory-mapped matrix on disk, optionally
+quantized to float16 or int8, with ids and metadata in a SQLite side table, and
+answers dotproduct top-k queries with NumPy. It needs no network at all, which
+makes it handy for small corpora and for running the pipeline offline. Once a
+local store grows past `IVF_MIN_VECTORS` it builds an IVF index (see ann.py)
+and queries only scan the closest clusters.
+
+Pick the backend with `VECTOR_STORE=pinecone` (the default) or `VECTOR_STORE=local`.
+"""
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import ann
+
+Vector = Tuple[str, Sequence[float], dict]
+
+LOCAL_STORE_PATH = Path(
+    os.environ.get("LOCAL_STORE_PATH", Path(__file__).parent / "demo_fs" / "vectors")
+)
+LOCAL_STORE_DTYPE = os.environ.get("LOCAL_STORE_DTYPE", "float32")
+# "ivf" builds an approximate index once the store is big enough, "flat" always scans every row
+LOCAL_STORE_INDEX = os.environ.get("LOCAL_STORE_INDEX", "ivf")
+# rows scored per block, bounds the temporary memory a query needs
+_QUERY_BLOCK_ROWS = 65536
+
+
+class VectorStore(ABC):
+    """Minimal vector index interface, results are shaped like Pinecone's"""
+
+    @abstractmethod
+    def upsert(self, vectors: Sequence[Vector]) -> None:
+        """Insert or replace (id, values, metadata) tuples"""
+
+    @abstractmethod
+    def query(self, vector: Sequence[float], top_k: int = 5, include_metadata: bool = True) -> dict:
+        """{'matches': [{'id', 'score', 'metadata'}, ...]} ordered by dotproduct score"""
+
+    @abstractmethod
+    def delete(self, ids: Sequence[str]) -> None:
+        """Remove vectors by id, unknown ids are ignored"""
+
+    def describe(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class PineconeStore(VectorStore):
+    """A Pinecone index reached over gRPC"""
+
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def connect(cls, index_name: Optional[str] = None, dimension: int = 1536) -> "PineconeStore":
+        """Initialise Pinecone and connect to the index, creating it if missing"""
+        import pinecone
+
+        index_name = index_name or os.environ['PINECONE_INDEX']
+        pinecone.init(
+            api_key=os.environ['PINECONE_API_KEY'],  # app.pinecone.io (console)
+            environment=os.environ['PINECONE_ENVIRONMENT']  # next to API key in console
+        )
+        # check if index already exists (it shouldn't if this is first time)
+        if index_name not in pinecone.list_indexes():
+            pinecone.create_index(index_name, dimension=dimension, metric='dotproduct')
+        return cls(pinecone.GRPCIndex(index_name))
+
+    def upsert(self, vectors: Sequence[Vector]) -> None:
+        self.index.upsert(vectors=list(vectors))
+
+    def query(self, vector: Sequence[float], top_k: int = 5, include_metadata: bool = True) -> dict:
+        res = self.index.query(vector, top_k=top_k, include_metadata=include_metadata)
+        return {'matches': [{
+            'id': match['id'],
+            'score': match['score'],
+            'metadata': dict(match['metadata']) if include_metadata else {},
+        } for match in res['matches']]}
+
+    def delete(self, ids: Sequence[str]) -> None:
+        self.index.delete(ids=list(ids))
+
+    def describe(self) -> dict:
+        return self.index.describe_index_stats()
+
+    def close(self) -> None:
+        self.index.close()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    row INTEGER PRIMARY KEY,
+    id TEXT UNIQUE,
+    metadata TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    list INTEGER
+);
+CREATE INDEX IF NOT EXISTS vectors_deleted ON vectors (deleted);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0');
+INSERT OR IGNORE INTO meta (key, value) VALUES ('ivf_epoch', '0');
+"""
+
+
+class LocalStore(VectorStore):
+    """Memory-mapped vector matrix with a SQLite side table
+
+    Row `i` of `vectors.bin` holds the vector whose `row` is `i` in the SQLite
+    table. Deleted rows are zeroed and reused by later inserts. Writes go
+    through a SQLite write transaction, so several processes can share a store.
+    For int8 storage every row also gets a float32 scale in `scales.bin`.
+    Quantized rows are widened to float32 block by block at query time, which
+    trades some query latency for a half or quarter of the disk and page cache.
+
+    With `index="ivf"` the first write that takes the store past `min_vectors`
+    trains k-means centroids, saved to `ivf_centroids.npy`, and every row's
+    cluster is kept in the `list` column from then on. Queries score the rows
+    of the `nprobe` closest clusters only; raise `nprobe` for recall, lower it
+    for latency. `build_index` retrains from scratch, worth doing after the
+    corpus has grown several times over.
+    """
+
+    def __init__(self, path: Path = LOCAL_STORE_PATH, dtype: str = LOCAL_STORE_DTYPE,
+                 index: str = LOCAL_STORE_INDEX, nprobe: int = ann.IVF_NPROBE,
+                 min_vectors: int = ann.IVF_MIN_VECTORS):
+        if index not in ("ivf", "flat"):
+            raise ValueError(f"Unknown local store index {index!r}")
+        self.index = index
+        self.nprobe = nprobe
+        self.min_vectors = min_vectors
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            str(self.path / "meta.sqlite3"), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock:
+            columns = [c[1] for c in self._conn.execute("PRAGMA table_info(vectors)")]
+            if columns and "list" not in columns:
+                self._conn.execute("ALTER TABLE vectors ADD COLUMN list INTEGER")
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dtype', ?)", (dtype,))
+        self.dtype = np.dtype(self._meta("dtype"))
+        if self.dtype not in (np.float32, np.float16, np.int8):
+            raise ValueError(f"Unsupported local store dtype {self.dtype}")
+        self.dimension = int(self._meta("dimension") or 0)
+        # query side state, reloaded whenever the store version moves
+        self._loaded_version = -1
+        self._matrix: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._live: np.ndarray = np.zeros(0, dtype=bool)
+        self._row_ids: List[Optional[str]] = []
+        self._ivf: Optional[ann.IVFIndex] = None
+        self._ivf_epoch = 0
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def version(self) -> int:
+        """Bumped by every write, lets readers notice a changed index"""
+        with self._lock:
+            return int(self._meta("version"))
+
+    def _open_matrix(self, rows: int, mode: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        matrix = np.memmap(self.path / "vectors.bin", dtype=self.dtype, mode=mode,
+                           shape=(rows, self.dimension))
+        scales = None
+        if self.dtype == np.int8:
+            scales = np.memmap(self.path / "scales.bin", dtype=np.float32, mode=mode, shape=(rows,))
+        return matrix, scales
+
+    def _ensure_capacity(self, rows: int) -> None:
+        """Grow the backing files to hold at least `rows` rows"""
+        files = [(self.path / "vectors.bin", self.dtype.itemsize * self.dimension)]
+        if self.dtype == np.int8:
+            files.append((self.path / "scales.bin", 4))
+        for file_path, row_bytes in files:
+            size = file_path.stat().st_size if file_path.exists() else 0
+            if size < rows * row_bytes:
+                # double to keep growth amortised
+                with open(file_path, "ab") as handle:
+                    handle.truncate(max(rows, 2 * size // row_bytes, 1024) * row_bytes)
+
+    def _encode(self, values: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self.dtype == np.int8:
+            scales = np.abs(values).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.round(values / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return values.astype(self.dtype), None
+
+    def upsert(self, vectors: Sequence[Vector]) -> None:
+        if not vectors:
+            return
+        values = np.asarray([v[1] for v in vectors], dtype=np.float32)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not self.dimension:
+                    self.dimension = int(self._meta("dimension") or values.shape[1])
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) VALUES ('dimension', ?)",
+                        (str(self.dimension),),
+                    )
+                if values.shape[1] != self.dimension:
+                    raise ValueError(f"Expected {self.dimension} dimensions, got {values.shape[1]}")
+                rows = []
+                for vector_id, _, metadata in vectors:
+                    existing = self._conn.execute(
+                        "SELECT row FROM vectors WHERE id = ?", (vector_id,)
+                    ).fetchone() or self._conn.execute(
+                        "SELECT row FROM vectors WHERE deleted = 1 LIMIT 1"
+                    ).fetchone()
+                    if existing:
+                        self._conn.execute(
+                            "UPDATE vectors SET id = ?, metadata = ?, deleted = 0 WHERE row = ?",
+                            (vector_id, json.dumps(metadata), existing[0]),
+                        )
+                        rows.append(existing[0])
+                    else:
+                        cursor = self._conn.execute(
+                            "INSERT INTO vectors (id, metadata) VALUES (?, ?)",
+                            (vector_id, json.dumps(metadata)),
+                        )
+                        rows.append(cursor.lastrowid)
+                (total,) = self._conn.execute("SELECT coalesce(max(row), 0) + 1 FROM vectors").fetchone()
+                self._ensure_capacity(total)
+                matrix, scales = self._open_matrix(total, "r+")
+                encoded, encoded_scales = self._encode(values)
+                matrix[rows] = encoded
+                if scales is not None:
+                    scales[rows] = encoded_scales
+                matrix.flush()
+                if self._load_ivf() is not None:
+                    self._conn.executemany(
+                        "UPDATE vectors SET list = ? WHERE row = ?",
+                        zip(ann.assign(values, self._ivf.centroids).tolist(), rows),
+                    )
+                elif self.index == "ivf":
+                    (live,) = self._conn.execute("SELECT count(*) FROM vectors WHERE deleted = 0").fetchone()
+                    if live >= self.min_vectors:
+                        self._train(total)
+                self._bump_version()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def build_index(self, nlist: Optional[int] = None) -> None:
+        """(Re)train the IVF centroids on the live rows and reassign every row"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                (total,) = self._conn.execute("SELECT coalesce(max(row), 0) + 1 FROM vectors").fetchone()
+                self._train(total, nlist)
+                self._bump_version()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _train(self, total: int, nlist: Optional[int] = None) -> None:
+        """Cluster the live rows, must be called inside a write transaction"""
+        rows = np.array([row for (row,) in self._conn.execute(
+            "SELECT row FROM vectors WHERE deleted = 0 ORDER BY row"
+        )], dtype=np.int64)
+        if not len(rows) or not self.dimension:
+            return
+        matrix, scales = self._open_matrix(total, "r")
+        sample = rows
+        if len(sample) > ann.KMEANS_MAX_SAMPLE:
+            sample = np.sort(np.random.default_rng(667).choice(rows, ann.KMEANS_MAX_SAMPLE, replace=False))
+        index = ann.IVFIndex(ann.kmeans(self._decode(matrix, scales, sample), nlist or ann.default_nlist(len(rows))))
+        lists = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), _QUERY_BLOCK_ROWS):
+            block = rows[start:start + _QUERY_BLOCK_ROWS]
+            lists[start:start + len(block)] = ann.assign(self._decode(matrix, scales, block), index.centroids)
+        self._conn.executemany("UPDATE vectors SET list = ? WHERE row = ?", zip(lists.tolist(), rows.tolist()))
+        index.save(self.path / "ivf_centroids.npy")
+        self._conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'ivf_epoch'")
+        self._ivf, self._ivf_epoch = index, int(self._meta("ivf_epoch"))
+
+    def _load_ivf(self) -> Optional[ann.IVFIndex]:
+        """The current centroids, reloaded if another process retrained them"""
+        epoch = int(self._meta("ivf_epoch"))
+        if epoch != self._ivf_epoch:
+            self._ivf = ann.IVFIndex.load(self.path / "ivf_centroids.npy") if epoch else None
+            self._ivf_epoch = epoch
+        return self._ivf
+
+    @staticmethod
+    def _decode(matrix: np.ndarray, scales: Optional[np.ndarray], rows: np.ndarray) -> np.ndarray:
+        values = matrix[rows].astype(np.float32)
+        if scales is not None:
+            values *= scales[rows][:, None]
+        return values
+
+    def delete(self, ids: Sequence[str]) -> None:
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = []
+                for vector_id in ids:
+                    row = self._conn.execute("SELECT row FROM vectors WHERE id = ?", (vector_id,)).fetchone()
+                    if row:
+                        rows.append(row[0])
+                self._conn.executemany(
+                    "UPDATE vectors SET id = NULL, metadata = NULL, deleted = 1, list = NULL WHERE row = ?",
+                    [(row,) for row in rows],
+                )
+                if rows and self.dimension:
+                    (total,) = self._conn.execute("SELECT max(row) + 1 FROM vectors").fetchone()
+                    matrix, _ = self._open_matrix(total, "r+")
+                    matrix[rows] = 0
+                    matrix.flush()
+                self._bump_version()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _bump_version(self) -> None:
+        self._conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+
+    def _refresh(self) -> None:
+        """Remap the matrix and reload the live rows if another writer changed them"""
+        version = self.version
+        if version == self._loaded_version:
+            return
+        with self._lock:
+            self.dimension = self.dimension or int(self._meta("dimension") or 0)
+            entries = self._conn.execute("SELECT row, id, list FROM vectors").fetchall()
+            ivf = self._load_ivf()
+        total = max((row for row, _, _ in entries), default=-1) + 1
+        self._row_ids = [None] * total
+        self._live = np.zeros(total, dtype=bool)
+        for row, vector_id, _ in entries:
+            self._row_ids[row] = vector_id
+            self._live[row] = vector_id is not None
+        if ivf is not None:
+            filed = [(row, cluster) for row, _, cluster in entries if cluster is not None]
+            ivf.set_assignments([row for row, _ in filed], [cluster for _, cluster in filed])
+        if total and self.dimension:
+            self._matrix, self._scales = self._open_matrix(total, "r")
+        else:
+            self._matrix, self._scales = None, None
+        self._loaded_version = version
+
+    def scores(self, vector: Sequence[float]) -> np.ndarray:
+        """Dotproduct of `vector` with every row, -inf for empty rows"""
+        self._refresh()
+        if self._matrix is None:
+            return np.zeros(0, dtype=np.float32)
+        query = np.asarray(vector, dtype=np.float32)
+        out = np.empty(len(self._live), dtype=np.float32)
+        for start in range(0, len(out), _QUERY_BLOCK_ROWS):
+            block = self._matrix[start:start + _QUERY_BLOCK_ROWS]
+            out[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+        if self._scales is not None:
+            out *= self._scales
+        out[~self._live] = -np.inf
+        return out
+
+    def rows_to_matches(self, rows: Sequence[int], scores: Sequence[float],
+                        include_metadata: bool = True) -> List[dict]:
+        """Pinecone shaped matches for matrix rows"""
+        metadata: Dict[int, dict] = {}
+        if include_metadata and len(rows):
+            with self._lock:
+                found = self._conn.execute(
+                    f"SELECT row, metadata FROM vectors WHERE row IN ({','.join('?' * len(rows))})",
+                    [int(row) for row in rows],
+                ).fetchall()
+            metadata = {row: json.loads(value) for row, value in found if value}
+        return [{
+            'id': self._row_ids[row],
+            'score': float(score),
+            'metadata': metadata.get(int(row), {}),
+        } for row, score in zip(rows, scores)]
+
+    def approximate_scores(self, vector: Sequence[float], nprobe: Optional[int] = None
+                           ) -> Tuple[np.ndarray, np.ndarray]:
+        """(rows, scores) for the rows in the `nprobe` clusters closest to `vector`"""
+        self._refresh()
+        query = np.asarray(vector, dtype=np.float32)
+        # sorted rows keep the memmap reads moving forward through the file
+        rows = np.sort(self._ivf.candidates(query, nprobe or self.nprobe))
+        return rows, self._decode(self._matrix, self._scales, rows) @ query
+
+    def query(self, vector: Sequence[float], top_k: int = 5, include_metadata: bool = True) -> dict:
+        self._refresh()
+        rows = np.zeros(0, dtype=np.int64)
+        if self.index == "ivf" and self._ivf is not None and self.nprobe < self._ivf.nlist:
+            rows, scores = self.approximate_scores(vector)
+        if len(rows) < top_k:
+            # too few candidates in the probed clusters, fall back to a full scan
+            scores = self.scores(vector)
+            rows = np.flatnonzero(self._live[:len(scores)])
+            scores = scores[rows]
+        k = min(top_k, len(rows))
+        if k == 0:
+            return {'matches': []}
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return {'matches': self.rows_to_matches(rows[top], scores[top], include_metadata)}
+
+    def describe(self) -> dict:
+        self._refresh()
+        return {'dimension': self.dimension, 'total_vector_count': int(self._live.sum()),
+                'dtype': str(self.dtype), 'index': self.index,
+                'nlist': self._ivf.nlist if self._ivf is not None else 0}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        self._matrix = self._scales = None
+
+
+def open_store(kind: Optional[str] = None, index_name: Optional[str] = None,
+               dimension: int = 1536) -> VectorStore:
+    """The vector store picked by `kind` or the VECTOR_STORE env var"""
+    kind = kind or os.environ.get("VECTOR_STORE", "pinecone")
+    if kind == "pinecone":
+        return PineconeStore.connect(index_name, dimension)
+    if kind == "local":
+        return LocalStore()
+    raise ValueError(f"Unknown vector store {kind!r}")
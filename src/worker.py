@@ -1,74 +1,209 @@
 import asyncio
 import logging  # noqa
+import multiprocessing
+import os
 import random
+import signal
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import timedelta
+from multiprocessing.managers import SyncManager
 from typing import List
 from uuid import UUID
 
 from temporalio import activity
 from temporalio.client import Client
-from temporalio.worker import Worker
+from temporalio.worker import SharedStateManager, Worker
 
+import codec
+import metrics
+import placement
+import resources
 import tasks
+import workflows
+from chunker import get_tokenizer
 
 interrupt_event = asyncio.Event()
 
+TEMPORAL_ADDRESS = os.environ.get("TEMPORAL_ADDRESS", "localhost:7233")
 
-async def main():
-    # Uncomment the line below to see logging
-    # logging.basicConfig(level=logging.INFO)
+# Worker processes on this host, each polls the distribution queue and owns
+# QUEUES_PER_PROCESS sticky queues
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", os.cpu_count() or 1))
+QUEUES_PER_PROCESS = int(os.environ.get("QUEUES_PER_PROCESS", "1"))
+# Processes for the CPU bound parse and chunk activity, per worker process
+PARSE_POOL_SIZE = int(os.environ.get("PARSE_POOL_SIZE", max(1, (os.cpu_count() or 1) // WORKER_PROCESSES)))
+# Activities each per-host queue runs at once
+ACTIVITY_SLOTS = int(os.environ.get("ACTIVITY_SLOTS", "100"))
+# Workflow tasks the distribution worker in each process runs at once
+MAX_WORKFLOW_TASKS = int(os.environ.get("MAX_WORKFLOW_TASKS", "100"))
+# How long running activities get to finish after SIGTERM before they are cancelled
+DRAIN_TIMEOUT_SECS = float(os.environ.get("DRAIN_TIMEOUT_SECS", "60"))
+# Worker process i serves Prometheus metrics on METRICS_PORT + i
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+DISTRIBUTION_QUEUE = "activity_sticky_queue-distribution-queue"
 
+
+def sticky_task_queues(count: int) -> List[str]:
+    """Names for the host's sticky queues, the same on every start"""
     # Comment line to see non-deterministic functionality
     random.seed(667)
-
-    # Create random task queues and build task queue selection function
-    task_queues: List[str] = [
+    return [
         f"activity_sticky_queue-host-{UUID(int=random.getrandbits(128))}"
-        for _ in range(5)
+        for _ in range(count)
     ]
 
-    @activity.defn(name="get_available_task_queue")
-    async def select_task_queue_random() -> str:
-        """Randomly assign the job to a queue"""
-        return random.choice(task_queues)
 
-    # Start client
-    client = await Client.connect("localhost:7233")
+def create_workers(client: Client, task_queues: List[str], activity_executor: Executor,
+                   shared_state_manager: SharedStateManager) -> List[Worker]:
+    """The distribution worker plus a worker for each of `task_queues`"""
+    # Every queue reports its load to the host's load board
+    board = placement.get_load_board()
+    for queue_id in task_queues:
+        board.register(queue_id, slots=ACTIVITY_SLOTS)
+
+    @activity.defn(name="get_available_task_queue")
+    async def select_task_queue(url: str) -> str:
+        """Assign the job to the least loaded queue on this host"""
+        return await asyncio.to_thread(board.choose)
 
     # Run a worker to distribute the workflows
-    run_futures = []
-    handle = Worker(
+    workers = [Worker(
         client,
-        task_queue="activity_sticky_queue-distribution-queue",
-        workflows=[tasks.FileProcessing],
-        activities=[select_task_queue_random],
-    )
-    run_futures.append(handle.run())
-    print("Base worker started")
+        task_queue=DISTRIBUTION_QUEUE,
+        workflows=[workflows.FileProcessing, workflows.CrawlWorkflow],
+        activities=[select_task_queue, tasks.expand_sitemap],
+        max_concurrent_workflow_tasks=MAX_WORKFLOW_TASKS,
+        graceful_shutdown_timeout=timedelta(seconds=DRAIN_TIMEOUT_SECS),
+    )]
 
     # Run the workers for the individual task queues
     for queue_id in task_queues:
-        handle = Worker(
+        workers.append(Worker(
             client,
             task_queue=queue_id,
             activities=[
                 tasks.download_file_to_worker_filesystem,
+                tasks.parse_and_chunk_file,
                 tasks.work_on_file_in_worker_filesystem,
                 tasks.clean_up_file_from_worker_filesystem,
             ],
+            activity_executor=activity_executor,
+            shared_state_manager=shared_state_manager,
+            max_concurrent_activities=ACTIVITY_SLOTS,
+            graceful_shutdown_timeout=timedelta(seconds=DRAIN_TIMEOUT_SECS),
+            interceptors=[placement.LoadReportingInterceptor(), metrics.MetricsInterceptor()],
+        ))
+    return workers
+
+
+async def serve(task_queues: List[str], index: int = 0):
+    """Run the distribution worker and the workers for `task_queues` until SIGTERM"""
+    # Uncomment the line below to see logging
+    # logging.basicConfig(level=logging.INFO)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, interrupt_event.set)
+
+    board = placement.get_load_board()
+
+    async def heartbeat_load_board() -> None:
+        while True:
+            await asyncio.to_thread(board.heartbeat, task_queues)
+            await asyncio.sleep(placement.STALE_SECS / 3)
+
+    # Start client, with the SDK's metrics folded into this process's /metrics.
+    # While it connects, open the OpenAI/Pinecone clients every activity
+    # reuses and load the tokenizer the embedding batches are counted with.
+    runtime, temporal_metrics = metrics.temporal_runtime()
+    client, _, _ = await asyncio.gather(
+        Client.connect(TEMPORAL_ADDRESS, data_converter=codec.data_converter, runtime=runtime),
+        asyncio.to_thread(resources.open_resources),
+        asyncio.to_thread(get_tokenizer),
+    )
+    resources.use_pooled_openai_session()
+    metrics_runner = await metrics.serve_metrics(METRICS_PORT + index, temporal_metrics)
+
+    # Sync activities run in a process pool, heartbeats go through the manager.
+    # Spawn rather than fork so children never inherit the open gRPC channel.
+    # The children ignore ctrl+c and load their parsers up front, and are
+    # started now, in the background, rather than by the first page.
+    parse_pool = ProcessPoolExecutor(
+        max_workers=PARSE_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"),
+        initializer=tasks.init_parse_process,
+    )
+    parse_pool.submit(int)
+    manager = SyncManager(ctx=multiprocessing.get_context("spawn"))
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    shared_state_manager = SharedStateManager.create_from_multiprocessing(manager)
+
+    workers = create_workers(client, task_queues, parse_pool, shared_state_manager)
+
+    run_futures = [asyncio.create_task(worker.run()) for worker in workers]
+    heartbeat = asyncio.create_task(heartbeat_load_board())
+    print(f"[{os.getpid()}] Workers for {', '.join(task_queues)} started, "
+          f"metrics on :{METRICS_PORT + index}/metrics")
+
+    # Wait until interrupted, or until a worker fails
+    interrupted = asyncio.create_task(interrupt_event.wait())
+    await asyncio.wait([interrupted, *run_futures], return_when=asyncio.FIRST_COMPLETED)
+
+    # Drain: stop taking new work, then give running activities time to finish
+    print(f"[{os.getpid()}] Draining workers")
+    for queue_id in task_queues:
+        board.unregister(queue_id)
+    heartbeat.cancel()
+    await asyncio.gather(*[worker.shutdown() for worker in workers], return_exceptions=True)
+    await asyncio.gather(*run_futures, return_exceptions=True)
+    interrupted.cancel()
+    parse_pool.shutdown()
+    manager.shutdown()
+    await metrics_runner.cleanup()
+    await resources.close_resources()
+    print(f"[{os.getpid()}] Workers stopped")
+
+
+def run_process(task_queues: List[str], index: int = 0) -> None:
+    """Entry point of each spawned worker process"""
+    asyncio.run(serve(task_queues, index))
+
+
+def main():
+    task_queues = sticky_task_queues(WORKER_PROCESSES * QUEUES_PER_PROCESS)
+    if WORKER_PROCESSES == 1:
+        run_process(task_queues)
+        return
+
+    # Spawned children get their own event loop, clients and parse pool
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_process,
+            args=(task_queues[i * QUEUES_PER_PROCESS:(i + 1) * QUEUES_PER_PROCESS], i),
+            name=f"worker-{i}",
         )
-        run_futures.append(handle.run())
-        # Wait until interrupted
-        print(f"Worker {queue_id} started")
+        for i in range(WORKER_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    print(f"Started {WORKER_PROCESSES} worker processes, ctrl+c to exit")
+
+    def forward(sig, frame):
+        # ctrl+c already reaches the children through the process group
+        if sig == signal.SIGTERM:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
 
-    print("All workers started, ctrl+c to exit")
-    await asyncio.gather(*run_futures)
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            print(f"{process.name} exited with code {process.exitcode}")
+    print("\nShutting down workers")
 
 
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    try:
-        loop.run_until_complete(main())
-    except KeyboardInterrupt:
-        interrupt_event.set()
-        loop.run_until_complete(loop.shutdown_asyncgens())
-        print("\nShutting down workers")
\ No newline at end of file
+    main()
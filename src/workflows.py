@@ -0,0 +1,294 @@
+"""Workflow definitions of the ingestion pipeline and the types they pass around.
+
+Only this module is loaded into the workflow sandbox, for every workflow run,
+so it imports nothing but the Temporal SDK and the standard library. The
+activities themselves are in tasks.py with their heavy dependencies, the
+workflows call them through the typed stubs below, which carry the activity
+names and result types. `starter.py` needs nothing else to start a crawl.
+"""
+import asyncio
+from dataclasses import dataclass, fields
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from temporalio import activity, workflow
+from temporalio.common import RetryPolicy
+from temporalio.exceptions import ChildWorkflowError
+
+
+@dataclass
+class StageTiming:
+    secs: float = 0.0
+    bytes: int = 0
+    tokens: int = 0
+    batches: int = 0
+    items: int = 0
+    # OpenAI calls only: retried requests and time spent waiting on rate limits
+    retries: int = 0
+    throttled_secs: float = 0.0
+
+    def add(self, other: "StageTiming") -> "StageTiming":
+        return StageTiming(*(getattr(self, f.name) + getattr(other, f.name) for f in fields(self)))
+
+
+def merge_stages(*stage_maps: Optional[Dict[str, StageTiming]]) -> Dict[str, StageTiming]:
+    """Sum stage timings by stage name"""
+    merged: Dict[str, StageTiming] = {}
+    for stages in stage_maps:
+        for name, timing in (stages or {}).items():
+            merged[name] = merged.get(name, StageTiming()).add(timing)
+    return merged
+
+
+# Activity arguments and results are recorded in workflow history, so they
+# only ever carry references: paths to files on the sticky worker, counts and
+# validators. Page bodies, chunk text and embeddings stay on the worker.
+# `stages` holds the timings of the activity's stages, see metrics.py.
+@dataclass
+class DownloadObj:
+    url: str
+    unique_worker_id: str
+    workflow_uuid: str
+
+@dataclass
+class DownloadedObj:
+    url: str
+    path: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    not_modified: bool = False
+    stages: Optional[Dict[str, StageTiming]] = None
+
+@dataclass
+class ChunkedObj:
+    url: str
+    chunks_path: str
+    pending: int
+    stale: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    stages: Optional[Dict[str, StageTiming]] = None
+
+@dataclass
+class ProcessedObj:
+    summary: str
+    chunks: int = 0
+    deleted: int = 0
+    stages: Optional[Dict[str, StageTiming]] = None
+
+@dataclass
+class FileResult:
+    url: str
+    summary: str
+    chunks: int = 0
+    deleted: int = 0
+    skipped: bool = False
+    # summed timings of every activity, plus the workflow's own wall time
+    stages: Optional[Dict[str, StageTiming]] = None
+    wall_secs: float = 0.0
+
+@dataclass
+class CrawlParams:
+    urls: List[str]
+    sitemap_url: Optional[str] = None
+    # FileProcessing children running at once
+    concurrency: int = 10
+    # URLs handled before continuing as new, keeps each run's history bounded
+    urls_per_run: int = 500
+    # carried across continue-as-new, counts rather than per URL results so
+    # each run's input stays the same size however far the crawl has got
+    offset: int = 0
+    processed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    failures: Optional[Dict[str, str]] = None
+    stages: Optional[Dict[str, StageTiming]] = None
+
+
+# failed URLs reported with their error, the rest are only counted
+MAX_REPORTED_FAILURES = 100
+
+
+@dataclass
+class CrawlResult:
+    processed: int
+    skipped: int
+    failed: int
+    # the first MAX_REPORTED_FAILURES failed URLs and their errors
+    failures: Dict[str, str]
+    # stage timings summed over every page
+    stages: Dict[str, StageTiming]
+
+
+# Stubs of the activities in tasks.py and worker.py, for typed workflow
+# invocation. The workers register the implementations under the same names.
+@activity.defn
+async def expand_sitemap(sitemap_url: str) -> List[str]:
+    raise NotImplementedError
+
+
+@activity.defn
+async def get_available_task_queue(url: str) -> str:
+    raise NotImplementedError
+
+
+@activity.defn
+async def download_file_to_worker_filesystem(details: DownloadObj) -> DownloadedObj:
+    raise NotImplementedError
+
+
+@activity.defn
+def parse_and_chunk_file(dl_file: DownloadedObj) -> ChunkedObj:
+    raise NotImplementedError
+
+
+@activity.defn
+async def work_on_file_in_worker_filesystem(chunked: ChunkedObj) -> ProcessedObj:
+    raise NotImplementedError
+
+
+@activity.defn
+async def clean_up_file_from_worker_filesystem(path: str) -> None:
+    raise NotImplementedError
+
+
+@workflow.defn
+class FileProcessing:
+    @workflow.run
+    async def run(self, url: str) -> FileResult:
+        """Workflow implementing the basic file processing example.
+
+        First, the least loaded worker is selected, preferring the one that
+        processed the URL before. This is the "sticky worker" on which
+        the workflow runs. This consists of a file download and the Pinecone pipeline,
+        with a file cleanup if an error occurs. The result carries the timings
+        of every stage.
+        """
+        started = workflow.now()
+        workflow.logger.info("Searching for available worker")
+        workflow.logger.info(f"url: {url}")
+        unique_worker_task_queue = await workflow.execute_activity(
+            get_available_task_queue,
+            url,
+            start_to_close_timeout=timedelta(seconds=120),
+        )
+        workflow.logger.info(f"Matching workflow to worker {unique_worker_task_queue}")
+
+        download_params = DownloadObj(
+            url=url,
+            unique_worker_id=unique_worker_task_queue,
+            workflow_uuid=str(workflow.uuid4()),
+        )
+
+        downloaded_file = await workflow.execute_activity(
+            download_file_to_worker_filesystem,
+            download_params,
+            start_to_close_timeout=timedelta(seconds=120),
+            heartbeat_timeout=timedelta(seconds=30),
+            task_queue=unique_worker_task_queue,
+        )
+        if downloaded_file.not_modified:
+            return FileResult(
+                url=url,
+                summary=f"Skipped {url}, not modified since last ingest",
+                skipped=True,
+                stages=downloaded_file.stages,
+                wall_secs=(workflow.now() - started).total_seconds(),
+            )
+
+        processed = ProcessedObj(summary="failed execution")  # Sentinel value
+        try:
+            chunked_file = await workflow.execute_activity(
+                parse_and_chunk_file,
+                downloaded_file,
+                start_to_close_timeout=timedelta(seconds=120),
+                retry_policy=RetryPolicy(
+                    maximum_attempts=2,
+                ),
+                task_queue=unique_worker_task_queue,
+            )
+            processed = await workflow.execute_activity(
+                work_on_file_in_worker_filesystem,
+                chunked_file,
+                start_to_close_timeout=timedelta(seconds=120),
+                retry_policy=RetryPolicy(
+                    maximum_attempts=2,
+                    # maximum_interval=timedelta(milliseconds=500),
+                ),
+                task_queue=unique_worker_task_queue,
+            )
+        finally:
+            await workflow.execute_activity(
+                clean_up_file_from_worker_filesystem,
+                downloaded_file.path,
+                start_to_close_timeout=timedelta(seconds=120),
+                task_queue=unique_worker_task_queue,
+            )
+        return FileResult(
+            url=url,
+            summary=processed.summary,
+            chunks=processed.chunks,
+            deleted=processed.deleted,
+            stages=merge_stages(downloaded_file.stages, chunked_file.stages, processed.stages),
+            wall_secs=(workflow.now() - started).total_seconds(),
+        )
+
+@workflow.defn
+class CrawlWorkflow:
+    @workflow.run
+    async def run(self, params: CrawlParams) -> CrawlResult:
+        """Ingest a list of URLs, or every page of a sitemap, as one durable job
+
+        Each URL runs as a FileProcessing child workflow, at most
+        `params.concurrency` at a time. After `params.urls_per_run` URLs the
+        workflow continues as new with the rest, carrying the counts and stage
+        timings so far.
+        """
+        urls = list(params.urls)
+        if params.sitemap_url:
+            urls += await workflow.execute_activity(
+                expand_sitemap,
+                params.sitemap_url,
+                start_to_close_timeout=timedelta(seconds=300),
+                heartbeat_timeout=timedelta(seconds=60),
+            )
+            # a page listed twice would only be ingested twice
+            urls = list(dict.fromkeys(urls))
+        counts = {"processed": params.processed, "skipped": params.skipped, "failed": params.failed}
+        failures = dict(params.failures or {})
+        stages = dict(params.stages or {})
+        batch, rest = urls[:params.urls_per_run], urls[params.urls_per_run:]
+        window = asyncio.Semaphore(params.concurrency)
+
+        async def process(index: int, url: str) -> None:
+            async with window:
+                try:
+                    result = await workflow.execute_child_workflow(
+                        FileProcessing.run,
+                        url,
+                        id=f"{workflow.info().workflow_id}-url-{index}",
+                    )
+                except ChildWorkflowError as err:
+                    workflow.logger.warning(f"Failed to process {url}: {err.cause}")
+                    counts["failed"] += 1
+                    if len(failures) < MAX_REPORTED_FAILURES:
+                        failures[url] = str(err.cause)
+                    return
+                counts["skipped" if result.skipped else "processed"] += 1
+                stages.update(merge_stages(stages, result.stages))
+
+        await asyncio.gather(*[
+            process(params.offset + i, url) for i, url in enumerate(batch)
+        ])
+
+        if rest:
+            workflow.continue_as_new(CrawlParams(
+                urls=rest,
+                concurrency=params.concurrency,
+                urls_per_run=params.urls_per_run,
+                offset=params.offset + len(batch),
+                failures=failures,
+                stages=stages,
+                **counts,
+            ))
+        return CrawlResult(failures=failures, stages=stages, **counts)
@@ -0,0 +1,56 @@
+"""Runs the tests against src/ with every piece of host state in a scratch directory.
+
+The pipeline modules read their paths when they are imported, so the
+environment is set here, before any test imports them.
+"""
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC))
+
+from benchmarks.scratch import use_scratch_env  # noqa: E402
+
+SCRATCH = use_scratch_env("tests-")
+
+import pytest  # noqa: E402
+
+import resources  # noqa: E402
+import tasks  # noqa: E402
+from vectorstore import VectorStore  # noqa: E402
+
+
+class MemoryStore(VectorStore):
+    """Vectors in a dict, by id, as (values, metadata)"""
+
+    def __init__(self):
+        self.vectors = {}
+
+    def upsert(self, vectors) -> None:
+        self.vectors.update((vector_id, (values, metadata)) for vector_id, values, metadata in vectors)
+
+    def query(self, vector, top_k: int = 5, include_metadata: bool = True) -> dict:
+        scores = {vector_id: sum(a * b for a, b in zip(values, vector))
+                  for vector_id, (values, _) in self.vectors.items()}
+        return {'matches': [{
+            'id': vector_id,
+            'score': scores[vector_id],
+            'metadata': dict(self.vectors[vector_id][1]) if include_metadata else {},
+        } for vector_id in sorted(scores, key=scores.get, reverse=True)[:top_k]]}
+
+    def delete(self, ids) -> None:
+        for vector_id in ids:
+            self.vectors.pop(vector_id, None)
+
+
+async def fake_embed(texts, engine=None, cache=None, token_counts=None):
+    return [[float(len(text))] for text in texts]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """A fresh in-memory store for the ingest activities, with embeddings made up locally"""
+    store = MemoryStore()
+    monkeypatch.setattr(resources, "_resources", resources.Resources(store=store))
+    monkeypatch.setattr(tasks, "aembed_texts", fake_embed)
+    return store
@@ -0,0 +1,110 @@
+"""An edited chunk is embedded in place of the stale one, not linked to it."""
+import asyncio
+import time
+
+from temporalio.testing import ActivityEnvironment
+
+import bulk_ingest
+from dedup import DedupIndex
+from lexical import get_lexical_index
+import tasks
+
+TEXT = " ".join(f"word{i}" for i in range(90))
+EDITED = TEXT.replace("word45", "edited")
+
+
+def page(url, text):
+    return [{"text": text, "source": url}]
+
+
+def test_dedup_links_near_duplicates_of_other_pages(tmp_path):
+    dedup_index = DedupIndex(tmp_path / "dedup.sqlite3", threshold=0.85)
+    unique, duplicates = dedup_index.claim([{"id": "a", "text": TEXT}, {"id": "b", "text": EDITED}])
+    assert [chunk["id"] for chunk in unique] == ["a"]
+    assert [chunk["id"] for chunk in duplicates] == ["b"]
+    # "a" is kept while "b" links to it
+    assert dedup_index.release(["a"]) == []
+    assert dedup_index.release(["b"]) == ["a"]
+
+
+def test_uncommitted_chunks_are_not_linked_from_other_pages(tmp_path):
+    dedup_index = DedupIndex(tmp_path / "dedup.sqlite3", threshold=0.85)
+    dedup_index.claim([{"id": "a", "text": TEXT}])
+    # the upsert of "a" has not happened, it may never
+    unique, _ = dedup_index.claim([{"id": "b", "text": TEXT}])
+    assert [chunk["id"] for chunk in unique] == ["b"]
+    dedup_index.commit(unique)
+    _, duplicates = dedup_index.claim([{"id": "c", "text": EDITED}])
+    assert dedup_index._conn.execute("SELECT vector_id FROM refs WHERE chunk_id = 'c'").fetchone() == ("b",)
+
+
+def test_edited_chunk_replaces_stale_one(store):
+    url = "https://docs.test.local/edited"
+    env = ActivityEnvironment()
+    before = tasks.chunk_file_contents(page(url, TEXT))
+    asyncio.run(env.run(tasks.process_file_contents, before))
+    (old_id,) = before["pending_ids"]
+    assert store.vectors[old_id][1]["text"] == TEXT
+
+    after = tasks.chunk_file_contents(page(url, EDITED))
+    assert after["stale_ids"] == [old_id]
+    processed = asyncio.run(env.run(tasks.process_file_contents, after))
+    (new_id,) = after["pending_ids"]
+    assert (processed.chunks, processed.deleted) == (1, 1)
+    assert store.vectors[new_id][1]["text"] == EDITED
+    assert old_id not in store.vectors
+    assert [match["id"] for match in get_lexical_index().search("edited")] == [new_id]
+    assert old_id not in [match["id"] for match in get_lexical_index().search("word45")]
+
+
+def test_shared_chunk_edited_on_two_pages(store):
+    footer = " ".join(f"footer{i}" for i in range(90))
+    edited = footer.replace("footer45", "edited")
+    first, second = "https://docs.test.local/first", "https://docs.test.local/second"
+    env = ActivityEnvironment()
+
+    def ingest(url, text):
+        plan = tasks.chunk_file_contents(page(url, text))
+        return plan, asyncio.run(env.run(tasks.process_file_contents, plan))
+
+    plan, _ = ingest(first, footer)
+    (old_id,) = plan["pending_ids"]
+    _, processed = ingest(second, footer)
+    assert processed.chunks == 0
+
+    # the second page still links to the old footer, so it stays, but the
+    # first page's edit is embedded rather than linked to it
+    plan, processed = ingest(first, edited)
+    (new_id,) = plan["pending_ids"]
+    assert (processed.chunks, processed.deleted) == (1, 0)
+    assert store.vectors[new_id][1]["text"] == edited
+    assert old_id in store.vectors
+
+    # the second page's edit links to the first page's, and nothing links
+    # to the old footer any more
+    _, processed = ingest(second, edited)
+    assert (processed.chunks, processed.deleted) == (0, 1)
+    assert old_id not in store.vectors
+    assert [metadata["text"] for _, metadata in store.vectors.values() if "footer" in metadata["text"]] == [edited]
+
+
+def test_bulk_ingest_edited_chunk_replaces_stale_one(tmp_path, store):
+    root = tmp_path / "rtdocs"
+    path = root / "docs.test.local" / "bulk.html"
+    path.parent.mkdir(parents=True)
+    dedup_index = DedupIndex(tmp_path / "dedup.sqlite3", threshold=0.85)
+    checkpoint = bulk_ingest.Checkpoint(tmp_path / "checkpoint.sqlite3")
+
+    async def embed(texts, token_counts):
+        return [[float(len(text))] for text in texts]
+
+    for text in [TEXT, EDITED]:
+        path.write_text(f'<html><body><main id="main-content"><p>{text}</p></main></body></html>')
+        stats = asyncio.run(bulk_ingest.ingest(root, store, embed, checkpoint, dedup_index=dedup_index,
+                                               workers=1))
+        assert (stats.files, stats.chunks, stats.duplicates) == (1, 1, 0)
+        # a new mtime for the edit, however coarse the filesystem's clock
+        time.sleep(0.01)
+
+    assert stats.deleted == 1
+    assert [metadata["text"] for _, metadata in store.vectors.values()] == [EDITED]
@@ -0,0 +1,20 @@
+"""Cache lookups never wait on the database's write lock."""
+import sqlite3
+
+from embedding_cache import EmbeddingCache
+
+MODEL = "text-embedding-ada-002"
+
+
+def test_lookups_do_not_take_the_write_lock(tmp_path):
+    cache = EmbeddingCache(tmp_path / "embeddings.sqlite3")
+    cache.put_many(MODEL, ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    # another process is writing
+    writer = sqlite3.connect(str(cache.path), isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    cache._conn.execute("PRAGMA busy_timeout = 0")
+    assert cache.get_many(MODEL, ["a", "c"]) == [[1.0, 2.0], None]
+    writer.execute("ROLLBACK")
+
+    stats = cache.stats()
+    assert (stats["host_hits"], stats["host_misses"]) == (1, 1)
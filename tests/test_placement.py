@@ -0,0 +1,18 @@
+"""Concurrent placement spreads work over the queues."""
+import threading
+from collections import Counter
+
+from placement import LoadBoard
+
+
+def test_concurrent_choices_see_each_other(tmp_path):
+    board = LoadBoard(tmp_path / "load_board.sqlite3")
+    for queue in ["a", "b", "c", "d"]:
+        board.register(queue, slots=2)
+    picks = []
+    threads = [threading.Thread(target=lambda: picks.append(board.choose())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert Counter(picks) == {"a": 2, "b": 2, "c": 2, "d": 2}
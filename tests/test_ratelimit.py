@@ -0,0 +1,26 @@
+"""A 429 is waited out once and counted once."""
+import time
+
+import openai
+
+from ratelimit import Limits, RateLimiter, call_with_retry, track_calls
+
+
+def test_rate_limit_error_is_throttled_once(tmp_path):
+    limiter = RateLimiter("chat", Limits(requests_per_minute=6000, tokens_per_minute=10 ** 6),
+                          tmp_path / "ratelimit.sqlite3")
+    calls = []
+
+    def fn():
+        calls.append(time.time())
+        if len(calls) == 1:
+            raise openai.error.RateLimitError("slow down", headers={"retry-after": "0.5"})
+        return "ok"
+
+    with track_calls() as stats:
+        assert call_with_retry(fn, limiter) == "ok"
+    # the jittered backoff may block for longer than Retry-After
+    waited = calls[1] - calls[0]
+    assert waited >= 0.5
+    assert waited - 0.1 < stats.throttled_secs <= waited
+    assert (stats.retries, stats.rate_limit_errors) == (1, 1)
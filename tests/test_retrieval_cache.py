@@ -0,0 +1,31 @@
+"""Retrieval from a Pinecone index ingested on other hosts skips host-local state."""
+import pytest
+
+import hybrid
+import retrieval_cache
+from retrieval_cache import RetrievalCache, query_store
+from vectorstore import PineconeStore
+
+
+class CountingIndex:
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, vector, top_k, include_metadata):
+        self.queries += 1
+        return {'matches': [{'id': 'a', 'score': 1.0, 'metadata': {'text': 'a'}}]}
+
+
+def test_remote_ingest_skips_host_local_state(tmp_path, monkeypatch):
+    index = CountingIndex()
+    store = PineconeStore(index)
+    cache = RetrievalCache(tmp_path / "retrieval.sqlite3")
+    query_store(store, [1.0, 0.0], cache=cache)
+    query_store(store, [1.0, 0.0], cache=cache)
+    assert index.queries == 1
+
+    monkeypatch.setattr(retrieval_cache, "REMOTE_INGEST", True)
+    query_store(store, [1.0, 0.0], cache=cache)
+    assert index.queries == 2
+    with pytest.raises(ValueError):
+        hybrid.search("question", store, mode="hybrid")
@@ -0,0 +1,16 @@
+"""The command line scripts start and parse their arguments."""
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.mark.parametrize("script", ["playground.py", "ask-embeddings-loop.py", "create-embeddings.py"])
+def test_help(script):
+    result = subprocess.run([sys.executable, str(ROOT / script), "--help"], cwd=ROOT,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith("usage:")